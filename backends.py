@@ -0,0 +1,31 @@
+from typing import Dict
+import simulation
+import eulerian
+import parallel
+
+"""
+This file lets the user interface and validation choose between simulation backends with the same
+interface using the 'backend' parameter:
+    "particles": Lagrangian particle simulation (see simulation.Simulation). This is the default.
+    "eulerian":  Grid based finite volume simulation (see eulerian.EulerianSimulation), which has no
+                 statistical noise and is cheaper than the particle method for high resolution grids.
+    "shared":    Particle simulation split across the number of worker processes set by the 'processes'
+                 parameter (see parallel.SharedSimulation), for very large particle counts.
+"""
+backends = {
+    "particles": simulation.Simulation,
+    "eulerian": eulerian.EulerianSimulation,
+    "shared": lambda parameters: parallel.SharedSimulation(parameters, parameters.get("processes"))
+}
+
+
+def create_simulation(parameters: Dict[str, any]):
+    """
+    Args:
+        parameters: Simulation parameters, including an optional 'backend' (defaults to "particles").
+    Returns:
+        Simulation created using the chosen backend.
+    """
+    backend = parameters.get("backend", "particles")
+    assert backend in backends, "Backend must be one of: " + ", ".join(backends)
+    return backends[backend](parameters)
@@ -0,0 +1,307 @@
+from typing import Dict, List
+import numpy as np
+import subprocess
+import argparse
+import platform
+import time
+import json
+import sys
+import os
+import simulation
+import validation
+import core
+
+"""
+This file implements benchmarks for the performance critical parts of the simulation.
+The simulation phases are timed while scaling the particle count and the concentration grid size.
+Results are written as JSON and can be compared against a stored baseline to track regressions.
+
+Example usage:
+    python benchmark.py --quick --output results.json
+    python benchmark.py --save-baseline
+    python benchmark.py --baseline benchmark_baseline.json --tolerance 0.2
+"""
+
+# Default file used for storing and comparing against baseline results.
+default_baseline_path = "benchmark_baseline.json"
+# Simulated time of the integrator convergence benchmark, kept short so the reference run stays cheap.
+convergence_time_max = 0.5
+# Factor by which the time step of the convergence reference run is smaller than the smallest benchmarked one.
+convergence_reference_refinement = 10
+
+
+def time_function(function: any, repeats: int):
+    """Times a function using the fastest of several repeats (the least noisy estimate).
+    Args:
+        function: Function taking no arguments to be timed.
+        repeats:  Number of times to call the function.
+    Returns:
+        Fastest wall time of a single call in seconds.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def get_parameters(config: Dict[str, any], section: str, **overrides):
+    """
+    Args:
+        config:    Loaded JSON configuration file.
+        section:   Name of the configuration section to take the parameters from.
+        overrides: Parameters to replace in the configuration section.
+    Returns:
+        Copy of the section parameters with absolute file paths and the overrides applied.
+    """
+    parameters = dict(config[section]["parameters"])
+    for key in ["velocity_field_path", "diffusivity_field_path", "reference_file_path"]:
+        if key in parameters:
+            parameters[key] = core.relative_to_absolute(__file__, parameters[key])
+    parameters.update(overrides)
+    return parameters
+
+
+def benchmark_simulation(config: Dict[str, any], sweep: str, particle_count: int, grid: int,
+                         use_velocity: bool, repeats: int):
+    """Times each phase of a simulation with the given size.
+    Args:
+        config:         Loaded JSON configuration file.
+        sweep:          Name of the quantity being scaled ("particles" or "grid").
+        particle_count: Number of particles in the simulation.
+        grid:           Number of concentration cells along each axis.
+        use_velocity:   Whether or not the velocity field is used.
+        repeats:        Number of repeats for each timed phase.
+    Returns:
+        List of result dictionaries.
+    """
+    parameters = get_parameters(config, "Animated Chemical Spill", particle_count=particle_count,
+                                cell_size=[grid, grid], use_velocity=use_velocity, animated=False)
+    sim = None
+    def create():
+        nonlocal sim
+        sim = simulation.Simulation(parameters)
+    phases = {
+        "Simulation.__init__": create,
+        "Simulation.update": lambda: sim.update(),
+        # Private methods are accessed through their name mangled form.
+        "Simulation.__enforce_boundary_conditions": lambda: sim._Simulation__enforce_boundary_conditions(sim.coordinates),
+        "Simulation.calculate_concentrations": lambda: sim.calculate_concentrations()
+    }
+    results = []
+    for name, function in phases.items():
+        # Construction is expensive for large counts, so it is only repeated once.
+        seconds = time_function(function, 1 if function is create else repeats)
+        results.append({"name": name, "sweep": sweep, "particles": particle_count, "grid": grid,
+                        "use_velocity": use_velocity, "seconds": seconds})
+    return results
+
+
+def benchmark_read_data_file(repeats: int):
+    """Times reading the velocity field data file."""
+    path = core.relative_to_absolute(__file__, "velocityCMM3.dat")
+    seconds = time_function(lambda: core.read_data_file(path, [0, 1], [2, 3]), repeats)
+    return [{"name": "core.read_data_file", "seconds": seconds}]
+
+
+def benchmark_startup(repeats: int):
+    """Times importing the user interface in a new Python process (a cold start), compared to
+    importing Tkinter alone, which is the minimum cost of starting the user interface.
+    """
+    results = []
+    for module in ["tkinter", "interface"]:
+        command = [sys.executable, "-c", "import " + module]
+        seconds = time_function(lambda: subprocess.run(command, check=True,
+                                                       cwd=os.path.dirname(os.path.abspath(__file__))), repeats)
+        results.append({"name": "startup", "module": module, "seconds": seconds})
+    return results
+
+
+def benchmark_rmse_sweep(config: Dict[str, any], particle_max: int):
+    """Times a full RMSE curve fitting sweep using the validation configuration.
+    Args:
+        config:       Loaded JSON configuration file.
+        particle_max: Largest particle count used in the sweep.
+    """
+    rmse = config["Validation Tasks"]["rmse"]
+    particles = np.logspace(np.log10(rmse["particle_min"]), np.log10(particle_max),
+                            rmse["particle_divisions"], dtype=int)
+    dts = np.linspace(rmse["dt_min"], rmse["dt_max"], rmse["dt_divisions"])
+    tasks = validation.Validation(get_parameters(config, "Validation Tasks"))
+    seconds = time_function(lambda: tasks.fit_rmse_curve(particles, dts), 1)
+    return [{"name": "Validation.fit_rmse_curve", "particles": particle_max,
+             "simulations": int(particles.size * dts.size), "seconds": seconds}]
+
+
+def benchmark_curve_fit(dt_count: int, particle_divisions: int, bootstraps: int):
+    """Times the RMSE curve fitting of a large sweep on its own, using synthetic RMSE values.
+    Args:
+        dt_count:           Number of time steps (rows of RMSE values) fitted at once.
+        particle_divisions: Number of particle counts of each row.
+        bootstraps:         Number of bootstrap resamples used for the β confidence intervals.
+    """
+    rng = np.random.default_rng(0)
+    particles = np.logspace(2, 6, particle_divisions, dtype=int)
+    rmse = 0.5 * particles ** -0.5 * np.exp(rng.normal(0, 0.1, (dt_count, particles.size)))
+    fit_seconds = time_function(lambda: validation.fit_power_laws(particles, rmse), 3)
+    bootstrap_seconds = time_function(lambda: validation.bootstrap_slopes(particles, rmse, bootstraps, rng), 1)
+    return [{"name": "validation.fit_power_laws", "rows": dt_count, "points": particle_divisions,
+             "seconds": fit_seconds},
+            {"name": "validation.bootstrap_slopes", "rows": dt_count, "points": particle_divisions,
+             "bootstraps": bootstraps, "seconds": bootstrap_seconds}]
+
+
+def benchmark_convergence(config: Dict[str, any], dts: List[float], particle_count: int):
+    """Finds the error of each integrator and time step against a reference run with a much smaller time step,
+    so the total number of steps (and time) needed to reach a target accuracy can be compared.
+    The chemical spill case is used without diffusion, since the integrators only differ in how they follow
+    the velocity field, and the noise would otherwise hide the time stepping error. Every run uses the same
+    seed, so particles start at the same positions and their final positions can be compared directly.
+    Args:
+        config:         Loaded JSON configuration file.
+        dts:            Time steps to run the simulation with.
+        particle_count: Number of particles in each simulation.
+    """
+    parameters = get_parameters(config, "Animated Chemical Spill", particle_count=particle_count, seed=0,
+                                diffusivity=0.0, time_max=convergence_time_max, animated=False)
+    reference_dt = min(dts) / convergence_reference_refinement
+    # Simulations take an extra step past time_max, so each time step ends at a slightly different time
+    # and the reference positions are recorded at the final time of every run.
+    final_steps = {dt: int(parameters["time_max"] / dt) + 1 for dt in dts}
+    reference_steps = {dt: int(round(steps * dt / reference_dt)) for dt, steps in final_steps.items()}
+    print("Running convergence reference [integrator=heun, dt=" + str(reference_dt) + "]")
+    reference = simulation.Simulation(dict(parameters, dt=reference_dt, integrator="heun"))
+    reference_coordinates = {}
+    for step in range(1, max(reference_steps.values()) + 1):
+        reference.update()
+        if step in reference_steps.values():
+            reference_coordinates[step] = np.copy(reference.coordinates)
+    results = []
+    for integrator in ["euler", "heun"]:
+        for dt in dts:
+            print("Benchmarking convergence [integrator=" + integrator + ", dt=" + str(dt) + "]")
+            sim = simulation.Simulation(dict(parameters, dt=dt, integrator=integrator))
+            seconds = time_function(sim.simulate, 1)
+            # Root mean square distance between the final particle positions and the reference positions.
+            difference = sim.coordinates - reference_coordinates[reference_steps[dt]]
+            rmse = np.sqrt(np.mean(np.sum(difference ** 2, axis=1)))
+            results.append({"name": "convergence", "integrator": integrator, "dt": dt, "steps": sim.steps,
+                            "particles": particle_count, "rmse": float(rmse), "seconds": seconds})
+    return results
+
+
+def get_key(result: Dict[str, any]):
+    """Identifies a result by every entry except its measurements (used for matching against the baseline)."""
+    return json.dumps({key: value for key, value in result.items() if key not in ["seconds", "rmse"]},
+                      sort_keys=True)
+
+
+def compare(results: List[Dict[str, any]], baseline: List[Dict[str, any]], tolerance: float):
+    """Prints the speed of each result relative to the baseline.
+    Args:
+        results:   Current benchmark results.
+        baseline:  Stored benchmark results to compare against.
+        tolerance: Fractional slowdown allowed before a result is counted as a regression.
+    Returns:
+        Number of regressions found.
+    """
+    baseline_times = {get_key(result): result["seconds"] for result in baseline}
+    regressions = 0
+    for result in results:
+        key = get_key(result)
+        if key not in baseline_times:
+            continue
+        ratio = result["seconds"] / baseline_times[key]
+        regressed = ratio > 1 + tolerance
+        regressions += regressed
+        print(("REGRESSION " if regressed else "") + key + ": " + str(round(ratio, 3)) + "x baseline")
+    return regressions
+
+
+def main(arguments: List[str]):
+    parser = argparse.ArgumentParser(description="Benchmarks the simulation hot paths.")
+    parser.add_argument("--particles", type=float, nargs="+", default=[1e3, 1e4, 1e5, 1e6, 1e7],
+                        help="Particle counts to benchmark (using the smallest grid size).")
+    parser.add_argument("--grids", type=int, nargs="+", default=[64, 128, 256, 512, 1024],
+                        help="Grid sizes to benchmark (using --grid-particles particles).")
+    parser.add_argument("--grid-particles", type=float, default=1e6,
+                        help="Particle count used when scaling the grid size.")
+    parser.add_argument("--rmse-particle-max", type=int, default=50000,
+                        help="Largest particle count used by the RMSE sweep benchmark.")
+    parser.add_argument("--convergence-dts", type=float, nargs="+", default=[0.05, 0.02, 0.01, 0.005, 0.002],
+                        help="Time steps used by the integrator convergence benchmark.")
+    parser.add_argument("--convergence-particles", type=int, default=10000,
+                        help="Particle count used by the integrator convergence benchmark.")
+    parser.add_argument("--fit-rows", type=int, default=1000,
+                        help="Number of time steps fitted at once by the curve fitting benchmark.")
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats for each timed phase.")
+    parser.add_argument("--quick", action="store_true",
+                        help="Limit particle counts to 1e5 and skip the RMSE sweep and convergence benchmarks.")
+    parser.add_argument("--output", default=None, help="JSON file to write the results to.")
+    parser.add_argument("--baseline", default=default_baseline_path,
+                        help="JSON file containing baseline results to compare against.")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store the results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Fractional slowdown allowed before reporting a regression.")
+    args = parser.parse_args(arguments)
+
+    with open(core.relative_to_absolute(__file__, "config.json")) as json_file:
+        config = json.load(json_file)
+
+    particle_counts = [int(count) for count in args.particles if not args.quick or count <= 1e5]
+    grid_particles = int(min(args.grid_particles, 1e5) if args.quick else args.grid_particles)
+
+    results = benchmark_read_data_file(args.repeats)
+    results += benchmark_startup(args.repeats)
+    results += benchmark_curve_fit(args.fit_rows, 12, 100)
+    for use_velocity in [False, True]:
+        for particle_count in particle_counts:
+            print("Benchmarking [particles=" + str(particle_count) + ", grid=" + str(min(args.grids)) +
+                  ", use_velocity=" + str(use_velocity) + "]")
+            results += benchmark_simulation(config, "particles", particle_count, min(args.grids),
+                                            use_velocity, args.repeats)
+    for grid in args.grids:
+        print("Benchmarking [particles=" + str(grid_particles) + ", grid=" + str(grid) + "]")
+        results += benchmark_simulation(config, "grid", grid_particles, grid, False, args.repeats)
+    if not args.quick:
+        results += benchmark_rmse_sweep(config, args.rmse_particle_max)
+        results += benchmark_convergence(config, args.convergence_dts, args.convergence_particles)
+
+    output = {
+        "metadata": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump(output, json_file, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+    regressions = 0
+    if args.save_baseline:
+        with open(args.baseline, "w") as json_file:
+            json.dump(output, json_file, indent=4)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as json_file:
+            regressions = compare(results, json.load(json_file)["results"], args.tolerance)
+
+    # Correctness check of heterogeneous diffusion, which speed ups of the particle kernels must not break.
+    for kernel in ["numpy", "numba"]:
+        deviation, passed = validation.check_well_mixed(kernel=kernel)
+        regressions += not passed
+        print(("" if passed else "REGRESSION ") + "well mixed check [kernel=" + kernel + "]: " +
+              "density deviation " + str(round(deviation, 3)))
+    return 1 if regressions > 0 else 0
+
+
+"""Entry point to the benchmarks"""
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
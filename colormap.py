@@ -0,0 +1,119 @@
+from typing import List
+import numpy.typing as npt
+import numpy as np
+import sparse
+
+"""
+This file implements fast rendering of concentration grids to images using a color lookup table.
+The colors of the JSON configuration file's color map are evaluated once for a fixed number of evenly
+spaced concentrations, after which every frame is converted to an RGB image by quantizing the
+concentrations and taking the corresponding rows of the table. This avoids matplotlib's per frame
+overhead (artists, normalization and canvas redraws), so large grids can be displayed at interactive rates.
+"""
+
+# Table sizes which are supported. 256 entries gives the same color resolution as matplotlib,
+# 4096 entries keeps gradients smooth when images are scaled up or post processed.
+table_sizes = [256, 4096]
+
+
+"""
+The ColorLookupTable class converts scalar grids to 8 bit RGB images. Its buffers are reused between
+calls, so converting a frame does not allocate memory unless the grid shape changes.
+"""
+class ColorLookupTable(object):
+    def __init__(self, color_list: List[any], size: int = 256, minimum: float = 0.0, maximum: float = 1.0):
+        """
+        Args:
+            color_list: List of [value, color] pairs (e.g. the color_map entries of the JSON configuration file).
+            size:       Number of entries in the table (see table_sizes). Defaults to 256.
+            minimum:    Value mapped to the first color of the table. Defaults to 0.
+            maximum:    Value mapped to the last color of the table. Defaults to 1.
+        """
+        assert size in table_sizes, "Color lookup table size must be one of " + str(table_sizes)
+        assert maximum > minimum, "Color lookup table maximum must be greater than its minimum"
+        # Matplotlib is only used once to evaluate the colormap, so the images match the heatmap plots.
+        import plotting
+        cmap = plotting.create_colormap(color_list, size)
+        rgb = cmap(np.arange(size))[:, :3]
+        self.table = np.rint(rgb * 255).astype(np.uint8)
+        self.size = size
+        self.minimum = minimum
+        # Factor which converts a value to a (fractional) table index.
+        self.scale = size / (maximum - minimum)
+        self.__indexes = None
+        self.__image = None
+        self.__dense = None
+
+
+    def map(self, values: any):
+        """
+        Args:
+            values: Scalar grid (dense or sparse) to convert. Values outside the table bounds are clamped.
+                    shape=(Ny, Nx)
+        Returns:
+            RGB image of the values, with rows in the same order as the grid (as in matplotlib's imshow).
+            The returned array is reused by the next call. shape=(Ny, Nx, 3), dtype=uint8
+        """
+        if self.__indexes is None or self.__indexes.shape != values.shape:
+            self.__indexes = np.empty(values.shape)
+            self.__image = np.empty(values.shape + (3,), dtype=np.uint8)
+        if isinstance(values, sparse.SparseGrid):
+            if self.__dense is None or self.__dense.shape != values.shape:
+                self.__dense = np.empty(values.shape)
+            values = values.to_dense(self.__dense)
+        indexes = self.__indexes
+        # Quantize in place: index = clip(floor((value - minimum) * scale), 0, size - 1),
+        # which is the same binning as matplotlib's colormaps.
+        np.subtract(values, self.minimum, out=indexes)
+        np.multiply(indexes, self.scale, out=indexes)
+        np.floor(indexes, out=indexes)
+        np.clip(indexes, 0, self.size - 1, out=indexes)
+        np.take(self.table, indexes.astype(np.intp, copy=False), axis=0, out=self.__image)
+        return self.__image
+
+
+    def __zoom(self, image: npt.NDArray, zoom: int):
+        """Enlarges each pixel of an image to a zoom by zoom block."""
+        if zoom > 1:
+            return np.repeat(np.repeat(image, zoom, axis=0), zoom, axis=1)
+        return image
+
+
+    def to_ppm(self, values: npt.NDArray, zoom: int = 1):
+        """
+        Args:
+            values: Scalar grid to convert.
+            zoom:   Integer factor by which each cell is enlarged. Defaults to 1.
+        Returns:
+            Binary PPM image of the values, which can be passed directly to a Tkinter PhotoImage.
+        """
+        image = self.__zoom(self.map(values), zoom)
+        header = "P6 {} {} 255\n".format(image.shape[1], image.shape[0]).encode("ascii")
+        return header + image.tobytes()
+
+
+    def update_photo_image(self, photo_image: any, values: npt.NDArray, zoom: int = 1):
+        """Replaces the contents of a Tkinter PhotoImage (and every widget displaying it) with the values.
+        Args:
+            photo_image: Tkinter PhotoImage to update.
+            values:      Scalar grid to display.
+            zoom:        Integer factor by which each cell is enlarged. Defaults to 1.
+        """
+        photo_image.configure(data=self.to_ppm(values, zoom), format="PPM")
+
+
+    def save(self, values: npt.NDArray, path: str, zoom: int = 1):
+        """Saves the values as an image file. The format is determined by the file extension:
+           .ppm files are written directly, other formats (e.g. .png) require Pillow.
+        Args:
+            values: Scalar grid to save.
+            path:   Path of the image file to create.
+            zoom:   Integer factor by which each cell is enlarged. Defaults to 1.
+        """
+        if path.lower().endswith(".ppm"):
+            with open(path, "wb") as image_file:
+                image_file.write(self.to_ppm(values, zoom))
+            return
+        from PIL import Image
+        image = self.__zoom(self.map(values), zoom)
+        Image.fromarray(image).save(path)
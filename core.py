@@ -0,0 +1,61 @@
+import numpy as np
+import os
+
+"""
+This file contains the display-free helper functions (file input and output and data checks) used by
+the simulation and validation. It only depends on NumPy, so the simulation can be imported in headless
+worker processes without Tkinter, PIL or matplotlib being installed or a display being available.
+"""
+
+
+def read_data_file(file: any, *columns):
+    """Function for reading and checking column data from a data file.
+    Args:
+        columns: List of column indexes to read into the returned list.
+    Returns:
+        A list of data in the specified columns, or a list of None if columns are not found. 
+    """
+    data = []
+    for column in columns:
+        try:
+            # Read the given columns out of the file and append them to a list.
+            data.append(np.genfromtxt(file, usecols=tuple(column), invalid_raise=True))
+        except:
+            print("Could not retrieve " + str(column) + " columns from file " + str(os.path.basename(file)))
+            return [None for column in columns]
+    return data
+
+
+def relative_to_absolute(directory: any, path: str):
+    """Converts relative file paths to absolute.
+    Args:
+        directory: Directory of the file.
+        path:      Name of the file.
+    Returns:
+        A relative file path converted to an absolute file object.
+    """
+    return os.path.join(os.path.dirname(directory), path)
+
+
+def contains_value(dictionary_or_list: any, element: any):
+    """Recrusively checks if an iterable object contains an element.
+    Args:
+        dictionary_or_list: Dictionary or List object to check through.
+        element:            Any variable to check for.
+    Returns:
+        True if the dictionary or list contains the given element, false otherwise.
+    """
+    # This is a fairly self-explanatory recursive search algorithm.
+    if isinstance(dictionary_or_list, list):
+        if element in dictionary_or_list: return True
+        for v in dictionary_or_list:
+            if isinstance(v, list) or isinstance(v, dict):
+                if contains_value(v, element): return True
+    # The reason it is repeated twice is because lists
+    # and dictionaries differ in how they are iterated.
+    elif isinstance(dictionary_or_list, dict):
+        if element in dictionary_or_list.values(): return True
+        for _, v in dictionary_or_list.items():
+            if isinstance(v, list) or isinstance(v, dict):
+                if contains_value(v, element): return True
+    return False
@@ -0,0 +1,300 @@
+from typing import Dict
+import scipy.sparse.linalg
+import scipy.sparse
+import numpy.typing as npt
+import numpy as np
+import simulation
+import profiling
+import progress
+import exposure
+import lattice
+import core
+import shapes
+
+"""
+This file implements a grid based (Eulerian) alternative to the particle simulation. Instead of
+tracking particles, the density of each species is stored on the concentration grid and moved using
+a finite volume discretization of the advection-diffusion equation. The result has no statistical
+noise, which makes it much cheaper than the particle method for high resolution concentration fields.
+
+Each time step is split into an explicit first order upwind advection step (automatically divided
+into substeps if the time step is too large for it to be stable) and an implicit (backward Euler)
+diffusion step. The implicit diffusion matrix is factorized once, so each step costs a sparse solve.
+
+The X and Y variables alias indexes. This improves code readability when accessing
+multi-dimensional arrays.
+"""
+X = 0
+Y = 1
+
+# Number of samples per axis used to find the initial species fractions of each cell.
+initial_samples = 8
+# Largest number of samples per axis, which limits the cost of setting up very large grids
+# (which still get at least one sample per cell).
+max_initial_samples = 4096
+# Number of samples labelled at once, which limits the memory used to find the initial fractions.
+initial_chunk_size = 2 ** 20
+
+
+def get_nodes(minimum: float, maximum: float, count: int):
+    """
+    Finds the nodes of one axis of the grid. Node i stands for the region which the particle simulation
+    maps to concentration cell i, i.e. positions within half a node spacing of it (clipped to the domain).
+    Args:
+        minimum: Lower bound of the axis.
+        maximum: Upper bound of the axis.
+        count:   Number of concentration cells along the axis.
+    Returns:
+        Node positions, the width of the region of each node and the spacing between nodes.
+    """
+    if count == 1:
+        return np.array([(minimum + maximum) / 2]), np.array([maximum - minimum]), maximum - minimum
+    spacing = (maximum - minimum) / (count - 1)
+    widths = np.full(count, spacing)
+    widths[[0, -1]] = spacing / 2
+    return np.linspace(minimum, maximum, count), widths, spacing
+
+
+"""
+The EulerianSimulation class has the same interface as the Simulation class (concentrations,
+species_concentrations, steps, update(), simulate(), calculate_concentrations()) and accepts
+the same parameters. Parameters which only apply to particles (e.g. particle_count, kernel,
+threads, optimized) are ignored.
+Methods with double underscores at the front are private (only used internally by the class).
+"""
+class EulerianSimulation(object):
+    def __init__(self, parameters: Dict[str, any]):
+        """
+        Args:
+            parameters: Simulation parameters (see simulation.Simulation).
+        """
+        self.__dict__.update(simulation.optional_parameters)
+        self.__dict__.update(parameters)
+        self.__validate_parameters()
+
+        self.min = np.array(self.min)
+        self.max = np.array(self.max)
+        self.cell_size = np.array(self.cell_size)
+        self.profiler = profiling.Profiler(self.profile_memory) if self.profile else profiling.null_profiler
+        self.stats = self.profiler.stats
+        # Same number of steps as the particle simulation (including the extra step for t = 0).
+        self.steps = int(self.time_max / self.dt) + 1
+
+        self.x_nodes, x_widths, self.x_spacing = get_nodes(self.min[X], self.max[X], self.cell_size[X])
+        self.y_nodes, y_widths, self.y_spacing = get_nodes(self.min[Y], self.max[Y], self.cell_size[Y])
+        # Areas of each node region and lengths of the faces between neighboring regions.
+        self.volumes = np.outer(x_widths, y_widths)
+        self.x_face_lengths = np.broadcast_to(y_widths, (self.cell_size[X] - 1, self.cell_size[Y]))
+        self.y_face_lengths = np.broadcast_to(x_widths[:, np.newaxis], (self.cell_size[X], self.cell_size[Y] - 1))
+
+        # Density of each species, shape=(species_count, Nx, Ny). The particle simulation starts with a
+        # uniform total density, so the initial density of each species is its fraction of every cell.
+        self.densities = self.__get_initial_fractions()
+
+        if self.use_velocity:
+            self.__create_advection()
+        self.__create_diffusion()
+        self.calculate_concentrations()
+
+
+    def __validate_parameters(self):
+        """Check that no parameter passed to the simulation is outside its expected envelope."""
+        assert self.time_max > 0,         "Max time must be greater than 0"
+        assert self.dt > 0,               "Time step must be greater than 0"
+        assert self.dt <= self.time_max,  "Time step cannot exceed maximum time"
+        assert self.max[X] > self.min[X], "X_max must be greater than X_min"
+        assert self.max[Y] > self.min[Y], "Y_max must be greater than Y_min"
+        assert self.cell_size[X] > 0,     "Cell width must be greater than 0"
+        assert self.cell_size[Y] > 0,     "Cell height must be greater than 0"
+        assert np.all(np.array(self.diffusivity) >= 0), "Diffusivity must be greater than or equal to 0"
+        assert np.ndim(self.diffusivity) == 0 or len(self.diffusivity) == self.species_count, \
+            "Diffusivity must be a single value or have one value per species"
+        assert self.species_count >= 2,   "Species count must be at least 2"
+
+
+    def __get_initial_fractions(self):
+        """
+        Returns:
+            Fraction of each cell covered by each species, found by labelling a regular
+            grid of sample points with the initial condition shapes.
+        """
+        shape_list = [shapes.create_shape(info) for info in simulation.get_shape_list(self.__dict__)]
+        cell_count = int(np.prod(self.cell_size))
+        if len(shape_list) == 0:
+            # Without shapes every cell is entirely background (species 0).
+            fractions = np.zeros((cell_count, self.species_count))
+            fractions[:, 0] = 1
+            return np.reshape(fractions.T, (self.species_count, *self.cell_size))
+        shape_grid = shapes.ShapeGrid(shape_list, self.min, self.max, self.shape_resolution)
+        # Sample points at the centers of a fine grid which is at least as fine as the shape grid.
+        samples = np.maximum(np.minimum(np.maximum(self.cell_size * initial_samples, self.shape_resolution),
+                                        max_initial_samples), self.cell_size)
+        x_samples, y_samples = [self.min[axis] + (np.arange(samples[axis]) + 0.5) *
+                                (self.max[axis] - self.min[axis]) / samples[axis] for axis in [X, Y]]
+        counts = np.zeros(cell_count * self.species_count, dtype=np.int64)
+        # Rows of samples are labelled in chunks, so the memory used does not grow with the grid size.
+        rows = max(1, initial_chunk_size // samples[Y])
+        for start in range(0, samples[X], rows):
+            x, y = np.meshgrid(x_samples[start:start + rows], y_samples, indexing="ij")
+            points = np.column_stack((x.ravel(), y.ravel()))
+            values = shape_grid.label(points)
+            assert np.all((values >= 0) & (values < self.species_count)), \
+                "Shape values must be species ids between 0 and species_count - 1"
+            # Samples are assigned to cells using the same mapping as the particle simulation.
+            cells = np.rint((points - self.min) / (self.max - self.min) * (self.cell_size - 1)).astype(int)
+            indexes = cells[:, X] * self.cell_size[Y] + cells[:, Y]
+            counts += np.bincount(indexes * self.species_count + values, minlength=counts.size)
+        counts = counts.reshape(cell_count, self.species_count)
+        fractions = counts / np.sum(counts, axis=1, keepdims=True)
+        return np.reshape(fractions.T, (self.species_count, *self.cell_size))
+
+
+    def __get_velocities(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to find the velocities of.
+        Returns:
+            Velocity vector of the nearest velocity field node to each point.
+        """
+        coordinates, vectors = core.read_data_file(self.velocity_field_path, [0, 1], [2, 3])
+        assert not isinstance(coordinates, type(None)), "Could not retrieve velocity coordinates from data file"
+        assert not isinstance(vectors, type(None)), "Could not retrieve velocity vectors from data file"
+        vectors = self.velocity_scale * vectors
+        try:
+            return lattice.Lattice(coordinates, vectors).lookup(points)
+        except ValueError:
+            from scipy.spatial import cKDTree
+            _, indexes = cKDTree(coordinates).query(points, workers=-1)
+            return vectors[indexes]
+
+
+    def __create_advection(self):
+        """
+        Finds the velocity normal to each face between neighboring cells. The velocity field is constant
+        in time, so the upwind direction of each face and the advection substep count are only found once.
+        """
+        x_faces = np.meshgrid((self.x_nodes[:-1] + self.x_nodes[1:]) / 2, self.y_nodes, indexing="ij")
+        y_faces = np.meshgrid(self.x_nodes, (self.y_nodes[:-1] + self.y_nodes[1:]) / 2, indexing="ij")
+        # The velocities of both sets of faces are found in a single lookup.
+        points = np.concatenate([np.column_stack((x.ravel(), y.ravel())) for x, y in [x_faces, y_faces]])
+        velocities = self.__get_velocities(points)
+        self.x_face_velocities = np.reshape(velocities[:x_faces[X].size, X], x_faces[X].shape)
+        self.y_face_velocities = np.reshape(velocities[x_faces[X].size:, Y], y_faces[X].shape)
+
+        """
+        The upwind scheme is stable (and keeps densities positive) if no cell loses more than its
+        contents in one step. The outflow rate of each cell is the sum of the flows out of its faces.
+        """
+        x_flows = self.x_face_velocities * self.x_face_lengths
+        y_flows = self.y_face_velocities * self.y_face_lengths
+        outflow = np.zeros(self.volumes.shape)
+        outflow[:-1, :] += np.maximum(x_flows, 0)
+        outflow[1:, :] -= np.minimum(x_flows, 0)
+        outflow[:, :-1] += np.maximum(y_flows, 0)
+        outflow[:, 1:] -= np.minimum(y_flows, 0)
+        self.advection_substeps = max(int(np.ceil(self.dt * np.max(outflow / self.volumes))), 1)
+
+
+    def __get_diffusion_matrix(self, diffusivities: npt.NDArray):
+        """
+        Args:
+            diffusivities: Diffusivity at each node. shape=(Nx, Ny)
+        Returns:
+            Sparse matrix L such that L @ density gives the net diffusive flow into each cell,
+            with no flow through the domain boundaries.
+        """
+        indexes = np.arange(self.volumes.size).reshape(self.volumes.shape)
+        rows, columns, conductances = [], [], []
+        # The diffusivity of each face is the average of the diffusivities on either side of it.
+        if self.cell_size[X] > 1:
+            faces = (diffusivities[:-1, :] + diffusivities[1:, :]) / 2 * self.x_face_lengths / self.x_spacing
+            rows.append(indexes[:-1, :].ravel())
+            columns.append(indexes[1:, :].ravel())
+            conductances.append(faces.ravel())
+        if self.cell_size[Y] > 1:
+            faces = (diffusivities[:, :-1] + diffusivities[:, 1:]) / 2 * self.y_face_lengths / self.y_spacing
+            rows.append(indexes[:, :-1].ravel())
+            columns.append(indexes[:, 1:].ravel())
+            conductances.append(faces.ravel())
+        rows, columns = np.concatenate(rows + [[]]).astype(int), np.concatenate(columns + [[]]).astype(int)
+        conductances = np.concatenate(conductances + [[]])
+        off_diagonal = scipy.sparse.coo_matrix((conductances, (rows, columns)),
+                                               shape=(self.volumes.size, self.volumes.size))
+        off_diagonal = off_diagonal + off_diagonal.T
+        return off_diagonal - scipy.sparse.diags(np.asarray(off_diagonal.sum(axis=1)).ravel())
+
+
+    def __create_diffusion(self):
+        """
+        Factorizes the backward Euler diffusion matrix (V - dt * L) of each species, where V holds the cell
+        areas. Species which share a diffusivity share a factorization, and species with no diffusivity
+        are skipped during updates.
+        """
+        if self.diffusivity_field_path is not None:
+            coordinates, diffusivities = core.read_data_file(self.diffusivity_field_path, [0, 1], [2])
+            assert not isinstance(diffusivities, type(None)), "Could not retrieve diffusivities from data file"
+            x, y = np.meshgrid(self.x_nodes, self.y_nodes, indexing="ij")
+            field = lattice.Lattice(coordinates, diffusivities).lookup(np.column_stack((x.ravel(), y.ravel())))
+            node_diffusivities = [np.reshape(field, self.volumes.shape)] * self.species_count
+            keys = [None] * self.species_count
+        else:
+            keys = list(np.broadcast_to(np.array(self.diffusivity, dtype=float), self.species_count))
+            node_diffusivities = [np.full(self.volumes.shape, key) for key in keys]
+        solvers = {}
+        self.diffusion_solvers = []
+        for key, diffusivities in zip(keys, node_diffusivities):
+            if key not in solvers:
+                solvers[key] = None
+                if np.any(diffusivities > 0):
+                    matrix = scipy.sparse.diags(self.volumes.ravel()) - \
+                             self.dt * self.__get_diffusion_matrix(diffusivities)
+                    solvers[key] = scipy.sparse.linalg.factorized(matrix.tocsc())
+            self.diffusion_solvers.append(solvers[key])
+
+
+    def __advect(self, densities: npt.NDArray, dt: float):
+        """Moves the densities of every species one upwind advection step forward in time (in place)."""
+        x_flux = np.where(self.x_face_velocities > 0, densities[:, :-1, :], densities[:, 1:, :]) * \
+                 self.x_face_velocities * self.x_face_lengths
+        y_flux = np.where(self.y_face_velocities > 0, densities[:, :, :-1], densities[:, :, 1:]) * \
+                 self.y_face_velocities * self.y_face_lengths
+        change = np.zeros(densities.shape)
+        change[:, :-1, :] -= x_flux
+        change[:, 1:, :] += x_flux
+        change[:, :, :-1] -= y_flux
+        change[:, :, 1:] += y_flux
+        densities += change * (dt / self.volumes)
+
+
+    def update(self):
+        """Moves the simulation one step forward in time."""
+        if self.use_velocity:
+            with self.profiler.phase("advection", self.volumes.size):
+                for _ in range(self.advection_substeps):
+                    self.__advect(self.densities, self.dt / self.advection_substeps)
+        with self.profiler.phase("diffusion", self.volumes.size):
+            for species, solver in enumerate(self.diffusion_solvers):
+                if solver is not None:
+                    self.densities[species] = np.reshape(solver((self.densities[species] * self.volumes).ravel()),
+                                                         self.volumes.shape)
+
+
+    def simulate(self, print_time: bool = False, progress_reporter: progress.ProgressReporter = None,
+                 exposure_tracker: exposure.ExposureTracker = None):
+        """Runs the simulation until completion (see simulation.Simulation.simulate)."""
+        simulation.run_steps(self, print_time, progress_reporter, exposure_tracker)
+
+
+    def calculate_concentrations(self):
+        """
+        Updates the 'concentrations' member with the fraction of each cell occupied by species 1,
+        matching the concentrations of the particle simulation. As there, 'species_concentrations' holds the
+        fractions of every species if there are more than 2 species and is None otherwise.
+        """
+        total = np.sum(self.densities, axis=0)
+        fractions = np.divide(self.densities, total, out=np.zeros(self.densities.shape), where=total > 0)
+        fractions = np.minimum(fractions, 1.0)
+        self.species_concentrations = None
+        if self.species_count > 2:
+            self.species_concentrations = np.rot90(fractions, axes=(1, 2))
+        self.concentrations = np.rot90(fractions[1])
@@ -0,0 +1,98 @@
+import numpy.typing as npt
+import numpy as np
+import sparse
+
+"""
+This file implements tracking of the exposure of each concentration cell over the course of a simulation,
+which is used for producing hazard maps: where the concentration has ever exceeded a threshold, when it
+first did so, and the time integrated concentration (cumulative exposure) of each cell.
+"""
+
+"""
+The ExposureTracker class is updated with the concentrations of a simulation at each point in time.
+All of its arrays are allocated once and updated in place, so tracking costs a few passes over the
+concentration grid per update regardless of how long the simulation runs for. Sparse concentration
+grids (see sparse.SparseGrid) are tracked using only their stored cells.
+"""
+class ExposureTracker(object):
+    def __init__(self, shape: any, threshold: float, track_first_exceedance: bool = True,
+                 track_exposure: bool = True):
+        """
+        Args:
+            shape:                  Shape of the concentration grid.
+            threshold:              Concentration above which a cell counts as exceeded.
+            track_first_exceedance: Whether or not the time at which each cell first exceeded
+                                    the threshold is tracked. Defaults to True.
+            track_exposure:         Whether or not the cumulative exposure of each cell is tracked.
+                                    Defaults to True.
+        """
+        self.threshold = threshold
+        # Whether each cell has ever exceeded the threshold.
+        self.exceeded = np.zeros(shape, dtype=bool)
+        # Time at which each cell first exceeded the threshold (infinity if it never has).
+        self.first_exceedance = np.full(shape, np.inf) if track_first_exceedance else None
+        # Concentration of each cell integrated over time.
+        self.exposure = np.zeros(shape) if track_exposure else None
+        self.time = None
+        # Buffers reused between updates.
+        self.__above = np.zeros(shape, dtype=bool)
+        self.__highlighted = np.zeros(shape)
+
+
+    def update(self, concentrations: npt.NDArray, time: float):
+        """
+        Args:
+            concentrations: Concentration grid (dense or sparse) at the given time.
+            time:           Simulation time of the concentrations. The exposure is integrated
+                            using the concentrations over the time since the previous update.
+        """
+        if isinstance(concentrations, sparse.SparseGrid):
+            self.__update_sparse(concentrations, time)
+            return
+        np.greater(concentrations, self.threshold, out=self.__above)
+        if self.first_exceedance is not None:
+            # Cells exceeding the threshold for the first time are those not already marked as exceeded.
+            np.copyto(self.first_exceedance, time, where=self.__above & ~self.exceeded)
+        self.exceeded |= self.__above
+        if self.exposure is not None and self.time is not None:
+            self.exposure += (time - self.time) * concentrations
+        self.time = time
+
+
+    def __update_sparse(self, concentrations: sparse.SparseGrid, time: float):
+        """Version of update for sparse grids. Cells which are not stored have a concentration of 0, so
+           only the stored cells can exceed the threshold (which is positive) or add to the exposure."""
+        above = concentrations.indexes[concentrations.values > self.threshold]
+        if self.first_exceedance is not None:
+            first = above[~self.exceeded.flat[above]]
+            self.first_exceedance.flat[first] = time
+        self.exceeded.flat[above] = True
+        if self.exposure is not None and self.time is not None:
+            self.exposure.flat[concentrations.indexes] += (time - self.time) * concentrations.values
+        self.time = time
+
+
+    def highlight(self, concentrations: any):
+        """
+        Args:
+            concentrations: Concentration grid (dense or sparse) to highlight.
+        Returns:
+            The concentrations with every cell which has ever exceeded the threshold set to 1.
+            The returned array is reused by the next call.
+        """
+        if isinstance(concentrations, sparse.SparseGrid):
+            concentrations.to_dense(self.__highlighted)
+        else:
+            np.copyto(self.__highlighted, concentrations)
+        np.copyto(self.__highlighted, 1.0, where=self.exceeded)
+        return self.__highlighted
+
+
+    def save(self, path: str):
+        """Saves the tracked hazard maps to a NumPy .npz file."""
+        maps = {"exceeded": self.exceeded}
+        if self.first_exceedance is not None:
+            maps["first_exceedance"] = self.first_exceedance
+        if self.exposure is not None:
+            maps["exposure"] = self.exposure
+        np.savez(path, **maps)
@@ -1,25 +1,32 @@
 from sys import platform as system_platform
 from typing import Dict
 from tkinter.filedialog import askopenfile
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib import animation
 import tkinter as tk
 import numpy as np
+import threading
 import sys
+import os
 import json
-import simulation
-import validation
+import progress
+import exposure
+import sparse
 import utility
+import plotting
+import core
 
 """
 This file implements all the user interface related functionality 
 and acts as an entry point to the application.
+
+Modules which take a long time to import (matplotlib, scipy and the simulation and validation
+modules which use them) are imported when they are first needed rather than at startup, so the
+main menu appears quickly. Python caches imported modules, so this only costs time once.
 """
 
-# Tkinter embedded plot fix for macOS.
+# Tkinter embedded plot fix for macOS (setting the backend through
+# the environment avoids importing matplotlib before it is needed).
 if system_platform == 'darwin':
-    import matplotlib
-    matplotlib.use("TkAgg")
+    os.environ.setdefault("MPLBACKEND", "TkAgg")
 
 # Check for correct python version.
 if sys.version_info[0:2] < (3, 7):
@@ -31,6 +38,9 @@ readability when accessing multi-dimensional arrays.
 """
 X = 0
 Y = 1
+# Approximate size in pixels of the image shown when direct rendering is used.
+direct_image_size = 500
+
 # Used for naming plot axes based on the above dimension alias.
 dimension_labels = {
     0: "X",
@@ -63,7 +73,7 @@ class UserInterface(object):
     def create_header(self):
         """Creates the GUI logo."""
         utility.create_image(self.frame, 
-                             utility.relative_to_absolute(__file__, "logo.png"), 0, 1)
+                             core.relative_to_absolute(__file__, "logo.png"), 0, 1)
         # Create the GUI instruction text.
         # (modified by main menu buttons when they are pressed).
         self.label_text = "Please choose a mode of operation."
@@ -90,6 +100,7 @@ class UserInterface(object):
             row_heights: Relative row heights of the ui container. Defaults to [80, 4, 4].
                          which is s based on having a reset plot and back button below the plot.
         """
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
         canvas = FigureCanvasTkAgg(figure, master=self.container)
         canvas.get_tk_widget().grid(row=0, column=0)
         utility.set_grid_sizes(self.container, row_heights, [100])
@@ -236,7 +247,7 @@ class VelocityInputField(ToggleInputField):
         self.path_label = utility.create_label(
             file_container, "File: " + self.defaults[1], 1, 0)
         self.entries.append(
-            utility.relative_to_absolute(__file__, self.defaults[1]))
+            core.relative_to_absolute(__file__, self.defaults[1]))
         utility.set_grid_sizes(file_container, [50, 50], [100])
 
 
@@ -352,21 +363,19 @@ class ChemicalSpill(MainMenuButton):
         super().press()
         parameters = self.data["parameters"]
         # Ensure that velocity path is absolute.
-        parameters["velocity_field_path"] = utility.relative_to_absolute(
+        parameters["velocity_field_path"] = core.relative_to_absolute(
             __file__, parameters["velocity_field_path"])
+        if parameters.get("diffusivity_field_path") is not None:
+            parameters["diffusivity_field_path"] = core.relative_to_absolute(
+                __file__, parameters["diffusivity_field_path"])
 
         self.highlight_threshold = self.data["highlight_threshold"]
 
-        self.sim = simulation.Simulation(parameters)
+        import backends
+        self.sim = backends.create_simulation(parameters)
 
-        figure, self.axes, self.heatmap = utility.create_heatmap(self.sim.concentrations, 
-                                                                 self.data["color_map"], 
-                                                                 self.sim.animated, 
-                                                                 self.sim.min, self.sim.max, 
-                                                                 "x", "y")
-
-        # Create an array to store all the highlighted concentrations.
-        self.highlighted = np.copy(self.sim.concentrations)
+        # Tracks the cells where the concentration has ever exceeded the highlight threshold.
+        self.exposure = exposure.ExposureTracker(self.sim.concentrations.shape, self.highlight_threshold)
 
         # Update the top label with relevant information.
         self.ui.label["text"] = self.name + " (animating until t=" + \
@@ -383,13 +392,61 @@ class ChemicalSpill(MainMenuButton):
                               self.ui.create_menu_buttons, pady=(5, 0),
                               ipady=15, fg="black", bg="pink")
 
+        if self.data.get("direct_rendering", False):
+            self.show_image()
+            return
+
+        # Sparse concentrations are converted since matplotlib can only plot dense grids.
+        figure, self.axes, self.heatmap = plotting.create_heatmap(sparse.to_dense(self.sim.concentrations),
+                                                                 self.data["color_map"], 
+                                                                 self.sim.animated, 
+                                                                 self.sim.min, self.sim.max, 
+                                                                 "x", "y")
         self.canvas = self.ui.embed_plot(figure)
         # Enables the plot to be animated
+        from matplotlib import animation
         self.anim = animation.FuncAnimation(figure, func=self.animate_plot,
                                             frames=self.sim.steps, interval=1,
                                             repeat=False, blit=False)
 
 
+    def show_image(self):
+        """Displays the concentrations as an image whose pixels are mapped straight to colors
+           (see colormap.ColorLookupTable) instead of an animated matplotlib heatmap. This skips
+           matplotlib's per frame overhead, so large concentration grids animate much faster."""
+        import colormap
+        self.lookup_table = colormap.ColorLookupTable(self.data["color_map"])
+        # Enlarge small grids so the image is roughly the size of the heatmap plots.
+        self.zoom = max(1, direct_image_size // max(self.sim.concentrations.shape))
+        self.photo_image = tk.PhotoImage(master=self.ui.container)
+        self.image = tk.Label(self.ui.container, bg=utility.background_color,
+                              image=self.photo_image, compound="top")
+        self.image.grid(row=0, column=0)
+        utility.set_grid_sizes(self.ui.container, [80, 4, 4], [100])
+        self.animate_image(0)
+
+
+    def animate_image(self, step: int):
+        """Called once per step of the simulation when direct rendering is used.
+        Args:
+            step: Current step of the simulation.
+        """
+        # Stop animating once the image has been removed (e.g. by the back or reset buttons).
+        if not self.image.winfo_exists():
+            return
+        self.image["text"] = "Time: " + str(round(step * self.sim.dt, 2)) + "s"
+        self.sim.calculate_concentrations()
+        self.exposure.update(self.sim.concentrations, step * self.sim.dt)
+        self.lookup_table.update_photo_image(self.photo_image,
+                                             self.exposure.highlight(self.sim.concentrations),
+                                             self.zoom)
+        # Enables plotting t = 0.
+        if step > 0:
+            self.sim.update()
+        if step + 1 < self.sim.steps:
+            self.ui.root.after(1, self.animate_image, step + 1)
+
+
     def animate_plot(self, step: int):
         """Animation function called once per step of the simulation.
         Args:
@@ -398,14 +455,9 @@ class ChemicalSpill(MainMenuButton):
         self.axes.set_title("Time: " + str(round(step * self.sim.dt, 2)) + "s")
         # Recalculate concentrations every simulation step.
         self.sim.calculate_concentrations()
-        # Check if a concentration is above the highlighted 
-        # threshold in either array.
-        above_threshold = np.logical_or(self.sim.concentrations > self.highlight_threshold,
-                                        self.highlighted > self.highlight_threshold)
-        # Update the highlighted array with the points 
-        # where the threshold is exceeded (masking).
-        self.highlighted = np.where(above_threshold, 1.0, self.sim.concentrations)
-        self.heatmap.set_array(self.highlighted)
+        # Permanently highlight the cells where the threshold has been exceeded.
+        self.exposure.update(self.sim.concentrations, step * self.sim.dt)
+        self.heatmap.set_array(self.exposure.highlight(self.sim.concentrations))
         # Enables plotting t = 0.
         if step > 0:
             self.sim.update()
@@ -417,11 +469,17 @@ class ValidationTasks(MainMenuButton):
     def press(self):
         super().press()
         parameters = self.data["parameters"]
-        # Ensure that reference data file path is absolute.
-        parameters["reference_file_path"] = utility.relative_to_absolute(
-            __file__, parameters["reference_file_path"])
-
-        self.validation = validation.Validation(parameters)
+        # Ensure that reference data file path (if one is used) is absolute.
+        if parameters.get("reference_file_path") is not None:
+            parameters["reference_file_path"] = core.relative_to_absolute(
+                __file__, parameters["reference_file_path"])
+
+        # Simulation results are cached on disk so repeated and extended sweeps only run new simulations.
+        cache_directory = core.relative_to_absolute(__file__, self.data["cache_directory"])
+        # Imported here as it depends on most of scipy, which is only needed for the validation tasks.
+        import validation
+        self.validation = validation.Validation(parameters, cache_directory=cache_directory,
+                                                **self.data["variance_reduction"])
 
         # Create sub containers for the task buttons.
         utility.set_grid_sizes(self.ui.container,
@@ -495,7 +553,7 @@ class ValidationTasks(MainMenuButton):
                     default_values[index], utility.get_entry(entry))
             # Any value of None (invalid) in the outputs dictionary
             # will prevent the button from continuing.
-            if not utility.contains_value(self.outputs, None) and self.output_validation(self.outputs):
+            if not core.contains_value(self.outputs, None) and self.output_validation(self.outputs):
                 self.plot(type)
 
 
@@ -524,6 +582,9 @@ class ValidationTasks(MainMenuButton):
                               self.outputs["particle_max"]]) / np.log([10])
             particles = np.logspace(extents[0], extents[1],
                                     self.outputs["particle_divisions"], dtype=int)
+            if self.validation.antithetic:
+                # Antithetic pairs split each particle count in half, so the counts are rounded to even numbers.
+                particles = np.maximum(particles // 2 * 2, 2)
 
             dts = np.linspace(self.outputs["dt_min"], self.outputs["dt_max"],
                               self.outputs["dt_divisions"])
@@ -531,15 +592,19 @@ class ValidationTasks(MainMenuButton):
             # Find the RMSE values for given particles and dts, 
             # also retrieve fitting information for the graph.
             rmse_array, fitted_values, fitting_parameters = self.validation.fit_rmse_curve(particles, dts)
+            # Error bars are only shown if several replicas were averaged.
+            rmse_errors = self.validation.rmse_confidence if self.validation.replicas > 1 else None
 
             if type == "linear":
                 figure = self.validation.rmse_figure(particles, dts, 
-                                                     rmse_array, "linear")
+                                                     rmse_array, "linear",
+                                                     rmse_errors=rmse_errors)
             elif type == "log":
                 figure = self.validation.rmse_figure(particles, dts, 
                                                      rmse_array, "log",
                                                      fitted_values, 
-                                                     fitting_parameters)
+                                                     fitting_parameters,
+                                                     rmse_errors)
                 # Print the β values in case the user
                 # desires to copy them from the console.
                 print("β values: " + str([b for a, b in fitting_parameters]))
@@ -636,23 +701,74 @@ class CustomConditions(MainMenuButton):
                                                          utility.get_entry(input.entries))
         # Any value of None (invalid) in the outputs dictionary
         # will prevent the button from continuing.
-        if not utility.contains_value(self.outputs, None) and self.output_validation(self.outputs):
+        if not core.contains_value(self.outputs, None) and self.output_validation(self.outputs):
             self.plot()
 
     def plot(self):
         """Plots the desired type of concentration graph."""
         utility.clear_widgets(self.ui.container)
 
-        self.sim = simulation.Simulation(self.outputs)
+        import backends
+        self.sim = backends.create_simulation(self.outputs)
 
         # Non-animated graphs need to be calculated first.
         if not self.sim.animated:
-            self.sim.simulate(print_time=True)
-            self.sim.calculate_concentrations()
+            self.simulate_in_background()
+        else:
+            self.show_plot()
+
+
+    def simulate_in_background(self):
+        """
+        Runs a non-animated simulation in a separate thread so that the user interface remains
+        responsive. The progress of the simulation is shown using a progress bar which is updated
+        by periodically polling the progress reporter from the Tkinter event loop.
+        """
+        utility.set_grid_sizes(self.ui.container, [45, 10, 45], [100])
+        progress_bar = utility.create_progress_bar(self.ui.container, 1, 0)
+        # Console reporting is kept so that progress is also visible in the terminal.
+        progress_reporter = progress.ConsoleProgressReporter(interval=0.2)
+        thread = threading.Thread(target=self.sim.simulate, daemon=True,
+                                  kwargs={"progress_reporter": progress_reporter})
+        thread.start()
+        self.poll_simulation(thread, self.sim, progress_bar, progress_reporter)
+
+
+    def poll_simulation(self, thread: threading.Thread, sim: any, progress_bar: any,
+                        progress_reporter: progress.ProgressReporter):
+        """Updates the progress bar until the background simulation finishes, then plots the results.
+        The simulation, bar and reporter are passed in rather than read from members, since the user
+        may have started a different simulation by the time a poll runs.
+        Args:
+            thread:            Thread running the simulation.
+            sim:               Simulation being run by the thread.
+            progress_bar:      Progress bar showing the progress of the simulation.
+            progress_reporter: Reporter updated by the simulation.
+        """
+        # Stop the simulation and polling if the user navigated away from the progress bar.
+        if not progress_bar.winfo_exists():
+            progress_reporter.stop()
+            return
+        progress_bar["value"] = 100 * progress_reporter.fraction
+        # The remaining time is unknown until the first progress report.
+        eta = "?" if np.isinf(progress_reporter.eta) else str(round(progress_reporter.eta, 1))
+        self.ui.label["text"] = self.name + " (simulating until t=" + str(sim.time_max) + "s, " + \
+                                "ETA: " + eta + "s)"
+        if thread.is_alive():
+            self.ui.root.after(100, self.poll_simulation, thread, sim, progress_bar, progress_reporter)
+        else:
+            sim.calculate_concentrations()
+            utility.clear_widgets(self.ui.container)
+            self.show_plot()
+
 
+    def show_plot(self):
+        """Creates the concentration figure and the plot buttons."""
         figure = None
         one_dimensional_case = False
-        
+        # Sparse concentrations are converted since matplotlib can only plot dense grids.
+        concentrations = sparse.to_dense(self.sim.concentrations)
+
         for i in [X, Y]:
             # If either cell dimension is == 1, store it and 
             # the other axis and switch to the 1D plot case. 
@@ -666,16 +782,16 @@ class CustomConditions(MainMenuButton):
                                       self.sim.max[self.single_dimension],
                                       self.sim.cell_size[self.other_dimension])
             # Convert the concentration array to 1D.
-            single_dimension_concentration = np.reshape(self.sim.concentrations,
+            single_dimension_concentration = np.reshape(concentrations,
                                                         (self.sim.cell_size[self.other_dimension]))
             # Create the figure for the concentration versus (x/y) position plot.
-            figure, self.axes, self.lines = utility.create_line_plot(
+            figure, self.axes, self.lines = plotting.create_line_plot(
                 self.domain, single_dimension_concentration,
                 self.sim.min[self.single_dimension], self.sim.max[self.single_dimension], 
                 0, 1, dimension_labels[self.single_dimension], "Concentration ϕ")
         else:
             # Create the heatmap for concentration plotting.
-            figure, self.axes, self.heatmap = utility.create_heatmap(self.sim.concentrations, 
+            figure, self.axes, self.heatmap = plotting.create_heatmap(concentrations,
                                                                     self.data["color_map"],
                                                                     self.sim.animated,
                                                                     self.sim.min, self.sim.max,
@@ -699,6 +815,7 @@ class CustomConditions(MainMenuButton):
         self.canvas = self.ui.embed_plot(figure)
         if self.sim.animated:
             # Created after canvas to fix animation for macOS.
+            from matplotlib import animation
             self.anim = animation.FuncAnimation(figure, func=self.animate_plot,
                                                 frames=self.sim.steps, fargs=(one_dimensional_case,), 
                                                 interval=1, repeat=False)
@@ -715,12 +832,13 @@ class CustomConditions(MainMenuButton):
         self.axes.set_title("Time: " + str(round(step * self.sim.dt, 2)) + "s")
         # Recalculate concentrations every simulation step.
         self.sim.calculate_concentrations()
+        concentrations = sparse.to_dense(self.sim.concentrations)
         if one_dimensional:
             # Concentrations array needs to be converted to 1D before it is set.
-            self.lines.set_data(self.domain, np.reshape(self.sim.concentrations,
+            self.lines.set_data(self.domain, np.reshape(concentrations,
                                                         (self.sim.cell_size[self.other_dimension])))
         else:
-            self.heatmap.set_array(self.sim.concentrations)
+            self.heatmap.set_array(concentrations)
         # Enables plotting t = 0.
         if step > 0:
             self.sim.update()
@@ -756,7 +874,7 @@ class CustomConditions(MainMenuButton):
                               "Cell height must be greater than 0")
         if outputs["use_velocity"]:
             # Check that the velocity field file can be read and has 4 columns.
-            coordinates, vectors = utility.read_data_file(
+            coordinates, vectors = core.read_data_file(
                 outputs["velocity_field_path"], [0, 1], [2, 3])
             valid &= utility.check(not isinstance(coordinates, type(None)) and \
                                    not isinstance(vectors, type(None)),
@@ -780,4 +898,4 @@ class CustomConditions(MainMenuButton):
 
 """Entry point to the application"""
 if __name__ == "__main__":
-    UserInterface(utility.relative_to_absolute(__file__, "config.json"))
\ No newline at end of file
+    UserInterface(core.relative_to_absolute(__file__, "config.json"))
\ No newline at end of file
@@ -0,0 +1,158 @@
+import numpy.typing as npt
+import numpy as np
+
+"""
+This file implements an optional compiled kernel which performs a whole simulation step in a single
+parallel loop over the particles: velocity lookup, Lagrangian update, boundary reflection and
+concentration cell index computation. This avoids the temporary arrays and repeated passes over
+memory made by the NumPy implementation in simulation.py.
+
+The kernel requires numba. If it is not installed, 'available' is False and the simulation
+falls back to the NumPy implementation.
+
+Random numbers are generated from a counter based stream: each particle's normal samples are a hash of
+the seed, the step number and the particle index. This gives every thread an independent stream and
+makes results reproducible regardless of the number of threads used.
+"""
+try:
+    import numba
+    available = True
+except ImportError:
+    available = False
+
+X = 0
+Y = 1
+
+
+if available:
+    @numba.njit(cache=True)
+    def mix(state: np.uint64):
+        """SplitMix64 finalizer, which turns consecutive integers into statistically independent ones."""
+        state = (state ^ (state >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        state = (state ^ (state >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return state ^ (state >> np.uint64(31))
+
+
+    @numba.njit(cache=True)
+    def normal_pair(seed: np.uint64, counter: np.uint64):
+        """Returns two independent standard normal samples for a counter using the Box-Muller transform."""
+        first = mix(seed + counter * np.uint64(0x9E3779B97F4A7C15))
+        second = mix(first ^ np.uint64(0xD1B54A32D192ED03))
+        # The top 53 bits form a uniform double, the first is shifted into (0, 1] so its log is finite.
+        uniform_1 = ((first >> np.uint64(11)) + np.uint64(1)) * (1.0 / 9007199254740992.0)
+        uniform_2 = (second >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+        radius = np.sqrt(-2.0 * np.log(uniform_1))
+        return radius * np.cos(2.0 * np.pi * uniform_2), radius * np.sin(2.0 * np.pi * uniform_2)
+
+
+    @numba.njit(cache=True)
+    def reflect(value: float, minimum: float, maximum: float):
+        """Bounces a coordinate off the domain bounds, clamping it if it is still out of bounds."""
+        if value < minimum:
+            value = minimum + (minimum - value)
+        if value > maximum:
+            value = maximum + (maximum - value)
+        if value < minimum:
+            value = minimum
+        if value > maximum:
+            value = maximum
+        return value
+
+
+    @numba.njit(cache=True)
+    def nearest_node(x: float, y: float, origin: npt.NDArray, spacing: npt.NDArray, shape_x: int, shape_y: int):
+        """Returns the [x, y] index of the nearest node of a regular grid, clamped to the edges of the grid."""
+        node_x = min(max(int(np.rint((x - origin[X]) / spacing[X])), 0), shape_x - 1)
+        node_y = min(max(int(np.rint((y - origin[Y]) / spacing[Y])), 0), shape_y - 1)
+        return node_x, node_y
+
+
+    @numba.njit(cache=True)
+    def interpolate(x: float, y: float, grid: npt.NDArray, origin: npt.NDArray, spacing: npt.NDArray):
+        """Returns the bilinearly interpolated value of a regular grid and its x and y gradient
+           (see lattice.Lattice.interpolate)."""
+        position_x = min(max((x - origin[X]) / spacing[X], 0.0), grid.shape[0] - 1.0)
+        position_y = min(max((y - origin[Y]) / spacing[Y], 0.0), grid.shape[1] - 1.0)
+        lower_x = min(int(position_x), grid.shape[0] - 2)
+        lower_y = min(int(position_y), grid.shape[1] - 2)
+        fx = position_x - lower_x
+        fy = position_y - lower_y
+        v00 = grid[lower_x, lower_y]
+        v10 = grid[lower_x + 1, lower_y]
+        v01 = grid[lower_x, lower_y + 1]
+        v11 = grid[lower_x + 1, lower_y + 1]
+        value = (1 - fx) * ((1 - fy) * v00 + fy * v01) + fx * ((1 - fy) * v10 + fy * v11)
+        gradient_x = ((1 - fy) * (v10 - v00) + fy * (v11 - v01)) / spacing[X]
+        gradient_y = ((1 - fx) * (v01 - v00) + fx * (v11 - v10)) / spacing[Y]
+        return value, gradient_x, gradient_y
+
+
+    @numba.njit(parallel=True, cache=True)
+    def fused_step(coordinates: npt.NDArray, particles: npt.NDArray, velocity_grid: npt.NDArray,
+                   origin: npt.NDArray, spacing: npt.NDArray, use_velocity: bool, use_heun: bool,
+                   noise_scales: npt.NDArray, noise_grid: npt.NDArray, noise_origin: npt.NDArray,
+                   noise_spacing: npt.NDArray, use_noise_grid: bool, noise_sign: float, dt: float,
+                   minimum: npt.NDArray, maximum: npt.NDArray, cell_size: npt.NDArray,
+                   cells: npt.NDArray, seed: np.uint64, step: np.uint64):
+        """Moves every particle one simulation step forward in time (in place).
+        Args:
+            coordinates:    Particle coordinates. shape=(N, 2)
+            particles:      Species of each particle.
+            velocity_grid:  Velocity vectors on a regular grid (see lattice.Lattice). shape=(Nx, Ny, 2)
+            origin:         Coordinates of the first node of the velocity grid.
+            spacing:        Distance between velocity grid nodes along each axis.
+            use_velocity:   Whether or not the velocity field is applied.
+            use_heun:       Whether the velocity is averaged with the velocity at the predicted end of the step.
+            noise_scales:   Standard deviation of the diffusive displacement, sqrt(2 * D * dt), of each species.
+            noise_grid:     Diffusivity on a regular grid, which is bilinearly interpolated. Particles are also
+                            moved by dt * grad(D) of the interpolated diffusivity (see lattice.Lattice.interpolate).
+            noise_origin:   Coordinates of the first node of the noise grid.
+            noise_spacing:  Distance between noise grid nodes along each axis.
+            use_noise_grid: Whether the noise grid is used instead of the per-species noise scales.
+            noise_sign:     Sign of the noise found from the noise grid (-1 for antithetic simulations).
+            dt:             Time step.
+            minimum:        Left and bottom bounds of the domain respectively.
+            maximum:        Right and top bounds of the domain respectively.
+            cell_size:      Number of concentration cells along each axis.
+            cells:          Output array for the flattened concentration cell index of each particle.
+            seed:           Seed of the random number stream.
+            step:           Number of steps taken so far, so every step uses different random numbers.
+        """
+        count = coordinates.shape[0]
+        for particle in numba.prange(count):
+            x = coordinates[particle, X]
+            y = coordinates[particle, Y]
+            velocity_x = 0.0
+            velocity_y = 0.0
+            drift_x = 0.0
+            drift_y = 0.0
+            if use_noise_grid:
+                diffusivity, gradient_x, gradient_y = interpolate(x, y, noise_grid, noise_origin, noise_spacing)
+                sigma = noise_sign * np.sqrt(2 * diffusivity * dt)
+                drift_x = gradient_x * dt
+                drift_y = gradient_y * dt
+            else:
+                sigma = noise_scales[particles[particle]]
+            noise_x, noise_y = normal_pair(seed, step * np.uint64(count) + np.uint64(particle))
+            noise_x = noise_x * sigma + drift_x
+            noise_y = noise_y * sigma + drift_y
+            if use_velocity:
+                node_x, node_y = nearest_node(x, y, origin, spacing, velocity_grid.shape[0], velocity_grid.shape[1])
+                velocity_x = velocity_grid[node_x, node_y, X]
+                velocity_y = velocity_grid[node_x, node_y, Y]
+                if use_heun:
+                    # Average with the velocity at the end of the step predicted by the Euler method.
+                    predicted_x = reflect(x + velocity_x * dt + noise_x, minimum[X], maximum[X])
+                    predicted_y = reflect(y + velocity_y * dt + noise_y, minimum[Y], maximum[Y])
+                    node_x, node_y = nearest_node(predicted_x, predicted_y, origin, spacing,
+                                                  velocity_grid.shape[0], velocity_grid.shape[1])
+                    velocity_x = 0.5 * (velocity_x + velocity_grid[node_x, node_y, X])
+                    velocity_y = 0.5 * (velocity_y + velocity_grid[node_x, node_y, Y])
+            x = reflect(x + velocity_x * dt + noise_x, minimum[X], maximum[X])
+            y = reflect(y + velocity_y * dt + noise_y, minimum[Y], maximum[Y])
+            coordinates[particle, X] = x
+            coordinates[particle, Y] = y
+            # Same cell mapping as Simulation.calculate_concentrations.
+            cell_x = int(np.rint((x - minimum[X]) / (maximum[X] - minimum[X]) * (cell_size[X] - 1)))
+            cell_y = int(np.rint((y - minimum[Y]) / (maximum[Y] - minimum[Y]) * (cell_size[Y] - 1)))
+            cells[particle] = cell_x * cell_size[Y] + cell_y
@@ -0,0 +1,86 @@
+import numpy.typing as npt
+import numpy as np
+
+"""
+This file implements nearest node lookups for data given on a regular grid (lattice), such as the
+velocity field data file. On a regular grid the nearest node of a point can be found using just
+its coordinates, which is much faster than querying a space partitioning structure like a KDTree.
+
+The X and Y variables alias indexes. This improves code readability when accessing
+multi-dimensional arrays.
+"""
+X = 0
+Y = 1
+
+"""
+The Lattice class stores node values in a (Nx, Ny, ...) grid so that they can be indexed directly.
+A ValueError is raised if the given coordinates do not form a complete regular grid.
+"""
+class Lattice(object):
+    def __init__(self, coordinates: npt.NDArray, values: npt.NDArray):
+        """
+        Args:
+            coordinates: [x, y] coordinates of each node, in any order. shape=(N, 2)
+            values:      Values stored at each node. shape=(N, ...)
+        """
+        x_nodes, y_nodes = np.unique(coordinates[:, X]), np.unique(coordinates[:, Y])
+        if x_nodes.size < 2 or y_nodes.size < 2 or x_nodes.size * y_nodes.size != coordinates.shape[0]:
+            raise ValueError("Coordinates do not form a complete grid")
+        spacing = np.array([x_nodes[1] - x_nodes[0], y_nodes[1] - y_nodes[0]])
+        if not np.allclose(np.diff(x_nodes), spacing[X]) or not np.allclose(np.diff(y_nodes), spacing[Y]):
+            raise ValueError("Coordinates are not evenly spaced")
+
+        self.origin = np.array([x_nodes[0], y_nodes[0]])
+        self.spacing = spacing
+        self.shape = np.array([x_nodes.size, y_nodes.size])
+        # Place each value at the grid position of its node.
+        nodes = np.rint((coordinates - self.origin) / self.spacing).astype(int)
+        self.grid = np.zeros((x_nodes.size, y_nodes.size) + values.shape[1:], dtype=values.dtype)
+        self.grid[nodes[:, X], nodes[:, Y]] = values
+
+
+    def nodes(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to find the nearest nodes of. shape=(N, 2)
+        Returns:
+            [x, y] grid indexes of the nearest node to each point. Points outside of the
+            grid are clamped to the closest edge node, matching a nearest neighbor search.
+        """
+        return np.clip(np.rint((points - self.origin) / self.spacing), 0, self.shape - 1).astype(int)
+
+
+    def lookup(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to find the values of. shape=(N, 2)
+        Returns:
+            Value of the nearest node to each point.
+        """
+        nodes = self.nodes(points)
+        return self.grid[nodes[:, X], nodes[:, Y]]
+
+
+    def interpolate(self, points: npt.NDArray):
+        """
+        Bilinearly interpolates scalar node values, which (unlike the nearest node value) is continuous and
+        has a well defined gradient everywhere.
+        Args:
+            points: Coordinates to find the values of. shape=(N, 2)
+        Returns:
+            Interpolated value at each point and its [x, y] gradient, found from the same interpolant.
+            Points outside of the grid are clamped to its edges. shape=(N,) and shape=(N, 2)
+        """
+        positions = np.clip((points - self.origin) / self.spacing, 0, self.shape - 1)
+        lower = np.minimum(positions.astype(int), self.shape - 2)
+        fractions = positions - lower
+        # Values of the corners of the cell each point lies in.
+        v00 = self.grid[lower[:, X], lower[:, Y]]
+        v10 = self.grid[lower[:, X] + 1, lower[:, Y]]
+        v01 = self.grid[lower[:, X], lower[:, Y] + 1]
+        v11 = self.grid[lower[:, X] + 1, lower[:, Y] + 1]
+        fx, fy = fractions[:, X], fractions[:, Y]
+        values = (1 - fx) * ((1 - fy) * v00 + fy * v01) + fx * ((1 - fy) * v10 + fy * v11)
+        gradients = np.column_stack((((1 - fy) * (v10 - v00) + fy * (v11 - v01)) / self.spacing[X],
+                                     ((1 - fx) * (v01 - v00) + fx * (v11 - v10)) / self.spacing[Y]))
+        return values, gradients
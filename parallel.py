@@ -0,0 +1,194 @@
+from multiprocessing import shared_memory
+from typing import Dict
+import multiprocessing
+import numpy as np
+import os
+import simulation
+
+"""
+This file implements a multi-process simulation backend for very large particle counts.
+The particle coordinates and values are stored in shared memory, and each worker process updates and
+bins its own slice of them in place. Only the concentration histograms (whose size depends on the
+number of cells, not particles) are sent back to the main process, where they are summed.
+
+Requires Python 3.8 or newer (for multiprocessing.shared_memory).
+"""
+
+
+def create_shared_array(shape: any, dtype: any):
+    """
+    Args:
+        shape: Shape of the array.
+        dtype: Data type of the array.
+    Returns:
+        Shared memory block and a NumPy array which uses it as its buffer.
+    """
+    size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    memory = shared_memory.SharedMemory(create=True, size=size)
+    return memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+
+def worker(parameters: Dict[str, any], coordinates_name: str, particles_name: str,
+           count: int, start: int, end: int, connection: any):
+    """
+    Runs in a worker process, creating a simulation whose particles are a slice of the shared arrays.
+    Commands are received through the connection as (command, argument) tuples:
+        ("update", steps): Updates the slice the given number of steps, replies with None.
+        ("bin", None):     Replies with the binned counts and particle sums of the slice.
+        ("stop", None):    Closes the shared memory and exits.
+    Args:
+        parameters:       Simulation parameters of the worker.
+        coordinates_name: Name of the shared memory block holding all coordinates.
+        particles_name:   Name of the shared memory block holding all particle values.
+        count:            Total number of particles in the shared arrays.
+        start:            Index of the first particle of the slice.
+        end:              Index one past the last particle of the slice.
+        connection:       Pipe connection to the main process.
+    """
+    coordinates_memory = shared_memory.SharedMemory(name=coordinates_name)
+    particles_memory = shared_memory.SharedMemory(name=particles_name)
+    sim = simulation.Simulation(parameters)
+    # Slicing the shared arrays creates views, so the worker updates the shared data in place.
+    sim.coordinates = np.ndarray((count, 2), dtype=float, buffer=coordinates_memory.buf)[start:end]
+    sim.particles = np.ndarray(count, dtype=np.int64, buffer=particles_memory.buf)[start:end]
+    while True:
+        command, argument = connection.recv()
+        if command == "update":
+            for _ in range(argument):
+                sim.update()
+            connection.send(None)
+        elif command == "bin":
+            connection.send(sim.bin_particles())
+        else:
+            break
+    # The views must be released before the shared memory can be closed.
+    del sim
+    coordinates_memory.close()
+    particles_memory.close()
+
+
+"""
+The SharedSimulation class has the same interface as the Simulation class (concentrations, update(),
+simulate(), calculate_concentrations()) but splits the particles across several worker processes.
+Any other members (e.g. dt, steps, cell_size) are retrieved from the underlying simulation.
+
+The initial conditions are generated by a regular Simulation in the main process and then moved into
+shared memory. Call close() (or use a with statement) to stop the workers and free the shared memory.
+"""
+class SharedSimulation(object):
+    def __init__(self, parameters: Dict[str, any], processes: int = None):
+        """
+        Args:
+            parameters: Simulation parameters (see simulation.Simulation).
+            processes:  Number of worker processes. Defaults to None (the number of CPUs).
+        """
+        processes = os.cpu_count() if processes is None else processes
+        assert processes > 0, "Process count must be greater than 0"
+        self.sim = simulation.Simulation(parameters)
+        # Workers send binned histograms, which are only used by dense concentrations.
+        assert not self.sim.sparse_concentrations, "Sparse concentrations are not supported by shared simulations"
+        count = self.sim.coordinates.shape[0]
+
+        # Move the particle data into shared memory (the simulation keeps views of it).
+        self.coordinates_memory, coordinates = create_shared_array((count, 2), float)
+        self.particles_memory, particles = create_shared_array(count, np.int64)
+        coordinates[:] = self.sim.coordinates
+        particles[:] = self.sim.particles
+        self.sim.coordinates, self.sim.particles = coordinates, particles
+
+        # Workers only need the parameters which affect updating and binning, their initial
+        # conditions are replaced by the shared data so shape generation is skipped. Task E
+        # is handled by the main process, which ignores the particle sums of the workers.
+        worker_parameters = dict(parameters)
+        worker_parameters.update({"particle_count": 1, "sampling": "uniform", "shapes": [],
+                                  "use_circle": False, "use_rectangle": False, "optimized": False})
+        # Each worker gets an independent random number stream derived from the simulation generator.
+        seeds = np.random.SeedSequence(self.sim.rng.integers(2 ** 63)).spawn(processes)
+        bounds = np.linspace(0, count, processes + 1).astype(int)
+        self.connections = []
+        self.processes = []
+        for index in range(processes):
+            worker_parameters["seed"] = seeds[index]
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=worker, daemon=True,
+                                              args=(dict(worker_parameters), self.coordinates_memory.name,
+                                                    self.particles_memory.name, count, bounds[index],
+                                                    bounds[index + 1], worker_connection))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.concentrations = self.sim.concentrations
+
+
+    def __getattr__(self, name: str):
+        # Only called for members not found on this class, such as the simulation parameters.
+        return getattr(self.__dict__["sim"], name)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exception):
+        self.close()
+
+
+    def __broadcast(self, command: str, argument: any = None):
+        """Sends a command to all workers and waits for all of their replies."""
+        for connection in self.connections:
+            connection.send((command, argument))
+        return [connection.recv() for connection in self.connections]
+
+
+    def update(self, steps: int = 1):
+        """Moves the simulation forward in time.
+        Args:
+            steps: Number of steps for the workers to take before synchronizing. Defaults to 1.
+        """
+        self.__broadcast("update", steps)
+
+
+    def simulate(self, print_time: bool = False, progress_reporter: any = None, exposure_tracker: any = None):
+        """Runs the simulation until completion (see simulation.Simulation.simulate).
+        Without progress reporting or exposure tracking the workers run every step without synchronizing.
+        """
+        if progress_reporter is None and exposure_tracker is None and not print_time:
+            self.update(self.sim.steps)
+            return
+        simulation.run_steps(self, print_time, progress_reporter, exposure_tracker)
+
+
+    def bin_particles(self):
+        """Returns the particle counts and summed particle values of each cell, summed over all workers."""
+        partials = self.__broadcast("bin")
+        count = np.sum([partial[0] for partial in partials], axis=0)
+        weighted = None if self.sim.optimized else np.sum([partial[1] for partial in partials], axis=0)
+        return count, weighted
+
+
+    def calculate_concentrations(self):
+        self.sim.calculate_concentrations(self.bin_particles())
+        self.concentrations = self.sim.concentrations
+
+
+    def __del__(self):
+        # Simulations created through backends.create_simulation are not closed explicitly, so the workers and
+        # shared memory are freed once the simulation is no longer used (if the constructor got that far).
+        if "processes" in self.__dict__:
+            self.close()
+
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory."""
+        if not self.processes:
+            return
+        for connection in self.connections:
+            connection.send(("stop", None))
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.sim.coordinates = np.copy(self.sim.coordinates)
+        self.sim.particles = np.copy(self.sim.particles)
+        for memory in [self.coordinates_memory, self.particles_memory]:
+            memory.close()
+            memory.unlink()
@@ -0,0 +1,95 @@
+from typing import List
+import numpy.typing as npt
+
+"""
+This file contains the functions used for creating matplotlib figures. Matplotlib is imported inside
+the functions which use it, as importing it takes much longer than starting the user interface
+(which does not need it until a plot is shown). None of these functions require Tkinter, so figures
+can also be created and saved without a display (e.g. using the Agg backend).
+"""
+
+
+def create_colormap(color_list: List[any], size: int = 256):
+    """
+    Args:
+        color_list: List of [value, color] pairs (e.g. the color_map entries of the JSON configuration file).
+        size:       Number of discrete colors in the colormap. Defaults to 256 (matplotlib's default).
+    Returns:
+        Matplotlib colormap which interpolates between the given colors.
+    """
+    import matplotlib.colors
+    # Turn the lists inside the color_list into 
+    # tuples as required by the from_list function.
+    return matplotlib.colors.LinearSegmentedColormap.from_list(
+        "", [tuple(pair) for pair in color_list], N=size)
+
+
+def create_heatmap(data: npt.ArrayLike, color_list: List[any], 
+                   animated: bool, min: npt.ArrayLike, max: npt.ArrayLike, 
+                   x_label: str, y_label: str):
+    """Creates a heatmap figure used for plotting scalar fields.
+    Args:
+        data:       Scalar field to be plotted.
+        color_list: List of integer and color intervals used for determining
+                    the color gradient of the figure's color bar.
+        animated:   Whether or not the heatmap can be animated.
+        min:        [x, y] axis bounds
+        max:        [x, y] axis bounds.
+        x_label:    X axis label.
+        y_label:    Y axis label.
+    Returns:
+        A figure, its axes, and the created heatmap.
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.cm
+    # Close all previous plots to improve performance.
+    plt.close('all')
+    figure, axes = plt.figure(), plt.axes()
+    axes.set_xlabel(x_label)
+    axes.set_ylabel(y_label)
+    heatmap = axes.imshow(data, animated=animated,
+                          extent=(min[0], max[0], min[1], max[1]))
+    cmap = create_colormap(color_list)
+    heatmap.set_cmap(cmap)
+    figure.colorbar(matplotlib.cm.ScalarMappable(cmap=cmap))
+    return figure, axes, heatmap
+
+def create_line_plot(x_data: any, y_data: any,
+                     x_min: float, x_max: float,
+                     y_min: float, y_max: float,
+                     x_label: str, y_label: str):
+    """Creates a line plot figure used for plotting 1D concentration data.
+    Args:
+        x_data: X axis data to be plotted.
+        y_data: Y axis data to be plotted.
+        x_min:  X axis lower bound.
+        x_max:  X axis upper bound.
+        y_min:  Y axis lower bound.
+        y_max:  Y axis upper bound.
+        x_label:    X axis label.
+        y_label:    Y axis label.
+    Returns:
+        A figure, its axes, and the created line object.
+    """
+    import matplotlib.pyplot as plt
+    # Close all previous plots to improve performance.
+    plt.close('all')
+    figure, axes = plt.figure(), plt.axes()
+    lines, = plt.plot(x_data, y_data)
+    plt.grid()
+    plt.xlim(x_min, x_max)
+    plt.ylim(y_min, y_max)
+    plt.xlabel(x_label)
+    plt.ylabel(y_label)
+    return figure, axes, lines
+
+def configure_plot(title: str, x_label: str, y_label: str, scale: str):
+    """Sets the matplotlib plot to have with the desired parameters."""
+    import matplotlib.pyplot as plt
+    plt.title(title)
+    plt.legend()
+    plt.grid()
+    plt.yscale(scale)
+    plt.xscale(scale)
+    plt.xlabel(x_label)
+    plt.ylabel(y_label)
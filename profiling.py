@@ -0,0 +1,137 @@
+import contextlib
+import tracemalloc
+import threading
+import time
+
+"""
+This file implements the optional instrumentation used for finding where a simulation spends its time.
+A Profiler accumulates per-phase statistics and notifies any registered hooks after each timed phase.
+When profiling is disabled the simulation uses null_profiler, which does no work when a phase is timed.
+"""
+
+"""
+The PhaseStats class stores the cumulative statistics of a single named phase of the simulation.
+"""
+class PhaseStats(object):
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        # Total number of particles processed across all calls.
+        self.particles = 0
+        # Largest amount of memory allocated during a single call (only tracked if memory profiling is on).
+        self.peak_bytes = 0
+
+
+    def particles_per_second(self):
+        """Returns the average throughput of the phase, or 0 if it has not been timed yet."""
+        return self.particles / self.seconds if self.seconds > 0 else 0.0
+
+
+"""
+The SimulationStats class maps phase names to their statistics.
+"""
+class SimulationStats(object):
+    def __init__(self):
+        self.phases = {}
+        # Phases can be recorded from multiple threads when the simulation is multi-threaded.
+        self.lock = threading.Lock()
+
+
+    def record(self, name: str, seconds: float, particles: int, peak_bytes: int):
+        """Adds the measurements of a single call to the statistics of a phase."""
+        with self.lock:
+            phase = self.phases.setdefault(name, PhaseStats())
+            phase.seconds += seconds
+            phase.calls += 1
+            phase.particles += particles
+            phase.peak_bytes = max(phase.peak_bytes, peak_bytes)
+
+
+    def total_seconds(self):
+        return sum(phase.seconds for phase in self.phases.values())
+
+
+    def as_dict(self):
+        """Returns the statistics in a form which can be written to JSON."""
+        return {name: {"seconds": phase.seconds,
+                       "calls": phase.calls,
+                       "particles_per_second": phase.particles_per_second(),
+                       "peak_bytes": phase.peak_bytes} for name, phase in self.phases.items()}
+
+
+    def report(self):
+        """Returns a table of the phase statistics, sorted by the time spent in each phase."""
+        total = self.total_seconds()
+        lines = ["{:<16}{:>10}{:>8}{:>8}{:>16}{:>12}".format(
+            "phase", "time (s)", "%", "calls", "particles/s", "peak (MB)")]
+        for name, phase in sorted(self.phases.items(), key=lambda item: -item[1].seconds):
+            lines.append("{:<16}{:>10.4f}{:>8.1f}{:>8}{:>16.3e}{:>12.2f}".format(
+                name, phase.seconds, 100 * phase.seconds / total if total > 0 else 0.0,
+                phase.calls, phase.particles_per_second(), phase.peak_bytes / 1e6))
+        return "\n".join(lines)
+
+
+"""
+The Profiler class times phases of the simulation using the phase() context manager:
+    with profiler.phase("noise", particle_count):
+        ...
+Hooks are functions called as hook(name, seconds, particles) after each phase completes.
+"""
+class Profiler(object):
+    def __init__(self, track_memory: bool = False):
+        """
+        Args:
+            track_memory: Whether or not to track the peak memory allocated by each phase using tracemalloc.
+                          This adds noticeable overhead so it is disabled by default.
+        """
+        self.stats = SimulationStats()
+        self.hooks = []
+        # Resetting the peak of tracemalloc requires Python 3.9.
+        self.track_memory = track_memory and hasattr(tracemalloc, "reset_peak")
+        if self.track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+
+    def add_hook(self, hook: any):
+        """
+        Args:
+            hook: Function called as hook(name, seconds, particles) after each timed phase.
+        """
+        self.hooks.append(hook)
+
+
+    @contextlib.contextmanager
+    def phase(self, name: str, particles: int = 0):
+        """Times the code inside the with statement and records it under the given phase name.
+        Args:
+            name:      Name of the phase being timed.
+            particles: Number of particles processed by the phase (used for throughput).
+        """
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes if self.track_memory else 0
+        self.stats.record(name, seconds, particles, peak_bytes)
+        for hook in self.hooks:
+            hook(name, seconds, particles)
+
+
+"""
+The NullProfiler class has the same interface as Profiler but records nothing.
+Its phase method returns a shared context manager, so disabled profiling costs one method call per phase.
+"""
+class NullProfiler(object):
+    stats = None
+    __null_context = contextlib.nullcontext()
+
+    def add_hook(self, hook: any):
+        raise RuntimeError("Profiling hooks require the simulation to be created with 'profile' enabled")
+
+    def phase(self, name: str, particles: int = 0):
+        return self.__null_context
+
+
+null_profiler = NullProfiler()
@@ -0,0 +1,80 @@
+import time
+
+"""
+This file implements progress reporting for long running simulations.
+Reporters are updated every simulation step but only report at most once per interval
+of wall time, so the cost of reporting does not depend on the number of steps.
+"""
+
+"""
+The ProgressReporter class tracks the progress of a simulation and stores the latest estimates
+in its members, which makes it safe to read from another thread (e.g. a user interface polling it).
+Child classes override the report method to display the progress.
+"""
+class ProgressReporter(object):
+    def __init__(self, interval: float = 0.5):
+        """
+        Args:
+            interval: Minimum wall time in seconds between reports. Defaults to 0.5.
+        """
+        self.interval = interval
+        self.fraction = 0.0
+        self.steps_per_second = 0.0
+        self.eta = float("inf")
+        self.finished = False
+        self.stopped = False
+
+
+    def start(self, total_steps: int, dt: float):
+        """Called by the simulation before its first step.
+        Args:
+            total_steps: Number of steps the simulation will run for.
+            dt:          Simulation time step, used for reporting the simulated time.
+        """
+        self.total_steps = total_steps
+        self.dt = dt
+        self.step = 0
+        self.start_time = time.perf_counter()
+        self.last_report = self.start_time
+        self.finished = False
+
+
+    def update(self, step: int):
+        """Called by the simulation after each step. Only reports if the interval has passed.
+        Args:
+            step: Number of steps completed so far.
+        """
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or step == self.total_steps:
+            self.last_report = now
+            self.step = step
+            elapsed = now - self.start_time
+            self.fraction = step / self.total_steps
+            self.steps_per_second = step / elapsed if elapsed > 0 else 0.0
+            self.eta = (self.total_steps - step) / self.steps_per_second \
+                       if self.steps_per_second > 0 else float("inf")
+            self.finished = step == self.total_steps
+            self.report()
+
+
+    def stop(self):
+        """Asks the simulation to stop after its current step (e.g. when its results are no longer needed).
+        Simulations check the 'stopped' member after every step, so this can be called from another thread.
+        """
+        self.stopped = True
+
+
+    def report(self):
+        """
+        Defines what happens when progress is reported.
+        Overriden in child classes with specific behavior.
+        """
+        pass
+
+
+class ConsoleProgressReporter(ProgressReporter):
+    def report(self):
+        print("Simulation time: " + str(round(self.step * self.dt, 3)) + "s (" +
+              str(round(100 * self.fraction, 1)) + "%, " +
+              str(round(self.steps_per_second, 1)) + " steps/s, ETA: " +
+              str(round(self.eta, 1)) + "s)")
@@ -0,0 +1,68 @@
+from scipy.special import erf
+import numpy.typing as npt
+import numpy as np
+import functools
+
+"""
+This file implements the exact solution of one dimensional diffusion from a step (top hat) initial
+condition between two reflecting walls, used as the reference solution by the validation tasks.
+
+The solution on an infinite line is a difference of error functions. Reflecting walls are accounted
+for using the method of images: the initial step is mirrored about each wall, and the mirrored copies
+are repeated with a period of twice the domain length. Only images within a few diffusion lengths of
+the domain contribute, so the sum is truncated once the remaining terms are below double precision.
+"""
+
+# Number of diffusion lengths beyond which image contributions are negligible (erfc(8) < 1e-28).
+cutoff = 8
+
+
+def step_solution(points: npt.ArrayLike, time: float, diffusivity: float, minimum: float,
+                  maximum: float, step_min: float, step_max: float):
+    """
+    Args:
+        points:      Positions to evaluate the solution at.
+        time:        Time since the initial condition.
+        diffusivity: Diffusion coefficient.
+        minimum:     Position of the lower wall.
+        maximum:     Position of the upper wall.
+        step_min:    Lower bound of the region with an initial concentration of 1.
+        step_max:    Upper bound of the region with an initial concentration of 1.
+    Returns:
+        Concentration at each point.
+    """
+    points = np.asarray(points, dtype=float)
+    # Only the part of the step inside the domain contributes.
+    step_min, step_max = max(step_min, minimum), min(step_max, maximum)
+    if step_max <= step_min:
+        return np.zeros(points.shape)
+    if time <= 0 or diffusivity <= 0:
+        return ((points >= step_min) & (points <= step_max)).astype(float)
+    length = maximum - minimum
+    width = 2 * np.sqrt(diffusivity * time)
+    periods = int(np.ceil((cutoff * width + length) / (2 * length)))
+    shifts = 2 * length * np.arange(-periods, periods + 1)
+    # Each row holds the bounds of one image of the step: shifted copies and their mirror images.
+    lower = np.concatenate((step_min + shifts, 2 * minimum - step_max + shifts))[:, np.newaxis]
+    upper = np.concatenate((step_max + shifts, 2 * minimum - step_min + shifts))[:, np.newaxis]
+    flat = points.ravel()[np.newaxis, :]
+    solution = 0.5 * np.sum(erf((flat - lower) / width) - erf((flat - upper) / width), axis=0)
+    return np.reshape(solution, points.shape)
+
+
+@functools.lru_cache(maxsize=32)
+def get_reference_concentrations(cell_count: int, time: float, diffusivity: float, minimum: float,
+                                 maximum: float, step_min: float, step_max: float):
+    """
+    Cached version of step_solution evaluated at the concentration cells of a simulation, so repeated
+    validation runs with the same parameters only compute the solution once.
+    Args:
+        cell_count: Number of concentration cells between the walls (see step_solution for the others).
+    Returns:
+        Positions of the cells and the concentration at each of them (read only).
+    """
+    cells = np.linspace(minimum, maximum, cell_count)
+    concentrations = step_solution(cells, time, diffusivity, minimum, maximum, step_min, step_max)
+    cells.flags.writeable = False
+    concentrations.flags.writeable = False
+    return cells, concentrations
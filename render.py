@@ -0,0 +1,213 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+import numpy.typing as npt
+import numpy as np
+import subprocess
+import argparse
+import shutil
+import json
+import sys
+import os
+import exposure
+import sparse
+import core
+
+"""
+This file implements offline rendering of simulations to image sequences and videos. The concentration
+grid of every frame is recorded while the simulation runs, and the frames are then rendered to PNG files
+by several worker processes using matplotlib's Agg backend (which does not need a display). This is much
+faster than watching the animation in the user interface, which renders one frame per simulation step.
+
+Example usage:
+    python render.py --section "Animated Chemical Spill" --output frames --video spill.gif
+    python render.py --section "Animated Chemical Spill" --output frames --highlight --processes 8
+    python render.py --section "Animated Chemical Spill" --output frames --direct --zoom 4
+"""
+
+# Frame rate of rendered videos (frames per second).
+default_fps = 30
+
+
+def record_frames(sim: any, frame_step: int = 1, exposure_tracker: exposure.ExposureTracker = None):
+    """Runs a simulation until completion, recording its concentrations.
+    Args:
+        sim:              Simulation to run (any simulation backend).
+        frame_step:       Number of simulation steps between recorded frames. Defaults to 1.
+        exposure_tracker: If given, recorded frames highlight the cells which have ever exceeded its
+                          threshold (as in the user interface animation). Defaults to None.
+    Returns:
+        Recorded concentration grids and the simulation time of each. shape=(frames, Ny, Nx)
+        If the simulation uses sparse concentrations (and no exposure tracker is given), the grids
+        are returned as a list of sparse.SparseGrid objects instead, which only store the non-zero cells.
+    """
+    frames, times = [], []
+    for step in range(sim.steps + 1):
+        if step > 0:
+            sim.update()
+        if step % frame_step == 0 or step == sim.steps:
+            sim.calculate_concentrations()
+            concentrations = sim.concentrations
+            if exposure_tracker is not None:
+                exposure_tracker.update(concentrations, step * sim.dt)
+                concentrations = exposure_tracker.highlight(concentrations)
+            if isinstance(concentrations, sparse.SparseGrid):
+                # A new sparse grid is created by every calculation, so it does not need to be copied.
+                frames.append(concentrations)
+            else:
+                # Concentrations are copied since they may be views reused by the next frame.
+                frames.append(np.array(concentrations))
+            times.append(step * sim.dt)
+    if len(frames) > 0 and isinstance(frames[0], sparse.SparseGrid):
+        return frames, np.array(times)
+    return np.array(frames), np.array(times)
+
+
+def render_frames(frames: npt.NDArray, times: npt.NDArray, paths: List[str], color_list: List[any],
+                  minimum: npt.ArrayLike, maximum: npt.ArrayLike):
+    """Renders concentration grids to image files using a single figure which is reused for every frame.
+    Args:
+        frames:     Concentration grids (dense or sparse) to render.
+        times:      Simulation time of each frame (shown in the title).
+        paths:      Output image path of each frame.
+        color_list: List of [value, color] pairs used for the colormap.
+        minimum:    [x, y] axis bounds.
+        maximum:    [x, y] axis bounds.
+    """
+    # The object oriented interface is used so that no pyplot (and therefore no GUI) backend is needed.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    import matplotlib.cm
+    import plotting
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.set_xlabel("x")
+    axes.set_ylabel("y")
+    cmap = plotting.create_colormap(color_list)
+    dense = sparse.to_dense(frames[0])
+    heatmap = axes.imshow(dense, cmap=cmap, vmin=0, vmax=1,
+                          extent=(minimum[0], maximum[0], minimum[1], maximum[1]))
+    figure.colorbar(matplotlib.cm.ScalarMappable(cmap=cmap), ax=axes)
+    for frame, time, path in zip(frames, times, paths):
+        dense = sparse.to_dense(frame, dense)
+        heatmap.set_array(dense)
+        axes.set_title("Time: " + str(round(time, 2)) + "s")
+        figure.savefig(path)
+
+
+def render_sequence(frames: npt.NDArray, times: npt.NDArray, directory: str, color_list: List[any],
+                    minimum: npt.ArrayLike, maximum: npt.ArrayLike, processes: int = None):
+    """Renders concentration grids to a numbered PNG image sequence using several worker processes.
+    Args:
+        directory: Directory to write the images to (created if it does not exist).
+        processes: Number of worker processes. Defaults to None (the number of CPUs).
+        Other arguments are the same as for render_frames.
+    Returns:
+        Paths of the rendered images, in order.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, "frame_{:05d}.png".format(index)) for index in range(len(frames))]
+    processes = os.cpu_count() if processes is None else processes
+    if processes <= 1:
+        render_frames(frames, times, paths, color_list, minimum, maximum)
+        return paths
+    # Each worker renders a contiguous chunk of frames, so it only sets up a figure once.
+    bounds = np.linspace(0, len(frames), min(processes, len(frames)) + 1).astype(int)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tasks = [executor.submit(render_frames, frames[start:end], times[start:end], paths[start:end],
+                                 color_list, minimum, maximum) for start, end in zip(bounds[:-1], bounds[1:])]
+        for task in tasks:
+            task.result()
+    return paths
+
+
+def render_direct(frames: npt.NDArray, directory: str, color_list: List[any], zoom: int = 1):
+    """Renders concentration grids to a numbered PNG image sequence by mapping each cell straight to
+       a color using a lookup table (see colormap.ColorLookupTable). The images have no axes, title
+       or color bar, but this is fast enough that no worker processes are needed.
+    Args:
+        frames:     Concentration grids (dense or sparse) to render.
+        directory:  Directory to write the images to (created if it does not exist).
+        color_list: List of [value, color] pairs used for the colormap.
+        zoom:       Integer factor by which each cell is enlarged. Defaults to 1.
+    Returns:
+        Paths of the rendered images, in order.
+    """
+    import colormap
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, "frame_{:05d}.png".format(index)) for index in range(len(frames))]
+    lookup_table = colormap.ColorLookupTable(color_list)
+    for frame, path in zip(frames, paths):
+        lookup_table.save(frame, path, zoom)
+    return paths
+
+
+def encode_video(paths: List[str], output: str, fps: int = default_fps):
+    """Encodes a rendered image sequence into a video. GIFs are written using Pillow,
+       other formats require ffmpeg.
+    Args:
+        paths:  Paths of the images, in order (see render_sequence).
+        output: Path of the video file to create. Its extension sets the format (e.g. .mp4 or .gif).
+        fps:    Frame rate of the video.
+    Returns:
+        True if the video was created, False if ffmpeg is not installed.
+    """
+    if output.lower().endswith(".gif"):
+        from PIL import Image
+        images = [Image.open(path) for path in paths]
+        images[0].save(output, save_all=True, append_images=images[1:], duration=1000 / fps, loop=0)
+        return True
+    directory = os.path.dirname(paths[0])
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg is not installed, the rendered frames can be found in " + directory)
+        return False
+    # The scale filter rounds the size to even numbers, which some video encoders require.
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-framerate", str(fps),
+                    "-i", os.path.join(directory, "frame_%05d.png"),
+                    "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", "-pix_fmt", "yuv420p", output], check=True)
+    return True
+
+
+def main(arguments: List[str]):
+    parser = argparse.ArgumentParser(description="Renders a simulation from config.json to images or a video.")
+    parser.add_argument("--section", default="Animated Chemical Spill",
+                        help="Configuration section to take the simulation parameters and color map from.")
+    parser.add_argument("--output", default="frames", help="Directory to write the image sequence to.")
+    parser.add_argument("--video", default=None, help="Video file to encode the frames into (.gif, or any format supported by ffmpeg).")
+    parser.add_argument("--fps", type=int, default=default_fps, help="Frame rate of the video.")
+    parser.add_argument("--frame-step", type=int, default=1, help="Simulation steps between frames.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of rendering processes.")
+    parser.add_argument("--direct", action="store_true",
+                        help="Map cells straight to colors (no axes or color bar), which is much faster.")
+    parser.add_argument("--zoom", type=int, default=1, help="Pixels per cell when using --direct.")
+    parser.add_argument("--highlight", action="store_true",
+                        help="Permanently highlight cells above the section's highlight threshold.")
+    args = parser.parse_args(arguments)
+
+    with open(core.relative_to_absolute(__file__, "config.json")) as json_file:
+        data = json.load(json_file)[args.section]
+    parameters: Dict[str, any] = dict(data["parameters"])
+    for key in ["velocity_field_path", "diffusivity_field_path"]:
+        if parameters.get(key) is not None:
+            parameters[key] = core.relative_to_absolute(__file__, parameters[key])
+
+    import backends
+    sim = backends.create_simulation(parameters)
+    tracker = None
+    if args.highlight:
+        tracker = exposure.ExposureTracker(sim.concentrations.shape, data["highlight_threshold"])
+    print("Simulating " + str(sim.steps) + " steps")
+    frames, times = record_frames(sim, args.frame_step, tracker)
+    print("Rendering " + str(len(frames)) + " frames")
+    if args.direct:
+        paths = render_direct(frames, args.output, data["color_map"], args.zoom)
+    else:
+        paths = render_sequence(frames, times, args.output, data["color_map"], sim.min, sim.max, args.processes)
+    if args.video is not None:
+        encode_video(paths, args.video, args.fps)
+    return 0
+
+
+"""Entry point to the renderer"""
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
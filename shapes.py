@@ -0,0 +1,288 @@
+from typing import List, Dict
+import numpy.typing as npt
+import numpy as np
+import abc
+
+"""
+This file implements the shapes which can be used to set the initial conditions of a simulation.
+Each shape is created from a dictionary (see create_shape) so that any number of shapes can be
+listed in the JSON configuration file or passed by the user interface.
+
+The X and Y variables alias indexes. This improves code readability when accessing
+multi-dimensional arrays.
+"""
+X = 0
+Y = 1
+
+"""
+Abstract class which represents an initial condition shape.
+Child classes implement the contains method for their specific geometry.
+"""
+class Shape(abc.ABC):
+    def __init__(self, value: int, minimum: npt.ArrayLike, maximum: npt.ArrayLike):
+        """
+        Args:
+            value:   Particle value to be set inside the shape.
+            minimum: Left and bottom bounds of the shape respectively.
+            maximum: Right and top bounds of the shape respectively.
+        """
+        self.value = value
+        self.min = np.array(minimum, dtype=float)
+        self.max = np.array(maximum, dtype=float)
+
+
+    @abc.abstractmethod
+    def contains(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to check. shape=(N, 2)
+        Returns:
+            Boolean array which is True for the points that lie inside the shape.
+        """
+
+
+    def area(self):
+        """
+        Returns:
+            Exact area of the shape, or None if it can only be found numerically.
+        """
+        return None
+
+
+class Rectangle(Shape):
+    def __init__(self, info: Dict[str, any]):
+        super().__init__(info["value"], info["min"], info["max"])
+
+    def contains(self, points: npt.NDArray):
+        return np.all((points >= self.min) & (points <= self.max), axis=1)
+
+    def area(self):
+        return float(np.prod(np.maximum(self.max - self.min, 0)))
+
+
+class Circle(Shape):
+    def __init__(self, info: Dict[str, any]):
+        self.center = np.array(info["center"], dtype=float)
+        self.radius = info["radius"]
+        super().__init__(info["value"], self.center - self.radius, self.center + self.radius)
+
+    def contains(self, points: npt.NDArray):
+        # Compare squared Euclidean distances to avoid a square root.
+        return np.sum((points - self.center) ** 2, axis=1) <= self.radius ** 2
+
+    def area(self):
+        return float(np.pi * self.radius ** 2)
+
+
+class Ellipse(Shape):
+    def __init__(self, info: Dict[str, any]):
+        """
+        The info dictionary contains the center, the x and y radii (before rotation)
+        and an optional anti-clockwise rotation angle in degrees.
+        """
+        self.center = np.array(info["center"], dtype=float)
+        self.radii = np.array(info["radii"], dtype=float)
+        angle = np.radians(info.get("angle", 0.0))
+        # Rotation matrix which maps points into the unrotated frame of the ellipse.
+        self.rotation = np.array([[np.cos(angle), np.sin(angle)],
+                                  [-np.sin(angle), np.cos(angle)]])
+        # The bounding box of a rotated ellipse is found from its rotated radii.
+        extent = np.sqrt((self.radii[X] * np.cos(angle)) ** 2 + (self.radii[Y] * np.sin(angle)) ** 2), \
+                 np.sqrt((self.radii[X] * np.sin(angle)) ** 2 + (self.radii[Y] * np.cos(angle)) ** 2)
+        super().__init__(info["value"], self.center - extent, self.center + extent)
+
+    def contains(self, points: npt.NDArray):
+        local = (points - self.center) @ self.rotation.T
+        return np.sum((local / self.radii) ** 2, axis=1) <= 1.0
+
+    def area(self):
+        return float(np.pi * self.radii[X] * self.radii[Y])
+
+
+class Polygon(Shape):
+    def __init__(self, info: Dict[str, any]):
+        """The info dictionary contains a list of [x, y] vertices in order around the polygon."""
+        self.vertices = np.array(info["vertices"], dtype=float)
+        assert self.vertices.shape[0] >= 3, "Polygon must have at least 3 vertices"
+        super().__init__(info["value"], np.min(self.vertices, axis=0), np.max(self.vertices, axis=0))
+
+    def contains(self, points: npt.NDArray):
+        """
+        Uses the even-odd rule: a horizontal ray cast from a point inside the polygon
+        crosses its edges an odd number of times. Each edge is checked against all points at once.
+        """
+        inside = np.zeros(points.shape[0], dtype=bool)
+        for start, end in zip(self.vertices, np.roll(self.vertices, -1, axis=0)):
+            crosses = (start[Y] > points[:, Y]) != (end[Y] > points[:, Y])
+            # Horizontal edges never cross the ray, so their division by zero is ignored.
+            with np.errstate(divide="ignore", invalid="ignore"):
+                intersection = (end[X] - start[X]) * (points[:, Y] - start[Y]) / \
+                               (end[Y] - start[Y]) + start[X]
+            inside ^= crosses & (points[:, X] < intersection)
+        return inside
+
+
+class Mask(Shape):
+    def __init__(self, info: Dict[str, any]):
+        """
+        The info dictionary contains the path to a .npy array or an image file, the [x, y] bounds the
+        mask is stretched over and an optional threshold above which mask pixels are inside the shape.
+        The first row of the mask is the top of the shape, matching how images are displayed.
+        """
+        path = info["path"]
+        if str(path).endswith(".npy"):
+            self.mask = np.load(path)
+        else:
+            # Pillow is only needed for image masks.
+            from PIL import Image
+            self.mask = np.asarray(Image.open(path).convert("L")) / 255.0
+        assert self.mask.ndim == 2, "Mask must be a 2D array or grayscale image"
+        self.mask = self.mask > info.get("threshold", 0.5)
+        super().__init__(info["value"], info["min"], info["max"])
+
+    def contains(self, points: npt.NDArray):
+        rows, columns = self.mask.shape
+        standardized = (points - self.min) / (self.max - self.min)
+        inside = np.all((standardized >= 0) & (standardized <= 1), axis=1)
+        column = np.clip((standardized[:, X] * columns).astype(int), 0, columns - 1)
+        row = np.clip(((1 - standardized[:, Y]) * rows).astype(int), 0, rows - 1)
+        return inside & self.mask[row, column]
+
+
+"""
+Dictionary of shape types and their associated classes.
+Used for creating shapes based on the JSON configuration file.
+"""
+shape_dictionary = {
+    "rectangle": Rectangle,
+    "circle": Circle,
+    "ellipse": Ellipse,
+    "polygon": Polygon,
+    "mask": Mask
+}
+
+
+def create_shape(info: Dict[str, any]):
+    """
+    Args:
+        info: Dictionary containing the shape "type", its "value" and its geometric parameters.
+    Returns:
+        Shape instance of the requested type.
+    """
+    assert info["type"] in shape_dictionary, "Unknown shape type: " + str(info["type"])
+    return shape_dictionary[info["type"]](info)
+
+
+"""
+The ShapeGrid class labels particles with the shape they lie in. When shapes overlap,
+later shapes in the list take priority over earlier ones.
+
+The domain is split into a grid of cells which is labelled once when the grid is created.
+Cells which lie entirely inside a single region store the index of that region, so particles in them
+are labelled by a single lookup. Only particles in cells that are cut by a shape boundary are checked
+against the shapes themselves, keeping labelling close to O(N) regardless of the number of shapes.
+Polygons and masks can have features narrower than a cell which do not touch any cell corner, so every
+cell of their bounding boxes is checked exactly and only the simple shapes benefit from the grid.
+A resolution of 0 skips the grid, so every point is checked against the shapes directly. This is faster
+when there are few points or shapes, as labelling the grid costs as much as labelling its corners.
+"""
+class ShapeGrid(object):
+    def __init__(self, shapes: List[Shape], minimum: npt.ArrayLike,
+                 maximum: npt.ArrayLike, resolution: int):
+        """
+        Args:
+            shapes:     Shapes to label, in the order they are applied.
+            minimum:    Left and bottom bounds of the domain respectively.
+            maximum:    Right and top bounds of the domain respectively.
+            resolution: Number of grid cells along each axis of the domain (0 for no grid).
+        """
+        self.shapes = shapes
+        self.min = np.array(minimum, dtype=float)
+        self.max = np.array(maximum, dtype=float)
+        self.resolution = resolution
+        # Region values, with index 0 being the background.
+        self.values = np.array([0] + [shape.value for shape in shapes])
+        if resolution == 0:
+            self.cells = None
+            return
+
+        # Label the corners of every cell, a cell whose corners are not all equal is cut by a boundary.
+        nodes = np.linspace(self.min, self.max, resolution + 1)
+        x, y = np.meshgrid(nodes[:, X], nodes[:, Y], indexing="ij")
+        corners = np.reshape(self.exact_regions(np.column_stack((x.ravel(), y.ravel()))),
+                             (resolution + 1, resolution + 1))
+        self.cells = corners[:-1, :-1].copy()
+        boundary = (corners[:-1, :-1] != corners[1:, :-1]) | \
+                   (corners[:-1, :-1] != corners[:-1, 1:]) | \
+                   (corners[:-1, :-1] != corners[1:, 1:])
+        # Curved boundaries can bulge into a neighbouring cell between its corners,
+        # so the neighbours of every boundary cell are also treated as boundary cells.
+        dilated = boundary.copy()
+        dilated[1:, :] |= boundary[:-1, :]
+        dilated[:-1, :] |= boundary[1:, :]
+        dilated[:, 1:] |= dilated[:, :-1].copy()
+        dilated[:, :-1] |= dilated[:, 1:].copy()
+        boundary = dilated
+        cell_diagonal = np.linalg.norm((self.max - self.min) / resolution)
+        for shape in shapes:
+            first, last = self.__cell_indexes(np.array([shape.min, shape.max]))
+            # Polygons and masks can have features narrower than a cell anywhere inside their bounding box
+            # (e.g. thin diagonal strips or single pixel stripes), as can ellipses whose tightest curvature
+            # radius is smaller than a cell. None of these features have to touch a cell corner, so every cell
+            # of their bounding box is a boundary cell.
+            thin_ellipse = isinstance(shape, Ellipse) and np.min(shape.radii) ** 2 / np.max(shape.radii) < cell_diagonal
+            if isinstance(shape, (Polygon, Mask)) or thin_ellipse:
+                boundary[first[X]:last[X] + 1, first[Y]:last[Y] + 1] = True
+                continue
+            # Other shapes can only lie between corners along the edges of their bounding box if they are thin.
+            boundary[first[X]:last[X] + 1, [first[Y], last[Y]]] = True
+            boundary[[first[X], last[X]], first[Y]:last[Y] + 1] = True
+        # Boundary cells are marked using -1.
+        self.cells[boundary] = -1
+
+
+    def __cell_indexes(self, points: npt.NDArray):
+        """Finds the [x, y] grid cell index of each point, clipping points outside the domain."""
+        standardized = (points - self.min) / (self.max - self.min)
+        return np.clip((standardized * self.resolution).astype(int), 0, self.resolution - 1)
+
+
+    def exact_regions(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to find the regions of. shape=(N, 2)
+        Returns:
+            Index of the region each point lies in, 0 being the background and i + 1 being shapes[i].
+        """
+        regions = np.zeros(points.shape[0], dtype=int)
+        for index, shape in enumerate(self.shapes):
+            # Only points inside the bounding box of the shape are checked against it.
+            candidates = np.flatnonzero(np.all((points >= shape.min) & (points <= shape.max), axis=1))
+            regions[candidates[shape.contains(points[candidates])]] = index + 1
+        return regions
+
+
+    def regions(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to find the regions of. shape=(N, 2)
+        Returns:
+            Index of the region each point lies in, 0 being the background and i + 1 being shapes[i].
+        """
+        if self.cells is None:
+            return self.exact_regions(points)
+        cells = self.__cell_indexes(points)
+        regions = self.cells[cells[:, X], cells[:, Y]]
+        boundary = np.flatnonzero(regions < 0)
+        regions[boundary] = self.exact_regions(points[boundary])
+        return regions
+
+
+    def label(self, points: npt.NDArray):
+        """
+        Args:
+            points: Coordinates to label. shape=(N, 2)
+        Returns:
+            Particle value of each point.
+        """
+        return self.values[self.regions(points)]
@@ -1,8 +1,17 @@
-from scipy.spatial import cKDTree
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 import numpy.typing as npt
 import numpy as np
-import utility
+import hashlib
+import json
+import os
+import profiling
+import progress
+import exposure
+import lattice
+import sparse
+import core
+import shapes
 
 """
 This file implements the mathematics and physics related to the fluid simulation.
@@ -14,6 +23,293 @@ multi-dimensional arrays.
 X = 0
 Y = 1
 
+"""
+Default values of optional simulation parameters. These are applied before the parameters
+passed to the simulation so that existing configuration files do not need to specify them.
+    sampling: "uniform" draws particle coordinates uniformly over the whole domain and then
+              relabels them using the initial condition shapes. "stratified" samples each
+              shape and the background directly, with counts proportional to their areas.
+    shapes:   List of initial condition shape dictionaries (see shapes.create_shape),
+              applied after the circle and rectangle toggles.
+    shape_resolution: Largest number of cells along each axis of the grid used to label particles
+                      with the shape they lie in (see shapes.ShapeGrid). Smaller grids are used for
+                      small particle counts and no grid is used for a single shape.
+    profile:  Whether or not to record per-phase timing statistics (see profiling.Profiler).
+              The statistics are available through the 'stats' member.
+    profile_memory: Whether or not profiling also tracks the peak memory allocated by each phase.
+    seed:     Seed for the random number generator of the simulation. None uses a random seed.
+    kernel:   "numpy" updates particles using NumPy array operations. "numba" uses a compiled kernel
+              which performs the whole update in a single parallel loop (see kernels.py). It requires
+              numba to be installed and falls back to "numpy" if it is not.
+    threads:  Number of threads used by the "numpy" kernel to update and bin particles. Each thread
+              handles a slice of the particles with its own random number generator.
+    chunk_size: Number of particles processed at once by each thread, chosen so that
+                the working set of each operation fits in the CPU cache.
+    diffusivity_field_path: Path to a data file with [x, y, D] columns giving the diffusivity on a regular
+                            grid. None uses the 'diffusivity' parameter, which is either a single value or
+                            a list with the diffusivity of each species. The field is bilinearly interpolated
+                            and particles also drift by dt * grad(D) every step, without which they would gather
+                            where the diffusivity is low. Steps should be small compared to the field spacing
+                            (sqrt(2 * D * dt) much less than it) for sharp changes in diffusivity to be resolved.
+    integrator: "euler" moves particles using the Euler-Maruyama method, with the velocity sampled at the start
+                of each step. "heun" uses a predictor-corrector step for the advective part, averaging the
+                velocities at the start and at the predicted end of the step. This costs a second velocity
+                lookup but has a smaller time step error, allowing larger time steps for the same accuracy.
+    antithetic: Whether the diffusive noise of every particle is negated. A simulation and its antithetic
+                counterpart with the same seed form a pair whose average has a reduced variance.
+    velocity_scale: Factor which every vector of the velocity field is multiplied by (e.g. for sensitivity studies).
+    backend:  Simulation method used when created through backends.create_simulation ("particles", "eulerian"
+              or "shared", see backends.py).
+    processes: Number of worker processes of the "shared" backend. None uses the number of CPUs.
+    deposition: "nearest" assigns each particle to the concentration cell of its nearest grid node. "cic" (cloud in
+                cell) shares each particle between the 4 surrounding nodes using bilinear weights, which gives
+                smoother concentrations with a lower variance for the same number of particles.
+    sparse_concentrations: Whether the 'concentrations' member is a sparse.SparseGrid which only holds the cells with a
+                           non-zero concentration. The occupied cells are found without allocating any grid sized
+                           arrays, so the cost of each calculation scales with the number of particles rather than
+                           the number of cells. Species concentrations are not calculated in this mode.
+    pyramid_cell_sizes: List of additional [N_x, N_y] concentration grid sizes. The particles are binned once on the
+                        finest grid, from which the main grid and every additional grid are found exactly by summing
+                        the counts of neighbouring cells. Along each axis, the number of cells minus one of the finest
+                        grid must be an odd multiple of that of every other grid (see get_pyramid_base). The
+                        concentrations of each additional grid are stored in 'pyramid_concentrations', in order.
+    species_count: Number of particle species. Particle values (set by the initial condition shapes)
+                   are species ids from 0 to species_count - 1. With more than 2 species the concentration
+                   of every species is found in the same binning pass and stored in 'species_concentrations'.
+"""
+optional_parameters = {
+    "sampling": "uniform",
+    "shapes": [],
+    "shape_resolution": 512,
+    "profile": False,
+    "profile_memory": False,
+    "seed": None,
+    "kernel": "numpy",
+    "threads": 1,
+    "chunk_size": 16384,
+    "species_count": 2,
+    "diffusivity_field_path": None,
+    "integrator": "euler",
+    "antithetic": False,
+    "velocity_scale": 1.0,
+    "backend": "particles",
+    "processes": None,
+    "deposition": "nearest",
+    "pyramid_cell_sizes": [],
+    "sparse_concentrations": False
+}
+# Number of quadrature points per axis used to find the areas of initial condition regions
+# which cannot be found exactly (see get_region_fractions).
+area_resolution = 1024
+# Region area fractions found by quadrature, keyed by the shape list and domain they were found for.
+quadrature_fractions = {}
+# Largest number of cells of the grid which concentration grid pyramids are pooled from.
+max_pyramid_cells = 2 ** 24
+# Version of the simulation results, which is part of the key of every stored run (see get_run_key).
+# It must be increased whenever a change to the simulation changes its results, so stale results are not reused.
+cache_version = 1
+# Parameters which name data files, whose contents are part of the key of every stored run.
+data_file_parameters = ["velocity_field_path", "diffusivity_field_path", "reference_file_path"]
+# Hashes of the contents of data files, keyed by their path, modification time and size.
+file_hashes = {}
+
+
+def get_shape_list(parameters: Dict[str, any]):
+    """
+    Args:
+        parameters: Simulation parameters (with the optional parameters applied).
+    Returns:
+        List of initial condition shape dictionaries. The circle and rectangle toggles are converted into
+        shapes which come before any shapes in the 'shapes' list (so later entries take priority over them).
+    """
+    shape_list = []
+    if parameters["use_circle"]:
+        shape_list.append({"type": "circle", "value": parameters["circle_value"],
+                           "center": parameters["circle_center"], "radius": parameters["circle_radius"]})
+    if parameters["use_rectangle"]:
+        shape_list.append({"type": "rectangle", "value": parameters["rectangle_value"],
+                           "min": parameters["rectangle_min"], "max": parameters["rectangle_max"]})
+    return shape_list + parameters["shapes"]
+
+
+def get_file_hash(path: str):
+    """
+    Args:
+        path: Path of a data file.
+    Returns:
+        SHA-1 hash of the contents of the file, or None if it does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    status = os.stat(path)
+    key = (os.path.abspath(path), status.st_mtime_ns, status.st_size)
+    if key not in file_hashes:
+        with open(path, "rb") as file:
+            file_hashes[key] = hashlib.sha1(file.read()).hexdigest()
+    return file_hashes[key]
+
+
+def get_json_value(value: any):
+    """Converts NumPy scalars and arrays (which json cannot serialize) to the equivalent Python values."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+def get_run_key(parameters: Dict[str, any]):
+    """
+    Args:
+        parameters: Simulation parameters of a run.
+    Returns:
+        Hexadecimal key which identifies the results of the run, used for storing them (e.g. in the validation
+        cache or a parameter sweep). The optional parameters are applied first, so leaving out a parameter and
+        setting it to its default give the same key. The key also depends on the cache version and the contents
+        of every data file the run reads, so changing the simulation or a data file gives a new key.
+    """
+    defaulted = dict(optional_parameters)
+    defaulted.update(parameters)
+    paths = [defaulted[name] for name in data_file_parameters if defaulted.get(name) is not None]
+    paths += [shape["path"] for shape in defaulted["shapes"] if "path" in shape]
+    contents = {str(path): get_file_hash(path) for path in paths}
+    # NumPy scalars are converted to Python values, so for example np.int64(100) and 100 give the same key.
+    text = json.dumps({"version": cache_version, "parameters": defaulted, "files": contents},
+                      sort_keys=True, default=get_json_value)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def get_pyramid_base(cell_sizes: npt.ArrayLike, deposition: str = "nearest"):
+    """
+    Concentration cells are centred on the nodes of a grid spanning the domain, so a grid of N cells has
+    N - 1 intervals between nodes (and half width cells at the edges). Every cell of a grid with n intervals
+    is exactly a block of cells of a grid with m * n intervals if m is odd, as the cell boundaries (halfway
+    between nodes) of both grids then coincide. Along each axis, the base grid is therefore the finest grid,
+    whose intervals must be an odd multiple of those of every other grid. For example, a pyramid of 244, 82 and
+    28 cells works (243, 81 and 27 intervals), but halving the number of cells does not, as it gives even ratios.
+    With cloud in cell deposition any multiple works, as the bilinear weights of the coarse nodes are
+    linear combinations of those of the base nodes whenever the coarse nodes are also base nodes.
+    Args:
+        cell_sizes: [N_x, N_y] sizes of every concentration grid.
+        deposition: Deposition method of the simulation ("nearest" or "cic"). Defaults to "nearest".
+    Returns:
+        [N_x, N_y] size of the grid from which every grid is pooled.
+    """
+    cell_sizes = np.array(cell_sizes, dtype=np.int64)
+    base = np.max(cell_sizes, axis=0)
+    for axis in [X, Y]:
+        intervals = cell_sizes[:, axis][cell_sizes[:, axis] > 1] - 1
+        if intervals.size == 0:
+            continue
+        ratios = (base[axis] - 1) // intervals
+        allowed = (ratios * intervals == base[axis] - 1) & ((ratios % 2 == 1) | (deposition == "cic"))
+        assert np.all(allowed), \
+            "Concentration grid of " + str(intervals[~allowed][0] + 1) + " cells along " + "xy"[axis] + \
+            " cannot be pooled from the finest grid of " + str(base[axis]) + " cells, as the number of cells " + \
+            "minus one of the finest grid must be " + ("a" if deposition == "cic" else "an odd") + \
+            " multiple of that of every other grid (see get_pyramid_base)"
+    assert np.prod(base) <= max_pyramid_cells, \
+        "Concentration grid sizes require a pyramid base grid of " + str(list(base)) + " cells, which is too large"
+    return base
+
+
+def pool_histogram(histogram: npt.NDArray, base_size: npt.ArrayLike, cell_size: npt.ArrayLike,
+                   deposition: str = "nearest"):
+    """
+    Sums the cells of a histogram into the cells of a coarser grid (see get_pyramid_base).
+    Counts and sums are pooled rather than concentrations, so the result is the same as binning
+    the particles on the coarser grid directly.
+    Args:
+        histogram:  Value of each flattened cell of the base grid. shape=(cells,) or (cells, species_count)
+        base_size:  [N_x, N_y] size of the base grid.
+        cell_size:  [N_x, N_y] size of the coarser grid.
+        deposition: Deposition method the histogram was found with ("nearest" or "cic"). With "cic", each
+                    base node contributes to the neighbouring coarse nodes using the coarse bilinear weights.
+    Returns:
+        Value of each flattened cell of the coarser grid.
+    """
+    if np.array_equal(base_size, cell_size):
+        return histogram
+    pooled = np.reshape(histogram, (base_size[X], base_size[Y]) + histogram.shape[1:])
+    for axis in [X, Y]:
+        if deposition == "cic":
+            if cell_size[axis] == 1:
+                weights = np.ones((1, base_size[axis]))
+            else:
+                ratio = (base_size[axis] - 1) // (cell_size[axis] - 1)
+                distances = np.arange(base_size[axis]) - ratio * np.arange(cell_size[axis])[:, np.newaxis]
+                weights = np.maximum(0, 1 - np.abs(distances) / ratio)
+            pooled = np.moveaxis(np.tensordot(weights, pooled, axes=(1, axis)), 0, axis)
+            continue
+        if cell_size[axis] == 1:
+            starts = np.zeros(1, dtype=np.int64)
+        else:
+            # Base node i lies in the coarse cell of the nearest coarse node (never a tie as the ratio is odd).
+            ratio = (base_size[axis] - 1) // (cell_size[axis] - 1)
+            nodes = np.rint(np.arange(base_size[axis]) / ratio)
+            starts = np.searchsorted(nodes, np.arange(cell_size[axis]))
+        pooled = np.add.reduceat(pooled, starts, axis=axis)
+    return np.reshape(pooled, (np.prod(cell_size),) + histogram.shape[1:])
+
+
+def get_region_fractions(shape_grid: shapes.ShapeGrid, shape_list: List[Dict[str, any]]):
+    """
+    Finds the fraction of the domain covered by the background and by each initial condition shape (after
+    later shapes have been drawn over earlier ones). If every shape has an exact area (see shapes.Shape.area),
+    lies inside the domain and does not overlap the bounding box of any other shape, the fractions are
+    found directly from the areas. Otherwise they are found by labelling a fine grid of points covering the
+    domain, which is cached so that repeated simulations with the same shapes only do this once.
+    Args:
+        shape_grid: Grid used for labelling points with the shapes.
+        shape_list: Shape dictionaries the shapes were created from (used as the cache key).
+    Returns:
+        Area fraction of the background followed by that of each shape.
+    """
+    regions = shape_grid.shapes
+    domain_area = np.prod(shape_grid.max - shape_grid.min)
+    areas = [shape.area() for shape in regions]
+    inside = all(np.all(shape.min >= shape_grid.min) and np.all(shape.max <= shape_grid.max) for shape in regions)
+    disjoint = all(np.any(np.minimum(first.max, second.max) <= np.maximum(first.min, second.min))
+                   for index, first in enumerate(regions) for second in regions[index + 1:])
+    if None not in areas and inside and disjoint:
+        fractions = np.array(areas) / domain_area
+        return np.concatenate(([1 - np.sum(fractions)], fractions))
+    key = json.dumps([shape_list, shape_grid.min.tolist(), shape_grid.max.tolist()], sort_keys=True, default=str)
+    if key not in quadrature_fractions:
+        # Points at the centers of an area_resolution x area_resolution grid covering the domain.
+        centers = (np.arange(area_resolution) + 0.5) / area_resolution
+        x, y = np.meshgrid(centers, centers, indexing="ij")
+        quadrature = np.column_stack((x.ravel(), y.ravel())) * (shape_grid.max - shape_grid.min) + shape_grid.min
+        quadrature_fractions[key] = np.bincount(shape_grid.regions(quadrature),
+                                                minlength=len(regions) + 1) / quadrature.shape[0]
+    return quadrature_fractions[key]
+
+
+def run_steps(sim: any, print_time: bool = False, progress_reporter: progress.ProgressReporter = None,
+              exposure_tracker: exposure.ExposureTracker = None):
+    """Runs a simulation of any backend until completion, calling its update method once for each step
+       (see Simulation.simulate for the arguments).
+    Args:
+        sim: Simulation with the steps, dt and concentrations members and the update and
+             calculate_concentrations methods.
+    """
+    if progress_reporter is None and print_time:
+        progress_reporter = progress.ConsoleProgressReporter()
+    if progress_reporter is not None:
+        progress_reporter.start(sim.steps, sim.dt)
+    if exposure_tracker is not None:
+        exposure_tracker.update(sim.concentrations, 0.0)
+    for step in range(sim.steps):
+        sim.update()
+        if exposure_tracker is not None:
+            sim.calculate_concentrations()
+            exposure_tracker.update(sim.concentrations, (step + 1) * sim.dt)
+        if progress_reporter is not None:
+            progress_reporter.update(step + 1)
+            if progress_reporter.stopped:
+                break
+
+
 """
 The Simulation class initializes fluid particles and their coordinates in its constructor.
 The user can call the calculate_concentrations() method which will update the
@@ -31,7 +327,8 @@ class Simulation(object):
                         the user interface. Using a dictionary avoids having to pass each individual parameter
                         and store it. It also enables flexibility regarding passing differing initial conditions.
         """
-        # Members populated using the dictionary.
+        # Members populated using the dictionary (optional parameters first so they can be overriden).
+        self.__dict__.update(optional_parameters)
         self.__dict__.update(parameters)
         self.__validate_parameters()
         
@@ -39,6 +336,17 @@ class Simulation(object):
         self.min = np.array(self.min)
         self.max = np.array(self.max)
         self.cell_size = np.array(self.cell_size)
+        # Particles are binned on the pyramid base grid, which is the concentration grid if there is no pyramid.
+        self.pyramid_cell_sizes = [np.array(cell_size) for cell_size in self.pyramid_cell_sizes]
+        self.bin_size = self.cell_size
+        if len(self.pyramid_cell_sizes) > 0:
+            self.bin_size = get_pyramid_base([self.cell_size] + self.pyramid_cell_sizes, self.deposition)
+
+        # Phases of the simulation are timed through the profiler, which does nothing if profiling is off.
+        self.profiler = profiling.Profiler(self.profile_memory) if self.profile else profiling.null_profiler
+        self.stats = self.profiler.stats
+        # Every random number of the simulation is drawn from this generator.
+        self.rng = np.random.default_rng(self.seed)
 
         # Calculate the number of steps required to reach time max (and an extra step for t = 0).
         self.steps = int(self.time_max / self.dt) + 1
@@ -46,26 +354,77 @@ class Simulation(object):
         if self.use_velocity:
             # Read columns [0, 1] and [2, 3] of the data file as the
             # coordinates and vectors of the velocity field respectively.
-            self.velocity_coordinates, self.velocity_vectors = utility.read_data_file(self.velocity_field_path,
+            self.velocity_coordinates, self.velocity_vectors = core.read_data_file(self.velocity_field_path,
                                                                                       [0, 1], [2, 3])
             assert not isinstance(self.velocity_coordinates, type(None)), \
                 "Could not retrieve velocity coordinates from data file"
             assert not isinstance(self.velocity_vectors, type(None)), \
                 "Could not retrieve velocity vectors from data file"
-            """
-            A KDTree is a space partioning structure which allows the user to query any coordinate
-            using its nearest neighbors. This allows for the retrieval of velocity vectors for the
-            positions which may lie between those given in the velocity field data file.
-            """
-            self.spatial_velocity = cKDTree(self.velocity_coordinates)
+            self.velocity_vectors = self.velocity_scale * self.velocity_vectors
+            try:
+                # If the velocity field is given on a regular grid, the nearest velocity 
+                # vector of each particle can be found directly from its coordinates.
+                self.velocity_lattice = lattice.Lattice(self.velocity_coordinates, self.velocity_vectors)
+            except ValueError:
+                self.velocity_lattice = None
+                """
+                A KDTree is a space partioning structure which allows the user to query any coordinate
+                using its nearest neighbors. This allows for the retrieval of velocity vectors for the
+                positions which may lie between those given in the velocity field data file.
+                SciPy is only imported when it is needed, which keeps importing this file fast.
+                """
+                from scipy.spatial import cKDTree
+                self.spatial_velocity = cKDTree(self.velocity_coordinates)
+
+        if self.kernel == "numba":
+            # Importing numba is slow, so the kernels are only imported if they are used.
+            import kernels
+            if not kernels.available:
+                print("Numba is not installed, falling back to the NumPy kernel")
+                self.kernel = "numpy"
+            elif self.use_velocity and self.velocity_lattice is None:
+                print("Numba kernel requires a velocity field on a regular grid, " + 
+                      "falling back to the NumPy kernel")
+                self.kernel = "numpy"
 
-        self.__generate_random_particles()
+        # The standard deviation of the diffusive displacement, sqrt(2 * D * dt), is precomputed for each
+        # species, so per-species diffusivities only cost a lookup per particle during updates.
+        # Negative scales negate the noise. A diffusivity field is bilinearly interpolated instead, since the Ito
+        # form of the diffusion equation, dc/dt = div(D grad(c)), also moves particles by dt * grad(D) every step.
+        # The drift must be the gradient of the same continuous field the noise is scaled by, otherwise
+        # particles gather where the diffusivity is low.
+        self.noise_sign = -1 if self.antithetic else 1
+        self.noise_scales = self.noise_sign * np.sqrt(2 * np.broadcast_to(np.array(self.diffusivity, dtype=float),
+                                                                     self.species_count) * self.dt)
+        self.diffusivity_lattice = None
+        if self.diffusivity_field_path is not None:
+            diffusivity_coordinates, diffusivities = core.read_data_file(self.diffusivity_field_path,
+                                                                            [0, 1], [2])
+            assert not isinstance(diffusivities, type(None)), \
+                "Could not retrieve diffusivities from data file"
+            assert np.all(diffusivities >= 0), "Diffusivity field must be greater than or equal to 0"
+            # The diffusivity field must be given on a regular grid (a ValueError is raised otherwise).
+            self.diffusivity_lattice = lattice.Lattice(diffusivity_coordinates, diffusivities)
 
-        if self.use_circle:
-            self.__add_circle(self.circle_center, self.circle_radius, self.circle_value)
+        # Flattened concentration cell index of each particle, computed by the numba kernel during updates.
+        self.cell_indexes = None
 
-        if self.use_rectangle:
-            self.__add_rectangle(self.rectangle_min, self.rectangle_max, self.rectangle_value)
+        if self.threads > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+            # Independent random number streams for each thread, derived from the simulation generator.
+            self.thread_generators = [np.random.default_rng(seed) for seed in
+                                      np.random.SeedSequence(self.rng.integers(2 ** 63)).spawn(self.threads)]
+
+        self.__create_shape_grid()
+
+        if self.sampling == "stratified":
+            self.__generate_stratified_particles()
+        else:
+            self.__generate_random_particles()
+            # All shapes are applied in a single labelling pass over the particles.
+            self.particles = self.shape_grid.label(self.coordinates)
+        assert np.all((self.particles >= 0) & (self.particles < self.species_count)), \
+            "Shape values must be species ids between 0 and species_count - 1"
 
         if self.optimized:
             """
@@ -79,6 +438,7 @@ class Simulation(object):
             self.particles = np.delete(self.particles, red_indexes)
             self.coordinates = np.delete(self.coordinates, red_indexes, axis=0)
             self.average_density = self.particles.size / np.prod(self.cell_size)
+            self.pyramid_densities = [self.particles.size / np.prod(size) for size in self.pyramid_cell_sizes]
 
         # Calculating the concentrations at t = 0 ensures that the 
         # concentrations member is set before the simulation starts.
@@ -95,59 +455,178 @@ class Simulation(object):
         assert self.particle_count > 0,   "Particle count must be greater than 0"
         assert self.cell_size[X] > 0,     "Cell width must be greater than 0"
         assert self.cell_size[Y] > 0,     "Cell height must be greater than 0"
-        assert self.diffusivity >= 0,     "Diffusivity must be greater than or equal to 0"
+        assert self.deposition in ["nearest", "cic"], "Deposition must be either 'nearest' or 'cic'"
+        assert all(np.all(np.array(size) > 0) for size in self.pyramid_cell_sizes), \
+            "Pyramid cell sizes must be greater than 0"
+        assert not (self.sparse_concentrations and len(self.pyramid_cell_sizes) > 0), \
+            "Sparse concentrations cannot be combined with pyramid cell sizes"
+        assert np.all(np.array(self.diffusivity) >= 0), "Diffusivity must be greater than or equal to 0"
+        assert np.ndim(self.diffusivity) == 0 or len(self.diffusivity) == self.species_count, \
+            "Diffusivity must be a single value or have one value per species"
+        assert self.sampling in ["uniform", "stratified"], \
+            "Sampling must be either 'uniform' or 'stratified'"
+        assert self.shape_resolution > 0, "Shape resolution must be greater than 0"
+        assert self.kernel in ["numpy", "numba"], "Kernel must be either 'numpy' or 'numba'"
+        assert self.integrator in ["euler", "heun"], "Integrator must be either 'euler' or 'heun'"
+        assert self.threads > 0,          "Thread count must be greater than 0"
+        assert self.chunk_size > 0,       "Chunk size must be greater than 0"
+        assert self.species_count >= 2,   "Species count must be at least 2"
+        assert not (self.optimized and self.species_count > 2), \
+            "Task E optimization only supports 2 species (red and blue)"
 
 
     def __generate_random_particles(self):
         # Standardize random particle coordinates to the specified min and max domain.
-        self.coordinates = np.random.rand(self.particle_count, 2) * (self.max - self.min) + self.min
+        self.coordinates = self.rng.random((self.particle_count, 2)) * (self.max - self.min) + self.min
         
         # Each coordinate 'shares' an index in the below array which represents the
         # value of the particle (0 and 1 for red and blue respectively).
         self.particles = np.zeros(self.particle_count, dtype=int)
 
 
-    def __add_rectangle(self, minimum: List[float], maximum: List[float], value: int):
-        """Adds a rectangle to the particle field.
+    def __create_shape_grid(self):
+        """
+        Creates the grid used for labelling particles with the initial condition shapes.
+        """
+        shape_list = [shapes.create_shape(info) for info in get_shape_list(self.__dict__)]
+        # Labelling the grid costs about as much as labelling one particle per cell, so the grid has at most
+        # about as many cells as there are particles. A single shape is checked directly (see shapes.ShapeGrid).
+        resolution = 0
+        if len(shape_list) > 1:
+            resolution = int(min(self.shape_resolution, max(1, np.sqrt(self.particle_count))))
+        self.shape_grid = shapes.ShapeGrid(shape_list, self.min, self.max, resolution)
+
+
+    def __generate_stratified_particles(self):
+        """
+        Samples the background and each initial condition shape directly rather than relabelling
+        uniformly drawn particles. Each region receives a number of particles proportional to its
+        area, which removes the statistical fluctuation in how many particles start inside each shape.
+        """
+        regions = self.shape_grid.shapes
+        # Region areas are independent of the particle count.
+        fractions = get_region_fractions(self.shape_grid, get_shape_list(self.__dict__))
+
+        # Distribute the particle count proportionally to the region areas, giving
+        # any particles lost to rounding to the regions with the largest remainders.
+        counts = np.floor(fractions * self.particle_count).astype(int)
+        remainders = fractions * self.particle_count - counts
+        counts[np.argsort(-remainders)[:self.particle_count - np.sum(counts)]] += 1
+
+        # Shape bounds are clipped to the domain so that no candidates are wasted outside of it.
+        bounds = [(self.min, self.max)] + [(np.maximum(shape.min, self.min), np.minimum(shape.max, self.max))
+                                           for shape in regions]
+        coordinates = []
+        for index, count in enumerate(counts):
+            if count > 0:
+                minimum, maximum = bounds[index]
+                coordinates.append(self.__sample_region(index, count, minimum, maximum, fractions[index]))
+        self.coordinates = np.concatenate(coordinates)
+        self.particles = np.repeat(self.shape_grid.values, counts)
+
+
+    def __sample_region(self, index: int, count: int, minimum: npt.NDArray,
+                        maximum: npt.NDArray, fraction: float):
+        """Draws stratified particle coordinates which lie inside a single region.
         Args:
-            minimum: Left and bottom bounds of the rectangle respectively.
-            maximum: Right and top bounds of the rectangle respectively.
-            value:   Particle value to be set inside rectangle bounds.
+            index:    Index of the region to sample (see shapes.ShapeGrid.regions).
+            count:    Number of particle coordinates to return.
+            minimum:  Left and bottom bounds of the region respectively.
+            maximum:  Right and top bounds of the region respectively.
+            fraction: Fraction of the domain area covered by the region.
+        Returns:
+            Array of particle coordinates. shape=(count, 2)
         """
-        # Find any points that lie within the x and y bounds of the rectangle.
-        in_x_bound = np.logical_and(self.coordinates[:, X] >= minimum[X], 
-                                    self.coordinates[:, X] <= maximum[X])
-        in_y_bound = np.logical_and(self.coordinates[:, Y] >= minimum[Y],
-                                    self.coordinates[:, Y] <= maximum[Y])
-        # Set points which lie within both bounds to the desired rectangle value.
-        self.particles = np.where(np.logical_and(in_x_bound, in_y_bound), value, self.particles)
+        extent = maximum - minimum
+        # Fraction of the bounding box covered by the region, used to oversample
+        # so that usually a single pass produces enough accepted coordinates.
+        acceptance = fraction * np.prod(self.max - self.min) / np.prod(extent)
+        samples = []
+        remaining = count
+        while remaining > 0:
+            candidates = int(np.ceil(remaining / max(acceptance, 1e-3) * 1.1)) + 16
+            columns = max(1, min(candidates, int(round(np.sqrt(candidates * extent[X] / extent[Y])))))
+            points = self.__get_stratified_points(candidates, columns, candidates // columns) * extent + minimum
+            # Shuffle the accepted points so that truncating them does not favour any strata.
+            accepted = self.rng.permutation(points[self.shape_grid.regions(points) == index])
+            samples.append(accepted[:remaining])
+            remaining -= samples[-1].shape[0]
+        return np.concatenate(samples)
 
 
-    def __add_circle(self, center: List[float], radius: float, value: int):
-        """Adds a circle to the particle field.
+    def __get_stratified_points(self, count: int, columns: int, rows: int):
+        """Generates points in the unit square with one randomly placed point per stratum of a columns x rows grid.
         Args:
-            center: Center x and y coordinates of the rectangle.
-            radius: Radius of the circle.
-            value:  Particle value to be set inside circle bounds.
+            count:   Total number of points to generate. Points which do not fill 
+                     a complete grid of strata are distributed uniformly.
+            columns: Number of strata along the x axis.
+            rows:    Number of strata along the y axis.
+        Returns:
+            Array of points. shape=(count, 2)
         """
-        # Find the squared Euclidean distances of each particle coordinate to the center of the circle.
-        distances = (self.coordinates[:, X] - center[X]) ** 2 + \
-                    (self.coordinates[:, Y] - center[Y]) ** 2
-        # Set points which lie within the squared radius bound to the desired circle value.
-        self.particles = np.where(distances <= radius ** 2, value, self.particles)
+        x, y = np.meshgrid(np.arange(columns), np.arange(rows))
+        strata = np.column_stack((x.ravel(), y.ravel()))
+        points = (strata + self.rng.random(strata.shape)) / [columns, rows]
+        return np.concatenate((points, self.rng.random((count - points.shape[0], 2))))
 
 
-    def __compute_lagrangian(self, velocities: npt.ArrayLike):
-        """Performs the Lagrangian computation in 2 dimensions for each of the particles.
+    def __get_velocities(self, coordinates: npt.NDArray, workers: int = -1):
+        """
+        Args:
+            coordinates: Coordinates to find the velocities of.
+            workers:     Number of threads used when querying the KDTree. Defaults to -1 (all threads).
+        Returns:
+            Velocity vector of the nearest velocity field node to each coordinate.
+        """
+        if self.velocity_lattice is not None:
+            return self.velocity_lattice.lookup(coordinates)
+        _, indexes = self.spatial_velocity.query(coordinates, workers=workers)
+        return self.velocity_vectors[indexes]
+
+
+    def __scale_noise(self, noise: npt.NDArray, coordinates: npt.NDArray, particles: npt.NDArray):
+        """Turns standard normal noise into the diffusive displacement of each particle (in place).
+        Args:
+            noise:       Standard normal noise of each particle. shape=(N, 2)
+            coordinates: Particle coordinates to find the diffusivities at.
+            particles:   Species of each particle.
+        """
+        if self.diffusivity_lattice is not None:
+            # Noise scaled by sqrt(2 * D * dt) plus the drift dt * grad(D) of the interpolated field.
+            diffusivities, gradients = self.diffusivity_lattice.interpolate(coordinates)
+            noise *= self.noise_sign * np.sqrt(2 * diffusivities * self.dt)[:, np.newaxis]
+            noise += gradients * self.dt
+        elif np.ndim(self.diffusivity) == 0:
+            noise *= self.noise_scales[0]
+        else:
+            noise *= self.noise_scales[particles][:, np.newaxis]
+
+
+    def __compute_lagrangian(self, coordinates: npt.NDArray, particles: npt.NDArray,
+                             velocities: npt.ArrayLike, rng: np.random.Generator, workers: int = -1):
+        """Performs the Lagrangian computation in 2 dimensions for each of the particles (in place).
         Args:
-            velocities: Either a 2D (x, y) array of velocities for each coordinate or 0 for no velocity.
+            coordinates: Particle coordinates to update.
+            particles:   Species of each particle (used for per-species diffusivities).
+            velocities:  Either a 2D (x, y) array of velocities for each coordinate or 0 for no velocity.
+            rng:         Random number generator used for the diffusive noise.
+            workers:     Number of threads used for velocity lookups. Defaults to -1 (all threads).
         """
-        self.coordinates += velocities * self.dt + \
-                            np.sqrt([2 * self.diffusivity * self.dt]) * \
-                            np.random.standard_normal(size=self.coordinates.shape)
+        with self.profiler.phase("noise", coordinates.shape[0]):
+            noise = rng.standard_normal(size=coordinates.shape)
+            self.__scale_noise(noise, coordinates, particles)
+        if self.integrator == "heun" and self.use_velocity:
+            with self.profiler.phase("velocity_lookup", coordinates.shape[0]):
+                # Predict the end of the step using the Euler method (including the same noise) and
+                # correct the velocity to the average of the velocities at the start and end of the step.
+                predicted = coordinates + velocities * self.dt + noise
+                self.__enforce_boundary_conditions(predicted)
+                velocities = 0.5 * (velocities + self.__get_velocities(predicted, workers))
+        with self.profiler.phase("lagrangian", coordinates.shape[0]):
+            coordinates += velocities * self.dt + noise
 
 
-    def __enforce_boundary_conditions(self):
+    def __enforce_boundary_conditions(self, coordinates: npt.NDArray):
         """
         Ensures that any particles moved past the bounds of the container are
         bounced off of the boundary of the container by the exceeded distance.
@@ -156,22 +635,24 @@ class Simulation(object):
         to the second hit bound. This may occur at the corners of the container or
         if the time step is large enough to move the particle a sizeable distance
         in one simulation step.
+        Args:
+            coordinates: Particle coordinates to update (in place).
         """
         # Regular bounce.
-        self.coordinates[:] = np.where(self.coordinates < self.min, 
-                                       self.min + (self.min - self.coordinates), 
-                                       self.coordinates)
-        self.coordinates[:] = np.where(self.coordinates > self.max,
-                                       self.max + (self.max - self.coordinates),
-                                       self.coordinates)
+        coordinates[:] = np.where(coordinates < self.min, 
+                                  self.min + (self.min - coordinates), 
+                                  coordinates)
+        coordinates[:] = np.where(coordinates > self.max,
+                                  self.max + (self.max - coordinates),
+                                  coordinates)
 
         # Edge case for second bounces.
-        self.coordinates[:] = np.where(self.coordinates < self.min, 
-                                       self.min,
-                                       self.coordinates)
-        self.coordinates[:] = np.where(self.coordinates > self.max, 
-                                       self.max,
-                                       self.coordinates)
+        coordinates[:] = np.where(coordinates < self.min, 
+                                  self.min,
+                                  coordinates)
+        coordinates[:] = np.where(coordinates > self.max, 
+                                  self.max,
+                                  coordinates)
 
 
     def update(self):
@@ -179,72 +660,330 @@ class Simulation(object):
         This function encapsulates all the desired steps to be applied to
         particles in order to move them one simulation step forward in time.
         
-        The cKDTree query call in this method is the bottleneck of the simulation.
-        The number of these calls can be reduced by decreasing the number of queried
-        coordinates (i.e. particles) in the simulation, as is done in Task E.
+        The velocity lookup is the bottleneck of the simulation, especially if the velocity field is
+        not on a regular grid and a cKDTree query is required. The number of lookups can be reduced by 
+        decreasing the number of queried coordinates (i.e. particles) in the simulation, as is done in Task E.
         """
+        if self.kernel == "numba":
+            self.__fused_update()
+            return
+        # Any cell indexes computed by the numba kernel are out of date once particles move.
+        self.cell_indexes = None
+        if self.threads > 1:
+            # Each thread updates its own slice of the particles using its own random number generator.
+            list(self.executor.map(self.__update_slice, self.__get_slice_bounds(), self.thread_generators))
+            return
         if self.use_velocity:
-            # workers=-1 ensures that all CPU threads are used when querying the KDTree.
-            _, indexes = self.spatial_velocity.query(self.coordinates, workers=-1)
-            velocities = self.velocity_vectors[indexes]
-            self.__compute_lagrangian(velocities)
+            with self.profiler.phase("velocity_lookup", self.coordinates.shape[0]):
+                velocities = self.__get_velocities(self.coordinates)
+            self.__compute_lagrangian(self.coordinates, self.particles, velocities, self.rng)
         else:
-            self.__compute_lagrangian(0)
+            self.__compute_lagrangian(self.coordinates, self.particles, 0, self.rng)
+
+        with self.profiler.phase("boundary", self.coordinates.shape[0]):
+            self.__enforce_boundary_conditions(self.coordinates)
 
-        self.__enforce_boundary_conditions()
 
+    def __get_slice_bounds(self):
+        """Returns the [start, end) particle indexes of the contiguous slice handled by each thread."""
+        bounds = np.linspace(0, self.coordinates.shape[0], self.threads + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
 
-    def simulate(self, print_time: bool = False):
+
+    def __update_slice(self, bounds: any, rng: np.random.Generator):
+        """
+        Updates a slice of particles one block at a time. Blocks of chunk_size particles keep the
+        temporary arrays of each operation small enough to stay in the CPU cache. NumPy releases the
+        GIL during these operations, which allows the threads to run in parallel.
+        Args:
+            bounds: [start, end) particle indexes of the slice.
+            rng:    Random number generator of the thread.
+        """
+        for start in range(bounds[0], bounds[1], self.chunk_size):
+            # Slicing creates a view, so the block is updated in place.
+            end = min(start + self.chunk_size, bounds[1])
+            block = self.coordinates[start:end]
+            if self.use_velocity:
+                with self.profiler.phase("velocity_lookup", block.shape[0]):
+                    velocities = self.__get_velocities(block, workers=1)
+                self.__compute_lagrangian(block, self.particles[start:end], velocities, rng, workers=1)
+            else:
+                self.__compute_lagrangian(block, self.particles[start:end], 0, rng)
+            with self.profiler.phase("boundary", block.shape[0]):
+                self.__enforce_boundary_conditions(block)
+
+
+    def __fused_update(self):
+        """Performs the update using the compiled kernel, which also computes each particle's cell index."""
+        if self.cell_indexes is None or self.cell_indexes.size != self.coordinates.shape[0]:
+            self.cell_indexes = np.empty(self.coordinates.shape[0], dtype=np.int64)
+            # The kernel random number stream is seeded from the simulation generator.
+            self.kernel_seed = np.uint64(self.rng.integers(2 ** 63))
+            self.kernel_step = 0
+        if self.use_velocity:
+            velocity_grid = self.velocity_lattice.grid
+            origin, spacing = self.velocity_lattice.origin, self.velocity_lattice.spacing
+        else:
+            velocity_grid, origin, spacing = np.zeros((1, 1, 2)), np.zeros(2), np.ones(2)
+        if self.diffusivity_lattice is not None:
+            noise_grid = self.diffusivity_lattice.grid
+            noise_origin, noise_spacing = self.diffusivity_lattice.origin, self.diffusivity_lattice.spacing
+        else:
+            noise_grid, noise_origin, noise_spacing = np.zeros((2, 2)), np.zeros(2), np.ones(2)
+        import kernels
+        with self.profiler.phase("fused_step", self.coordinates.shape[0]):
+            kernels.fused_step(self.coordinates, self.particles, velocity_grid, origin, spacing,
+                               self.use_velocity, self.integrator == "heun", self.noise_scales,
+                               noise_grid, noise_origin, noise_spacing, self.diffusivity_lattice is not None,
+                               float(self.noise_sign), self.dt,
+                               self.min.astype(float), self.max.astype(float), self.bin_size,
+                               self.cell_indexes, self.kernel_seed, np.uint64(self.kernel_step))
+        self.kernel_step += 1
+
+
+    def simulate(self, print_time: bool = False, progress_reporter: progress.ProgressReporter = None,
+                 exposure_tracker: exposure.ExposureTracker = None):
         """Runs the simulation until completion, calling the update method once for each
            step of the simulation.
         Args:
-            print_time: Whether or not to print the current time step of the simulation
-                        in the console. Keeps the user aware of simulation progress.
+            print_time:        Whether or not to print the progress of the simulation in the console.
+                               Keeps the user aware of simulation progress. Printing is rate limited
+                               (see progress.ConsoleProgressReporter) so it does not slow the simulation.
+            progress_reporter: Reporter which is updated after every step. Defaults to None, which
+                               uses a console reporter if print_time is True and no reporting otherwise.
+                               The simulation stops early if the reporter is stopped (see progress.py).
+            exposure_tracker:  Tracker which is updated with the concentrations after every step
+                               (which requires calculating them every step). Defaults to None.
         """
-        for step in range(self.steps):
-            if print_time:
-                print("Simulation time: " + str(round(step * self.dt, 3)))
-            self.update()
+        run_steps(self, print_time, progress_reporter, exposure_tracker)
 
 
-    def calculate_concentrations(self):
+    def __get_cell_indexes(self, coordinates: npt.NDArray):
         """
         In order to find the concentration grid the particle coordinates are first standardized 
-        to a [0, 0] -> [1, 1] domain and then a [0, 0] -> [N_x - 1, N_y - 1] integer domain.
+        to a [0, 0] -> [1, 1] domain and then a [0, 0] -> [N_x - 1, N_y - 1] integer domain
+        (where N is the size of the grid the particles are binned on, see get_pyramid_base).
         This maintains each particle's relative position while mapping them to cell indexes.
+        The cell indexes are then flattened into one dimensional form using the equation:
+            index = x * height + y
+        Args:
+            coordinates: Particle coordinates to find the cell indexes of.
+        Returns:
+            Flattened cell index of each particle.
+        """
+        standardized = (coordinates - self.min) / (self.max - self.min)
+        cells = np.round(standardized * (self.bin_size - 1), decimals=0).astype(int)
+        return cells[:, X] * self.bin_size[Y] + cells[:, Y]
+
+
+    def __get_cell_weights(self, coordinates: npt.NDArray):
+        """
+        Cloud in cell version of __get_cell_indexes. Each particle lies between 4 nodes of the grid, which
+        are weighted by how close the particle is to them along each axis (bilinear interpolation weights).
+        Particles between the outermost nodes and the domain bounds are not possible, so the edge nodes
+        only receive weight from one side, which matches their half width cells.
+        Args:
+            coordinates: Particle coordinates to find the cell indexes and weights of.
+        Returns:
+            Flattened cell indexes and weights of the 4 nodes surrounding each particle. shape=(4, N)
+        """
+        standardized = (coordinates - self.min) / (self.max - self.min)
+        positions = standardized * (self.bin_size - 1)
+        # The lower node is kept below the last node so that particles on the upper bound have weight 0
+        # on the node past the grid (and along an axis with a single cell every weight goes to node 0).
+        lower = np.clip(np.floor(positions), 0, np.maximum(self.bin_size - 2, 0)).astype(int)
+        upper = np.minimum(lower + 1, self.bin_size - 1)
+        fraction = positions - lower
+        indexes = np.array([lower[:, X] * self.bin_size[Y] + lower[:, Y],
+                            upper[:, X] * self.bin_size[Y] + lower[:, Y],
+                            lower[:, X] * self.bin_size[Y] + upper[:, Y],
+                            upper[:, X] * self.bin_size[Y] + upper[:, Y]])
+        weights = np.array([(1 - fraction[:, X]) * (1 - fraction[:, Y]),
+                            fraction[:, X] * (1 - fraction[:, Y]),
+                            (1 - fraction[:, X]) * fraction[:, Y],
+                            fraction[:, X] * fraction[:, Y]])
+        return indexes, weights
+
+
+    def __deposit_slice(self, bounds: any):
+        """
+        Cloud in cell version of __bin_slice, which sums the particle weights (instead of counts) and the
+        weighted particle values of each cell.
+        Args:
+            bounds: [start, end) particle indexes of the slice.
+        Returns:
+            Summed particle weights and weighted particle values of each flattened cell (see __bin_slice).
+        """
+        start, end = bounds
+        cells = np.prod(self.bin_size)
+        count = np.zeros(cells)
+        weighted = None
+        if not self.optimized:
+            weighted = np.zeros((cells, self.species_count) if self.species_count > 2 else cells)
+        for block in range(start, end, self.chunk_size):
+            block_end = min(block + self.chunk_size, end)
+            indexes, weights = self.__get_cell_weights(self.coordinates[block:block_end])
+            count += np.bincount(indexes.ravel(), weights.ravel(), minlength=cells)
+            if self.optimized:
+                continue
+            values = np.broadcast_to(self.particles[block:block_end], indexes.shape)
+            if self.species_count > 2:
+                weighted += np.reshape(np.bincount((indexes * self.species_count + values).ravel(), weights.ravel(),
+                                                   minlength=cells * self.species_count), weighted.shape)
+            else:
+                weighted += np.bincount(indexes.ravel(), (weights * values).ravel(), minlength=cells)
+        return count, weighted
+
+
+    def __bin_slice(self, bounds: any):
         """
-        standardized = (self.coordinates - self.min) / (self.max - self.min)
-        cells = np.round(standardized * (self.cell_size - 1), decimals=0).astype(int)
+        Counts the particles and sums the particle values in each cell for a slice of particles.
+        Cell indexes are computed one block at a time so that their temporaries stay in the CPU cache.
+        Args:
+            bounds: [start, end) particle indexes of the slice.
+        Returns:
+            Particle counts and summed particle values (None for Task E) of each flattened cell.
+            With more than 2 species, the particle counts of each species are returned instead of the
+            summed values. shape=(cells, species_count)
+        """
+        if self.deposition == "cic":
+            return self.__deposit_slice(bounds)
+        start, end = bounds
+        if self.cell_indexes is not None:
+            indexes = self.cell_indexes[start:end]
+        else:
+            indexes = np.empty(end - start, dtype=int)
+            for block in range(start, end, self.chunk_size):
+                block_end = min(block + self.chunk_size, end)
+                indexes[block - start:block_end - start] = self.__get_cell_indexes(self.coordinates[block:block_end])
+        count = np.bincount(indexes, minlength=np.prod(self.bin_size))
+        if self.optimized:
+            weighted = None
+        elif self.species_count > 2:
+            # Combining the cell index and species id counts every species of every cell in one pass.
+            weighted = np.bincount(indexes * self.species_count + self.particles[start:end],
+                                   minlength=count.size * self.species_count)
+            weighted = np.reshape(weighted, (count.size, self.species_count))
+        else:
+            weighted = np.bincount(indexes, self.particles[start:end], minlength=count.size)
+        return count, weighted
+
 
+    def bin_particles(self):
         """
-        The number of unique cell indexes is then counted which allows the program to know how many 
-        particles are in each cell of the concentration grid. The average of the weighted sum of
-        particles (see np.bincount) in each cell gives us the concentration of the cell.
+        The number of particles in each cell of the concentration grid is counted (see np.bincount)
+        using the flattened cell indexes of the particles (see __get_cell_indexes).
+
+        If the numba kernel is used, the cell indexes were already computed during the update. If multiple
+        threads are used, each thread bins its own slice and the partial histograms are summed at the end.
+        Returns:
+            Particle counts and summed particle values (None for Task E) of each flattened cell.
         """
-        unique, indexes, count = np.unique(cells, return_inverse=True, return_counts=True, axis=0)
+        with self.profiler.phase("binning", self.coordinates.shape[0]):
+            if self.threads > 1:
+                partials = list(self.executor.map(self.__bin_slice, self.__get_slice_bounds()))
+                count = np.sum([partial[0] for partial in partials], axis=0)
+                weighted = None if self.optimized else np.sum([partial[1] for partial in partials], axis=0)
+                return count, weighted
+            return self.__bin_slice((0, self.coordinates.shape[0]))
+
+
+    def calculate_concentrations(self, binned: Tuple[npt.NDArray, npt.NDArray] = None):
+        """
+        The average of the weighted sum of particles in each cell gives us the concentration of the cell.
+        If pyramid cell sizes are given, the concentrations of every grid are found from the same histogram.
+        Args:
+            binned: Particle counts and summed particle values of each flattened cell (see bin_particles).
+                    Defaults to None, which bins the particles of this simulation. Passing the binned
+                    values allows histograms summed across several simulations to be converted.
+        """
+        if self.sparse_concentrations:
+            assert binned is None, "Binned particles cannot be converted to sparse concentrations"
+            self.concentrations, self.species_concentrations = self.__get_sparse_concentrations(), None
+            self.pyramid_concentrations = []
+            return
+        count, weighted = self.bin_particles() if binned is None else binned
+        self.concentrations, self.species_concentrations = self.__get_concentrations(
+            count, weighted, self.cell_size, self.average_density if self.optimized else None)
+        self.pyramid_concentrations = [self.__get_concentrations(count, weighted, cell_size,
+                                                                 self.pyramid_densities[index] if self.optimized
+                                                                 else None)[0]
+                                       for index, cell_size in enumerate(self.pyramid_cell_sizes)]
+
+
+    def __get_sparse_concentrations(self):
+        """
+        The cells containing particles are found by sorting the cell indexes of the particles (see np.unique),
+        and the particles are then binned into those cells only.
+        Returns:
+            Concentrations of the cells with a non-zero concentration (see sparse.SparseGrid).
+        """
+        with self.profiler.phase("binning", self.coordinates.shape[0]):
+            # The concentrations are those of species 1 ('blue'), as with dense concentrations.
+            values = self.particles if self.species_count == 2 else (self.particles == 1)
+            if self.deposition == "cic":
+                indexes, weights = self.__get_cell_weights(self.coordinates)
+                values = (weights * values).ravel()
+                weights = weights.ravel()
+            else:
+                indexes = self.cell_indexes if self.cell_indexes is not None else \
+                          self.__get_cell_indexes(self.coordinates)
+                weights = None
+            cells, inverse = np.unique(indexes.ravel(), return_inverse=True)
+            count = np.bincount(inverse, weights, minlength=cells.size)
+            if self.optimized:
+                concentrations = count / self.average_density
+            else:
+                weighted = np.bincount(inverse, values, minlength=cells.size)
+                concentrations = np.divide(weighted, count, out=np.zeros(cells.size), where=count > 0)
+        concentrations = np.minimum(concentrations, 1.0)
+        occupied = concentrations > 0
+        cells, concentrations = cells[occupied], concentrations[occupied]
+        # Flattened (x, y) indexes are converted to the rows and columns of the rotated dense grid.
+        x, y = np.divmod(cells, self.cell_size[Y])
+        rows = self.cell_size[Y] - 1 - y
+        return sparse.SparseGrid((self.cell_size[Y], self.cell_size[X]), rows * self.cell_size[X] + x,
+                                 concentrations)
+
+
+    def __get_concentrations(self, count: npt.NDArray, weighted: npt.NDArray, cell_size: npt.NDArray,
+                             average_density: float):
+        """
+        Args:
+            count:           Particle counts of each flattened cell of the binning grid.
+            weighted:        Summed particle values of each flattened cell of the binning grid.
+            cell_size:       [N_x, N_y] size of the concentration grid.
+            average_density: Average number of particles per cell at the start of the simulation (Task E only).
+        Returns:
+            Concentration grid and the concentration grid of each species (None unless there are more than 2).
+        """
+        count = pool_histogram(count, self.bin_size, cell_size, self.deposition)
+        species_concentrations = None
         if self.optimized:
             """
             For Task E, the concentration is estimated by considering just the number of 'blue' particles
             relative to the average density of 'blue' particles per cell at the beginning of the simulation.
             """
-            flat_concentrations = count / self.average_density
+            concentrations = count / average_density
+        elif self.species_count > 2:
+            weighted = pool_histogram(weighted, self.bin_size, cell_size, self.deposition)
+            fractions = np.divide(weighted, count[:, np.newaxis], out=np.zeros(weighted.shape),
+                                  where=count[:, np.newaxis] > 0)
+            # Each species grid is reshaped and rotated in the same way as the concentration grid below.
+            species_concentrations = np.rot90(np.reshape(fractions.T, (self.species_count, *cell_size)),
+                                              axes=(1, 2))
+            # The concentrations member stores species 1 ('blue') as it does with 2 species.
+            concentrations = fractions[:, 1]
         else:
-            flat_concentrations = np.bincount(indexes, self.particles) / count
-        """
-        An edge case for no particles in a cell must be considered. This could statistically occur no matter
-        the number of particles in the simulation as all particles could move out of a cell in one step.
-        We will assume that no particles in a cell will give it a concentration value of 0. 
-        
-        To create a complete concentration grid, a flattened array of 0s with size Nx * Ny is created.
-        The indexes with unique particles can be found in one dimensional form using the equation:
-            index = x * width + y
-        The concentrations at those indexes are then set, keeping the empty cells as 0.
-        """
-        self.concentrations = np.zeros(np.prod(self.cell_size))
-        occurences = unique[:, X] * self.cell_size[Y] + unique[:, Y]
-        self.concentrations[occurences] = flat_concentrations
+            """
+            An edge case for no particles in a cell must be considered. This could statistically occur no matter
+            the number of particles in the simulation as all particles could move out of a cell in one step.
+            We will assume that no particles in a cell will give it a concentration value of 0.
+            """
+            weighted = pool_histogram(weighted, self.bin_size, cell_size, self.deposition)
+            concentrations = np.divide(weighted, count, out=np.zeros(count.size), where=count > 0)
         # Cap concentrations at 1.0 for the optimized case as concentration found
         # to be above the average at the start of the simulation is just a full cell.
-        self.concentrations = np.where(self.concentrations > 1.0, 1.0, self.concentrations)
+        concentrations = np.where(concentrations > 1.0, 1.0, concentrations)
         # A 90 degree rotation and reshape to 2D is required due to how the indexes were computed in 1D.
-        self.concentrations = np.rot90(np.reshape(self.concentrations, self.cell_size))
\ No newline at end of file
+        return np.rot90(np.reshape(concentrations, cell_size)), species_concentrations
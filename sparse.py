@@ -0,0 +1,69 @@
+import numpy.typing as npt
+import numpy as np
+
+"""
+This file implements a sparse representation of concentration grids, which only stores the cells with a
+non-zero concentration. A localized spill on a very large grid only covers a small fraction of its cells,
+so finding, storing and tracking its concentrations this way scales with the size of the spill rather
+than the size of the domain (see the 'sparse_concentrations' simulation parameter).
+"""
+
+"""
+The SparseGrid class stores the non-zero cells of a concentration grid as flattened indexes into the
+grid (in the same orientation as the dense concentration grids, i.e. as plotted) and their values.
+"""
+class SparseGrid(object):
+    def __init__(self, shape: any, indexes: npt.NDArray, values: npt.NDArray):
+        """
+        Args:
+            shape:   Shape of the equivalent dense grid.
+            indexes: Flattened index of each stored cell.
+            values:  Concentration of each stored cell.
+        """
+        self.shape = tuple(int(size) for size in shape)
+        self.indexes = indexes
+        self.values = values
+
+
+    def to_dense(self, out: npt.NDArray = None):
+        """
+        Args:
+            out: Array to write the dense grid to, which avoids allocating a new one. Defaults to None.
+        Returns:
+            Dense concentration grid, with zeros in the cells which are not stored.
+        """
+        if out is None:
+            out = np.zeros(self.shape)
+        else:
+            out.fill(0)
+        np.put(out, self.indexes, self.values)
+        return out
+
+
+    def save(self, path: str):
+        """Saves the grid to a NumPy .npz file (see load)."""
+        np.savez(path, shape=np.array(self.shape), indexes=self.indexes, values=self.values)
+
+
+def load(path: str):
+    """
+    Args:
+        path: Path of a .npz file created by SparseGrid.save.
+    Returns:
+        The saved sparse grid.
+    """
+    with np.load(path) as data:
+        return SparseGrid(data["shape"], data["indexes"], data["values"])
+
+
+def to_dense(concentrations: any, out: npt.NDArray = None):
+    """
+    Args:
+        concentrations: Dense concentration grid or sparse grid.
+        out:            Array to write a sparse grid to (see SparseGrid.to_dense). Defaults to None.
+    Returns:
+        Dense concentration grid. Dense grids are returned unchanged.
+    """
+    if isinstance(concentrations, SparseGrid):
+        return concentrations.to_dense(out)
+    return concentrations
@@ -0,0 +1,310 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List
+import numpy.typing as npt
+import numpy as np
+import itertools
+import argparse
+import sqlite3
+import time
+import json
+import sys
+import os
+import simulation
+import sparse
+import core
+
+"""
+This file implements parameter sweeps, which run a simulation for every combination of a set of parameter
+overrides applied on top of a configuration section (e.g. for sensitivity studies of the diffusivity, cell size,
+circle radius or velocity scale). Runs are scheduled across a pool of worker processes. Each worker reduces the
+final concentrations of its run to a few numbers (see 'reductions'), so concentration grids are never sent back
+to the main process, which streams the results into an SQLite database as runs finish. Runs already in the
+database are skipped, so an interrupted or extended sweep only simulates the runs it is missing.
+
+Example usage:
+    python sweep.py --section "Validation Tasks" --grid "diffusivity=[0.05, 0.1, 0.2]" \\
+                    --grid "particle_count=[10000, 100000]" --set dt=0.01 --reductions rmse max_concentration
+    python sweep.py --section "Animated Chemical Spill" --grid "velocity_scale=[0.5, 1, 2]" \\
+                    --grid "circle_radius=[0.1, 0.2]" --set time_max=0.5 --reductions exceedance_area
+"""
+
+# Default SQLite database the results of sweeps are stored in.
+default_store_path = "sweep_results.sqlite"
+# Concentration above which a cell counts towards the exceedance area (as in the chemical spill highlight).
+default_threshold = 0.3
+# Simulation parameters which have no default value (see simulation.optional_parameters).
+required_parameters = ["time_max", "dt", "diffusivity", "particle_count", "min", "max", "cell_size",
+                       "use_velocity", "use_circle", "use_rectangle", "optimized"]
+# Parameters which are only required when the toggle they are listed under is enabled.
+toggled_parameters = {
+    "use_velocity": ["velocity_field_path"],
+    "use_circle": ["circle_center", "circle_radius", "circle_value"],
+    "use_rectangle": ["rectangle_min", "rectangle_max", "rectangle_value"]
+}
+
+
+def get_rmse(concentrations: npt.NDArray, parameters: Dict[str, any], threshold: float):
+    """Root mean square error of the concentrations along x compared to the exact 1D solution (see reference.py)."""
+    import reference
+    assert parameters["use_rectangle"] and not parameters["use_circle"] and \
+           not parameters.get("shapes") and parameters["rectangle_value"] == 1, \
+        "The RMSE reduction requires a single rectangle initial condition with a value of 1"
+    _, expected = reference.get_reference_concentrations(
+        int(parameters["cell_size"][0]), float(parameters["time_max"]), float(parameters["diffusivity"]),
+        float(parameters["min"][0]), float(parameters["max"][0]), float(parameters["rectangle_min"][0]),
+        float(parameters["rectangle_max"][0]))
+    # Rows of the concentration grid are averaged, so 2D grids of a 1D problem can also be compared.
+    return float(np.sqrt(np.mean((np.mean(concentrations, axis=0) - expected) ** 2)))
+
+
+def get_exceedance_area(concentrations: npt.NDArray, parameters: Dict[str, any], threshold: float):
+    """Area of the domain covered by cells with a concentration above the threshold."""
+    domain_area = np.prod(np.array(parameters["max"]) - np.array(parameters["min"]))
+    return float(np.count_nonzero(concentrations > threshold) / concentrations.size * domain_area)
+
+
+"""
+Functions which reduce the final concentrations of a run to a single value. Each takes the dense concentration
+grid, the parameters of the run and the concentration threshold of the sweep.
+"""
+reductions = {
+    "rmse": get_rmse,
+    "max_concentration": lambda concentrations, parameters, threshold: float(np.max(concentrations)),
+    "mean_concentration": lambda concentrations, parameters, threshold: float(np.mean(concentrations)),
+    "exceedance_area": get_exceedance_area
+}
+
+
+def get_grid(grid: Dict[str, List[any]]):
+    """
+    Args:
+        grid: Values of each swept parameter.
+    Returns:
+        Overrides of every combination of the parameter values (the last parameter varies fastest).
+    """
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def get_missing_parameters(parameters: Dict[str, any]):
+    """
+    Args:
+        parameters: Simulation parameters of a run.
+    Returns:
+        Names of the required parameters which the run does not set, so a sweep can be rejected before
+        any of its runs are submitted rather than failing in the worker processes.
+    """
+    names = list(required_parameters)
+    for toggle, toggled in toggled_parameters.items():
+        if parameters.get(toggle, False):
+            names += toggled
+    return [name for name in names if parameters.get(name) is None]
+
+
+def run(parameters: Dict[str, any], reduction_names: List[str], threshold: float):
+    """Runs a simulation until completion in a worker process and reduces its final concentrations.
+    Args:
+        parameters:      Simulation parameters of the run.
+        reduction_names: Names of the reductions to compute (see 'reductions').
+        threshold:       Concentration threshold passed to the reductions.
+    Returns:
+        Value of each reduction and the wall time of the run in seconds.
+    """
+    import backends
+    start = time.perf_counter()
+    sim = backends.create_simulation(parameters)
+    sim.simulate()
+    sim.calculate_concentrations()
+    concentrations = sparse.to_dense(sim.concentrations)
+    values = {name: reductions[name](concentrations, parameters, threshold) for name in reduction_names}
+    return values, time.perf_counter() - start
+
+
+"""
+The Sweep class runs simulations for a list of parameter overrides and stores their reduced results in an
+SQLite database. Each run is a row of the 'runs' table (indexed by a hash of its parameters) and each of its
+reductions is a row of the 'results' table, so later sweeps can add runs and reductions to the same database.
+"""
+class Sweep(object):
+    def __init__(self, parameters: Dict[str, any], store_path: str = default_store_path,
+                 reduction_names: List[str] = ["max_concentration"], threshold: float = default_threshold,
+                 processes: int = None):
+        """
+        Args:
+            parameters:      Base simulation parameters which the overrides of each run are applied to.
+            store_path:      Path of the SQLite database to store results in. Defaults to default_store_path.
+            reduction_names: Names of the reductions to compute for each run (see 'reductions').
+                             Defaults to ["max_concentration"].
+            threshold:       Concentration threshold used by the exceedance area reduction. Defaults to 0.3.
+            processes:       Number of worker processes. Defaults to None (the number of CPUs).
+        """
+        for name in reduction_names:
+            assert name in reductions, "Unknown reduction '" + name + "', expected one of " + str(list(reductions))
+        self.parameters = parameters
+        self.reduction_names = list(reduction_names)
+        self.threshold = threshold
+        self.processes = os.cpu_count() if processes is None else processes
+        assert self.processes > 0, "Process count must be greater than 0"
+        self.connection = sqlite3.connect(store_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, overrides TEXT, parameters TEXT, seconds REAL,
+                                             error TEXT);
+            CREATE TABLE IF NOT EXISTS results (key TEXT, reduction TEXT, threshold REAL, value REAL,
+                                                PRIMARY KEY (key, reduction, threshold));
+        """)
+        # Databases created before failed runs were recorded have no error column.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(runs)")]
+        if "error" not in columns:
+            self.connection.execute("ALTER TABLE runs ADD COLUMN error TEXT")
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exception):
+        self.connection.close()
+
+
+    def __is_stored(self, key: str):
+        """Returns whether every reduction of a run is already in the database."""
+        stored = self.connection.execute("SELECT COUNT(*) FROM results WHERE key = ? AND threshold = ? AND " +
+                                         "reduction IN (" + ", ".join("?" * len(self.reduction_names)) + ")",
+                                         [key, self.threshold] + self.reduction_names).fetchone()[0]
+        return stored == len(self.reduction_names)
+
+
+    def __store(self, key: str, overrides: Dict[str, any], parameters: Dict[str, any],
+                values: Dict[str, float], seconds: float, error: str = None):
+        """Writes the results of a run to the database (replacing any previous results of the same run).
+           Failed runs are stored with their error and no results, so they are run again by the next sweep.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                                (key, json.dumps(overrides, default=simulation.get_json_value),
+                                 json.dumps(parameters, default=simulation.get_json_value), seconds, error))
+        self.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                    [(key, name, self.threshold, value) for name, value in values.items()])
+        # Committing after every run means the results of an interrupted sweep are kept.
+        self.connection.commit()
+
+
+    def run(self, overrides_list: List[Dict[str, any]], print_progress: bool = True):
+        """Runs every set of overrides which is not already in the database.
+        Args:
+            overrides_list: Parameters to replace in the base parameters for each run (see get_grid).
+            print_progress: Whether or not to print a line to the console as each run finishes.
+        Returns:
+            Results of every run (see results).
+        """
+        pending = []
+        for overrides in overrides_list:
+            parameters = dict(self.parameters)
+            parameters.update(overrides)
+            key = simulation.get_run_key(parameters)
+            if not self.__is_stored(key):
+                pending.append((key, overrides, parameters))
+        for key, overrides, parameters in pending:
+            missing = get_missing_parameters(parameters)
+            assert len(missing) == 0, "Run " + json.dumps(overrides, default=simulation.get_json_value) + \
+                " is missing the required parameters " + ", ".join(missing) + " (which can be set using --set)"
+        if print_progress:
+            print(str(len(overrides_list) - len(pending)) + " of " + str(len(overrides_list)) +
+                  " runs found in the store, simulating " + str(len(pending)))
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            tasks = {executor.submit(run, parameters, self.reduction_names, self.threshold): (key, overrides, parameters)
+                     for key, overrides, parameters in pending}
+            for finished, task in enumerate(as_completed(tasks)):
+                key, overrides, parameters = tasks[task]
+                # A failing run is recorded rather than stopping the sweep, so the other runs still finish.
+                try:
+                    values, seconds = task.result()
+                except Exception as exception:
+                    error = type(exception).__name__ + ": " + str(exception)
+                    self.__store(key, overrides, parameters, {}, None, error)
+                    if print_progress:
+                        print("[" + str(finished + 1) + "/" + str(len(pending)) + "] " +
+                              json.dumps(overrides, default=simulation.get_json_value) + " failed (" + error + ")")
+                    continue
+                self.__store(key, overrides, parameters, values, seconds)
+                if print_progress:
+                    print("[" + str(finished + 1) + "/" + str(len(pending)) + "] " +
+                          json.dumps(overrides, default=simulation.get_json_value) + " " + json.dumps(values) +
+                          " (" + str(round(seconds, 2)) + "s)")
+        return self.results(overrides_list)
+
+
+    def results(self, overrides_list: List[Dict[str, any]]):
+        """
+        Args:
+            overrides_list: Overrides of the runs to retrieve.
+        Returns:
+            List with the overrides, wall time and reduction values of each run which is in the database.
+            Failed runs have an 'error' entry instead of reduction values.
+        """
+        rows = []
+        for overrides in overrides_list:
+            parameters = dict(self.parameters)
+            parameters.update(overrides)
+            key = simulation.get_run_key(parameters)
+            found = self.connection.execute("SELECT seconds, error FROM runs WHERE key = ?", (key,)).fetchone()
+            if found is None:
+                continue
+            row = dict(overrides)
+            row["seconds"] = found[0]
+            if found[1] is not None:
+                row["error"] = found[1]
+            row.update(self.connection.execute("SELECT reduction, value FROM results WHERE key = ? AND threshold = ?",
+                                               (key, self.threshold)).fetchall())
+            rows.append(row)
+        return rows
+
+
+def parse_assignment(text: str):
+    """Parses a 'name=value' command line argument, where the value is JSON (e.g. "cell_size=[64, 1]")."""
+    name, _, value = text.partition("=")
+    assert name and value, "Expected an argument of the form name=value, got '" + text + "'"
+    return name.strip(), json.loads(value)
+
+
+def main(arguments: List[str]):
+    parser = argparse.ArgumentParser(description="Runs a parameter sweep of a simulation from config.json.")
+    parser.add_argument("--section", default="Validation Tasks",
+                        help="Configuration section to take the base simulation parameters from.")
+    parser.add_argument("--grid", action="append", default=[],
+                        help="Swept parameter and a JSON list of its values, e.g. \"diffusivity=[0.05, 0.1]\". " +
+                             "Every combination of the values of all swept parameters is run.")
+    parser.add_argument("--runs", default=None,
+                        help="JSON file containing a list of parameter overrides, each combined with the grid.")
+    parser.add_argument("--set", action="append", default=[],
+                        help="Parameter override applied to every run, e.g. \"time_max=0.5\".")
+    parser.add_argument("--reductions", nargs="+", default=["max_concentration"], choices=list(reductions),
+                        help="Values computed from the final concentrations of each run.")
+    parser.add_argument("--threshold", type=float, default=default_threshold,
+                        help="Concentration threshold of the exceedance area reduction.")
+    parser.add_argument("--store", default=default_store_path, help="SQLite database to store the results in.")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args(arguments)
+
+    with open(core.relative_to_absolute(__file__, "config.json")) as json_file:
+        parameters: Dict[str, any] = dict(json.load(json_file)[args.section]["parameters"])
+    for key in ["velocity_field_path", "diffusivity_field_path", "reference_file_path"]:
+        if parameters.get(key) is not None:
+            parameters[key] = core.relative_to_absolute(__file__, parameters[key])
+    parameters.update(parse_assignment(text) for text in args.set)
+
+    overrides_list = get_grid(dict(parse_assignment(text) for text in args.grid))
+    if args.runs is not None:
+        with open(args.runs) as json_file:
+            runs = json.load(json_file)
+        overrides_list = [dict(listed, **overrides) for listed in runs for overrides in overrides_list]
+
+    with Sweep(parameters, args.store, args.reductions, args.threshold, args.processes) as sweep:
+        rows = sweep.run(overrides_list)
+    for row in rows:
+        print(json.dumps(row))
+    return 0
+
+
+"""Entry point to parameter sweeps"""
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,126 +1,18 @@
-from PIL import Image, ImageTk
-from tkinter import messagebox
-from typing import List
-import matplotlib.pyplot as plt
-import matplotlib.colors
-import numpy.typing as npt
-import numpy as np
+from tkinter import messagebox, ttk
 import tkinter as tk
-import os
 
 """
-This file contains general utility functions used throughout the project.
+This file contains the Tkinter widget helper functions used by the user interface.
 None of these functions have dependency on other project files.
+
+PIL is imported inside the function which uses it, as importing it takes much
+longer than starting the user interface (and it is rarely needed).
 """
 
 # Variable which ensures consistent background color across widgets.
 background_color = "white"
 
 
-def read_data_file(file: any, *columns):
-    """Function for reading and checking column data from a data file.
-    Args:
-        columns: List of column indexes to read into the returned list.
-    Returns:
-        A list of data in the specified columns, or a list of None if columns are not found. 
-    """
-    data = []
-    for column in columns:
-        try:
-            # Read the given columns out of the file and append them to a list.
-            data.append(np.genfromtxt(file, usecols=tuple(column), invalid_raise=True))
-        except:
-            print("Could not retrieve " + str(column) + " columns from file " + str(os.path.basename(file)))
-            return [None for column in columns]
-    return data
-
-
-def relative_to_absolute(directory: any, path: str):
-    """Converts relative file paths to absolute.
-    Args:
-        directory: Directory of the file.
-        path:      Name of the file.
-    Returns:
-        A relative file path converted to an absolute file object.
-    """
-    return os.path.join(os.path.dirname(directory), path)
-
-
-def create_heatmap(data: npt.ArrayLike, color_list: List[any], 
-                   animated: bool, min: npt.ArrayLike, max: npt.ArrayLike, 
-                   x_label: str, y_label: str):
-    """Creates a heatmap figure used for plotting scalar fields.
-    Args:
-        data:       Scalar field to be plotted.
-        color_list: List of integer and color intervals used for determining
-                    the color gradient of the figure's color bar.
-        animated:   Whether or not the heatmap can be animated.
-        min:        [x, y] axis bounds
-        max:        [x, y] axis bounds.
-        x_label:    X axis label.
-        y_label:    Y axis label.
-    Returns:
-        A figure, its axes, and the created heatmap.
-    """
-    # Close all previous plots to improve performance.
-    plt.close('all')
-    figure, axes = plt.figure(), plt.axes()
-    axes.set_xlabel(x_label)
-    axes.set_ylabel(y_label)
-    heatmap = axes.imshow(data, animated=animated,
-                          extent=(min[0], max[0], min[1], max[1]))
-    # Turn the lists inside the color_list into 
-    # tuples as required by the from_list function.
-    cmap = matplotlib.colors.LinearSegmentedColormap.from_list(
-        "", [tuple(pair) for pair in color_list])
-    heatmap.set_cmap(cmap)
-    figure.colorbar(matplotlib.cm.ScalarMappable(cmap=cmap))
-    return figure, axes, heatmap
-
-def create_line_plot(x_data: any, y_data: any,
-                     x_min: float, x_max: float,
-                     y_min: float, y_max: float,
-                     x_label: str, y_label: str):
-    """Creates a line plot figure used for plotting 1D concentration data.
-    Args:
-        x_data: X axis data to be plotted.
-        y_data: Y axis data to be plotted.
-        x_min:  X axis lower bound.
-        x_max:  X axis upper bound.
-        y_min:  Y axis lower bound.
-        y_max:  Y axis upper bound.
-        x_label:    X axis label.
-        y_label:    Y axis label.
-    Returns:
-        A figure, its axes, and the created line object.
-    """
-    # Close all previous plots to improve performance.
-    plt.close('all')
-    figure, axes = plt.figure(), plt.axes()
-    lines, = plt.plot(x_data, y_data)
-    plt.grid()
-    plt.xlim(x_min, x_max)
-    plt.ylim(y_min, y_max)
-    plt.xlabel(x_label)
-    plt.ylabel(y_label)
-    return figure, axes, lines
-
-def configure_plot(title: str, x_label: str, y_label: str, scale: str):
-    """Sets the matplotlib plot to have with the desired parameters."""
-    plt.title(title)
-    plt.legend()
-    plt.grid()
-    plt.yscale(scale)
-    plt.xscale(scale)
-    plt.xlabel(x_label)
-    plt.ylabel(y_label)
-
-"""
-The utility functions below are primarily there to reduce boilerplate 
-code for interacting with and creating gridded Tkinter widgets (GUI).
-"""
-
-
 def create_root(geometry: str):
     """Creates a Tkinter window with a given geometry (size and offset).
     Args:
@@ -301,6 +193,25 @@ def create_button(parent_container: any, text: str, row: int, column: int,
     return button
 
 
+def create_progress_bar(parent_container: any, row: int, column: int,
+                        sticky: str = "EW", padx: any = 20, pady: any = 0):
+    """
+    Args:
+        parent_container: Container in which to create the progress bar.
+        row:              Row in the parent container to use for the progress bar.
+        column:           Column in the parent container to use for the progress bar.
+        sticky:           Stretching properties of the progress bar. Defaults to "EW".
+        padx:             External x direction padding of the progress bar. Defaults to 20.
+        pady:             External y direction padding of the progress bar. Defaults to 0.
+    Returns:
+        Tkinter progress bar widget, its "value" ranges from 0 to 100.
+    """
+    progress_bar = ttk.Progressbar(parent_container, orient="horizontal",
+                                   mode="determinate", maximum=100)
+    progress_bar.grid(row=row, column=column, padx=padx, pady=pady, sticky=sticky)
+    return progress_bar
+
+
 def create_image(parent_container: any, path: any, 
                  row: int, column: int, sticky: str = "NSEW"):
     """
@@ -314,8 +225,13 @@ def create_image(parent_container: any, path: any,
     Returns:
         Tkinter image object.
     """
-    tkinter_image = ImageTk.PhotoImage(
-        image=Image.open(path), master=parent_container)
+    try:
+        # Tkinter can load PNG and GIF images itself, which avoids importing PIL.
+        tkinter_image = tk.PhotoImage(file=path, master=parent_container)
+    except tk.TclError:
+        from PIL import Image, ImageTk
+        tkinter_image = ImageTk.PhotoImage(
+            image=Image.open(path), master=parent_container)
     image = tk.Label(parent_container, bg=background_color, image=tkinter_image)
     image.image = tkinter_image
     image.grid(row=row, column=column, sticky=sticky)
@@ -342,27 +258,3 @@ def check(condition: bool, message: str):
         (and prompts the user with an error message).
     """
     return True if condition else not bool(messagebox.showinfo("Field error", message))
-
-
-def contains_value(dictionary_or_list: any, element: any):
-    """Recrusively checks if an iterable object contains an element.
-    Args:
-        dictionary_or_list: Dictionary or List object to check through.
-        element:            Any variable to check for.
-    Returns:
-        True if the dictionary or list contains the given element, false otherwise.
-    """
-    # This is a fairly self-explanatory recursive search algorithm.
-    if isinstance(dictionary_or_list, list):
-        if element in dictionary_or_list: return True
-        for v in dictionary_or_list:
-            if isinstance(v, list) or isinstance(v, dict):
-                if contains_value(v, element): return True
-    # The reason it is repeated twice is because lists
-    # and dictionaries differ in how they are iterated.
-    elif isinstance(dictionary_or_list, dict):
-        if element in dictionary_or_list.values(): return True
-        for _, v in dictionary_or_list.items():
-            if isinstance(v, list) or isinstance(v, dict):
-                if contains_value(v, element): return True
-    return False
\ No newline at end of file
@@ -1,31 +1,209 @@
 from scipy.interpolate import interp1d
-from scipy.optimize import curve_fit
 from scipy.signal import lfilter
 from typing import Dict, List
-import matplotlib.pyplot as plt
 import numpy.typing as npt
 import numpy as np
+import tempfile
+import os
+import reference
 import simulation
-import utility
+import backends
+import sparse
+import plotting
+import core
 
 """
 This file implements a class which handles error validation related tasks.
 """
 
+# Number of Levenberg-Marquardt iterations used to refine power law fits (see fit_power_laws).
+refine_iterations = 20
+# Largest relative deviation from a uniform particle density allowed by check_well_mixed.
+well_mixed_tolerance = 0.15
+
+
+def fit_log_log(x: npt.NDArray, y: npt.NDArray):
+    """
+    Closed form least squares fit of straight lines, log(y) = log(a) + B * log(x), to every row at once.
+    Args:
+        x: Positive x values. shape=(..., points), broadcastable against y.
+        y: Positive y values of each row. shape=(..., points)
+    Returns:
+        Fitted a and B values of each row.
+    """
+    log_x, log_y = np.log(x), np.log(y)
+    centred_x = log_x - np.mean(log_x, axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slopes = np.sum(centred_x * (log_y - np.mean(log_y, axis=-1, keepdims=True)), axis=-1) / \
+                 np.sum(centred_x ** 2, axis=-1)
+    intercepts = np.mean(log_y, axis=-1) - slopes * np.mean(log_x, axis=-1)
+    return np.exp(intercepts), slopes
+
+
+def fit_power_laws(x: npt.NDArray, y: npt.NDArray, sigma: npt.NDArray = None, refine: bool = True):
+    """
+    Fits the model y = a * x^B to every row of y at once. The model is linear in log space, so the fit found there
+    (see fit_log_log) is used directly or as the starting point of a (weighted) least squares fit in linear space,
+    which is refined with Levenberg-Marquardt iterations solving the 2x2 normal equations of every row together.
+    Args:
+        x:      Positive x values. shape=(..., points), broadcastable against y.
+        y:      Positive y values of each row. shape=(..., points)
+        sigma:  Standard deviation of each y value, whose inverse squares weight the refinement.
+                Defaults to None (equal weights, as scipy.optimize.curve_fit).
+        refine: Whether or not the log space fit is refined in linear space. Defaults to True.
+    Returns:
+        Fitted [a, B] values of each row. shape=(..., 2)
+    """
+    a, B = fit_log_log(x, y)
+    if refine:
+        log_x = np.log(x)
+        weights = np.ones(y.shape) if sigma is None else 1 / np.square(sigma)
+        def get_cost(a, B): return np.sum(weights * (y - a[..., np.newaxis] * x ** B[..., np.newaxis]) ** 2, axis=-1)
+        # Levenberg-Marquardt damping of each row, which is reduced while steps improve the fit and increased
+        # otherwise, so rows which are poorly described by the starting point still converge.
+        damping = np.full(a.shape, 1e-3)
+        cost = get_cost(a, B)
+        for _ in range(refine_iterations):
+            model = a[..., np.newaxis] * x ** B[..., np.newaxis]
+            residuals = y - model
+            # Derivatives of the model with respect to a and B.
+            d_a = model / a[..., np.newaxis]
+            d_B = model * log_x
+            j_aa = np.sum(weights * d_a * d_a, axis=-1) * (1 + damping)
+            j_ab = np.sum(weights * d_a * d_B, axis=-1)
+            j_bb = np.sum(weights * d_B * d_B, axis=-1) * (1 + damping)
+            r_a = np.sum(weights * d_a * residuals, axis=-1)
+            r_b = np.sum(weights * d_B * residuals, axis=-1)
+            determinant = j_aa * j_bb - j_ab ** 2
+            # Rows with a singular system (e.g. a single distinct x value) keep their current fit.
+            safe = np.where(determinant != 0, determinant, np.inf)
+            new_a = a + (j_bb * r_a - j_ab * r_b) / safe
+            new_B = B + (j_aa * r_b - j_ab * r_a) / safe
+            new_cost = get_cost(new_a, new_B)
+            improved = new_cost < cost
+            a, B = np.where(improved, new_a, a), np.where(improved, new_B, B)
+            cost = np.where(improved, new_cost, cost)
+            damping = np.where(improved, damping / 10, damping * 10)
+    return np.stack((a, B), axis=-1)
+
+
+def bootstrap_slopes(x: npt.NDArray, y: npt.NDArray, samples: int, rng: np.random.Generator,
+                     sigma: npt.NDArray = None, refine: bool = True, confidence: float = 0.95):
+    """
+    Finds confidence intervals of the fitted B value of every row by resampling the points of each row with
+    replacement. Every resample of every row is fitted at once (see fit_power_laws).
+    Args:
+        x:          Positive x values shared by every row. shape=(points,)
+        y:          Positive y values of each row. shape=(rows, points)
+        samples:    Number of bootstrap resamples.
+        rng:        Random number generator used for resampling.
+        sigma:      Standard deviation of each y value (see fit_power_laws). Defaults to None.
+        refine:     Whether or not the fits are refined in linear space (see fit_power_laws). Defaults to True.
+        confidence: Probability covered by the intervals. Defaults to 0.95.
+    Returns:
+        Lower and upper bounds of the B value of each row. shape=(rows, 2)
+    """
+    resamples = rng.integers(0, x.size, (samples, x.size))
+    # Resamples which pick a single x value cannot be fitted (nan) and are ignored.
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        slopes = fit_power_laws(x[resamples], y[:, resamples], None if sigma is None else sigma[:, resamples],
+                                refine)[..., 1]
+    tail = (1 - confidence) / 2 * 100
+    return np.nanpercentile(slopes, [tail, 100 - tail], axis=1).T
+
+
+def check_well_mixed(particle_count: int = 40000, dt: float = 0.0005, time_max: float = 0.25,
+                     kernel: str = "numpy", bins: int = 5, tolerance: float = well_mixed_tolerance):
+    """
+    A uniform concentration is a steady state of dc/dt = div(D grad(c)) for any diffusivity field, so particles
+    which start uniformly distributed must stay uniformly distributed. Without the drift dt * grad(D) (or with a
+    drift which does not match the diffusivities used for the noise) particles gather where the diffusivity is low.
+    This runs a simulation whose diffusivity field steps from 0.01 to 0.3 at x = 0.3 and checks the particle density.
+    Args:
+        particle_count: Number of particles in the simulation. Defaults to 40000.
+        dt:             Time step, which must be small enough to resolve the step. Defaults to 0.0005.
+        time_max:       Simulated time. Defaults to 0.25.
+        kernel:         Kernel used to update the particles ("numpy" or "numba"). Defaults to "numpy".
+        bins:           Number of density bins along each axis. Defaults to 5.
+        tolerance:      Largest relative deviation of the density allowed. Defaults to well_mixed_tolerance.
+    Returns:
+        Largest relative deviation of the density of any bin from the mean density, and whether it is allowed.
+    """
+    nodes = np.linspace(-1, 1, 21)
+    x, y = np.meshgrid(nodes, nodes, indexing="ij")
+    field = np.column_stack((x.ravel(), y.ravel(), np.where(x.ravel() < 0.3, 0.01, 0.3)))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "diffusivity.dat")
+        np.savetxt(path, field)
+        run = simulation.Simulation({"time_max": time_max, "dt": dt, "diffusivity": 0.1,
+                                     "particle_count": particle_count, "min": [-1, -1], "max": [1, 1],
+                                     "cell_size": [bins, bins], "use_velocity": False, "use_circle": False,
+                                     "use_rectangle": False, "optimized": False, "seed": 0,
+                                     "diffusivity_field_path": path, "kernel": kernel})
+        run.simulate()
+    density, _, _ = np.histogram2d(run.coordinates[:, 0], run.coordinates[:, 1], bins=bins, range=[[-1, 1], [-1, 1]])
+    deviation = float(np.max(np.abs(density / np.mean(density) - 1)))
+    return deviation, deviation <= tolerance
+
+
 """
 The Validation class encapsulates some of the data required for performing
 the error analysis tasks, which makes it easier for the GUI to interface with.
 """
 class Validation(object):
-    def __init__(self, sim_args: Dict[str, any]):
+    def __init__(self, sim_args: Dict[str, any], replicas: int = 1, antithetic: bool = False,
+                 common_random_numbers: bool = False, cache_directory: str = None):
         """
         Args:
-            sim_args: Dictionary containing all the parameters used by the
-                      simulation (e.g. dt, max time, cell size, etc).
+            sim_args:              Dictionary containing all the parameters used by the
+                                   simulation (e.g. dt, max time, cell size, etc). If it contains a
+                                   'reference_file_path', the reference solution is interpolated from
+                                   that file, otherwise the exact solution is computed (see reference.py).
+            replicas:              Number of independent runs averaged for each particle count and time
+                                   step. With more than 1 replica, confidence intervals are found for the
+                                   RMSE values (see 'rmse_confidence'). Defaults to 1.
+            antithetic:            Whether each run is a pair of simulations with half the particles each,
+                                   whose diffusive noise is negated in the second simulation. The averaged
+                                   pair has a lower variance than a single run with the same particle count.
+                                   Particle counts must then be even. Defaults to False.
+            common_random_numbers: Whether every particle count and time step uses the same seeds, so that
+                                   differences between them are not hidden by run to run noise.
+                                   Defaults to False.
+            cache_directory:       Directory in which the final concentrations of each run are stored. Runs
+                                   found in it are loaded instead of simulated, so repeated and extended sweeps
+                                   only simulate new runs and an interrupted sweep resumes where it stopped.
+                                   Runs are identified by all of their parameters (including the seed), so a
+                                   'seed' should be set in sim_args for them to be found again in later sessions.
+                                   Defaults to None (no caching).
         """
+        assert replicas > 0, "Replica count must be greater than 0"
         self.sim_args = sim_args
+        self.replicas = replicas
+        self.antithetic = antithetic
+        self.common_random_numbers = common_random_numbers
+        self.cache_directory = cache_directory
+        if self.cache_directory is not None:
+            os.makedirs(self.cache_directory, exist_ok=True)
+        # All run seeds are derived from this, so they are reproducible if the simulation parameters set a seed.
+        self.entropy = np.random.SeedSequence(self.sim_args.get("seed")).entropy
+        # Half width of the 95% confidence interval of each RMSE value found by the latest sweep.
+        self.rmse_confidence = None
+        # Bounds of the 95% bootstrap confidence interval of each β value found by the latest curve fit.
+        self.beta_confidence = None
+
+        if self.sim_args.get("reference_file_path") is None:
+            # Without a reference file the exact solution is used, which allows any grid size, time and diffusivity.
+            assert self.sim_args["use_rectangle"] and not self.sim_args["use_circle"] and \
+                   not self.sim_args.get("shapes") and self.sim_args["rectangle_value"] == 1, \
+                "The exact reference solution requires a single rectangle initial condition with a value of 1"
+            self.reference_cells, self.reference_concentrations = reference.get_reference_concentrations(
+                int(self.sim_args["cell_size"][0]), float(self.sim_args["time_max"]),
+                float(self.sim_args["diffusivity"]), float(self.sim_args["min"][0]),
+                float(self.sim_args["max"][0]), float(self.sim_args["rectangle_min"][0]),
+                float(self.sim_args["rectangle_max"][0]))
+            return
 
-        coordinates, concentrations = utility.read_data_file(
+        coordinates, concentrations = core.read_data_file(
             self.sim_args["reference_file_path"], [0], [1])
         assert not isinstance(coordinates, type(None)), \
             "Could not retrieve coordinates from reference file"
@@ -45,6 +223,37 @@ class Validation(object):
         self.reference_concentrations = reference_function(self.reference_cells)
 
     
+    def __get_seed(self, dt: float, particle_count: int, replica: int):
+        """
+        Returns:
+            Seed of a run. With common random numbers the seed only depends on the replica. Otherwise it
+            depends on the time step (through its bits) and particle count rather than their positions in
+            the sweep, so that runs are repeated exactly (and found in the cache) when a sweep is extended.
+        """
+        key = (replica,) if self.common_random_numbers else \
+              (int(np.float64(dt).view(np.uint64)), int(particle_count), replica)
+        return int(np.random.SeedSequence(self.entropy, spawn_key=key).generate_state(1, np.uint64)[0])
+
+
+    def __run(self, sim_args: Dict[str, any]):
+        """Runs a simulation until completion (or loads it from the cache) and returns its final concentrations."""
+        if self.cache_directory is not None:
+            key = simulation.get_run_key(sim_args)
+            path = os.path.join(self.cache_directory, key + ".npy")
+            if os.path.exists(path):
+                return np.load(path)
+        run = backends.create_simulation(sim_args)
+        run.simulate()
+        run.calculate_concentrations()
+        concentrations = sparse.to_dense(run.concentrations).ravel()
+        if self.cache_directory is not None:
+            # Writing to a temporary file first means a sweep killed mid write never leaves a corrupt result.
+            with open(path + ".tmp", "wb") as file:
+                np.save(file, concentrations)
+            os.replace(path + ".tmp", path)
+        return concentrations
+
+
     def __get_concentrations(self, particles: npt.NDArray, dts: npt.NDArray):
         """
         Generates an array of concentrations for given particle count and time steps.
@@ -53,31 +262,40 @@ class Validation(object):
             dts:       Time steps to to retrieve the concentrations for.
         Returns:
             Multi-dimensional array of concentrations.
-            shape=(dts.size, particles.size, concentrations.size)
+            shape=(dts.size, particles.size, replicas, concentrations.size)
         """
-        concentrations = np.array([])
+        # Both halves of an antithetic pair need the same number of particles to share their initial conditions
+        # and random numbers, so odd counts cannot be split without changing the total particle count.
+        assert not self.antithetic or np.all((np.array(particles) % 2 == 0) & (np.array(particles) > 0)), \
+            "Antithetic runs require even particle counts, got " + str(np.array(particles).tolist())
+        concentrations = []
         for dt in dts:
-            self.sim_args["dt"] = dt
             for particle_count in particles:
                 # Let the user know the progress of the retrieval.
                 print("Running simulation with [particle_count=" +
                       str(particle_count) + ", dt=" + str(dt) + "]")
-                self.sim_args["particle_count"] = particle_count
-                run = simulation.Simulation(self.sim_args)
-                run.simulate()
-                # Find and store the concentration at the final time.
-                run.calculate_concentrations()
-                concentrations = np.append(concentrations, run.concentrations)
+                for replica in range(self.replicas):
+                    sim_args = dict(self.sim_args, dt=dt, particle_count=particle_count,
+                                    seed=self.__get_seed(dt, particle_count, replica))
+                    if self.antithetic:
+                        # Both halves of the pair share a seed (and so their initial conditions) but their
+                        # noise has opposite signs. Together they use the same number of particles as one run.
+                        sim_args["particle_count"] = particle_count // 2
+                        concentrations.append((self.__run(sim_args) +
+                                               self.__run(dict(sim_args, antithetic=True))) / 2)
+                    else:
+                        concentrations.append(self.__run(sim_args))
         # Reshaping the array allows for accessing specific
         # time steps and numbers of particles easier.
-        return np.reshape(concentrations, 
-                          (dts.size, particles.size, run.concentrations.size))
+        return np.reshape(concentrations, (dts.size, particles.size, self.replicas, -1))
 
 
     def __calculate_rmse(self, particles: npt.NDArray, dts: npt.NDArray):
         """
         Finds the root mean square error (RMSE) for 
         different particle counts and time steps.
+        The RMSE of each replica is found separately and then averaged, which
+        also gives the 95% confidence interval stored in 'rmse_confidence'.
         Args:
             particles: Particle counts to retrieve the RMSE for.
             dts:       Time steps to retrieve the RMSE for.
@@ -89,7 +307,11 @@ class Validation(object):
         # the dimensions of the calculated concentrations.
         reference = np.full(calculated.shape, self.reference_concentrations)
         # Apply the formula for the root mean square for each set of concentrations.
-        return np.sqrt(np.average((reference - calculated) ** 2, axis=2))
+        rmse = np.sqrt(np.average((reference - calculated) ** 2, axis=3))
+        self.rmse_confidence = np.zeros(rmse.shape[:2])
+        if self.replicas > 1:
+            self.rmse_confidence = 1.96 * np.std(rmse, axis=2, ddof=1) / np.sqrt(self.replicas)
+        return np.average(rmse, axis=2)
 
 
     def reference_comparison_figure(self, particles: npt.NDArray, 
@@ -106,13 +328,16 @@ class Validation(object):
         Returns:
             Matplotlib figure of the reference comparison plot.
         """
+        # Imported here so that validation can run without matplotlib (e.g. in headless worker processes).
+        import matplotlib.pyplot as plt
         figure = plt.figure(figsize=(8, 6))
         # If not enough line styles are provided for
         # each particle count default to solid lines.
         if len(line_styles) is not len(particles):
             line_styles = [None] * len(particles)
         
-        calculated = self.__get_concentrations(particles, np.array([dt]))
+        # Replicas are averaged into a single concentration profile for each particle count.
+        calculated = np.average(self.__get_concentrations(particles, np.array([dt])), axis=2)
         plt.plot(self.reference_cells, self.reference_concentrations, label="Reference")
         
         # Plot each of the calculated concentrations on 
@@ -121,7 +346,7 @@ class Validation(object):
             plt.plot(self.reference_cells, calculated_concentration,
                      label="Number of Particles: " + str(particles[index]), 
                      linestyle=line_styles[index])
-        utility.configure_plot("Concentration ϕ vs x (t=0.2s, dt=" + str(dt) + "s)",
+        plotting.configure_plot("Concentration ϕ vs x (t=0.2s, dt=" + str(dt) + "s)",
                                "x", "Concentration ϕ", "linear")
         return figure
 
@@ -129,7 +354,8 @@ class Validation(object):
     def rmse_figure(self, particles: npt.NDArray, dts: npt.NDArray, 
                     rmse_array: npt.NDArray, scale: str,
                     fitted_values: List[any] = None,
-                    fitting_parameters: List[any] = None):
+                    fitting_parameters: List[any] = None,
+                    rmse_errors: npt.NDArray = None):
         """
         Produces a root mean square error versus number of particles
         figure with a given scale and optional fitting.
@@ -142,9 +368,12 @@ class Validation(object):
                                 Defaults to None (meaning ignored).
             fitting_parameters: Array of fitting parameters. shape=(particles.size, 2).
                                 Defaults to None (meaning ignored).
+            rmse_errors:        Array of RMSE error bar sizes (e.g. 'rmse_confidence').
+                                Defaults to None (meaning no error bars).
         Returns:
             Matplotlib figure of the RMSE vs particle count plot.
         """
+        import matplotlib.pyplot as plt
         figure = plt.figure(figsize=(8, 6))
         fit = fitted_values is not None and fitting_parameters is not None
         for index, dt in enumerate(dts):
@@ -159,38 +388,48 @@ class Validation(object):
                 plt.plot(particles, fitted_values[index], label=dt_label +
                          ", β: " + str(round(fitting_parameters[index][1], 3)))
             # Add the RMSE values against particle counts to the plot.
-            plt.scatter(particles, rmse_array[index], label=scatter_label)
-        utility.configure_plot("RMS Error vs Number of Particles (" + scale + ")",
+            if rmse_errors is None:
+                plt.scatter(particles, rmse_array[index], label=scatter_label)
+            else:
+                plt.errorbar(particles, rmse_array[index], yerr=rmse_errors[index],
+                             fmt="o", capsize=3, label=scatter_label)
+        plotting.configure_plot("RMS Error vs Number of Particles (" + scale + ")",
                                "Number of Particles", "RMS Error", scale)
         return figure
 
 
-    def fit_rmse_curve(self, particles: npt.NDArray, dts: npt.NDArray):
+    def fit_rmse_curve(self, particles: npt.NDArray, dts: npt.NDArray, refine: bool = True,
+                       weighted: bool = False, bootstraps: int = 0):
         """ 
         Args:
-            particles: Particle counts to find the RMSE and curve fit for.
-            dts:       Time steps to find the RMSE and curve fit for.
+            particles:  Particle counts to find the RMSE and curve fit for.
+            dts:        Time steps to find the RMSE and curve fit for.
+            refine:     Whether or not the log-log fit is refined by a least squares fit of the RMSE values
+                        themselves (see fit_power_laws). Defaults to True.
+            weighted:   Whether the refinement weights each RMSE value by its confidence interval (only used
+                        with more than 1 replica). Defaults to False.
+            bootstraps: Number of bootstrap resamples used to find the confidence interval of each β value
+                        (stored in 'beta_confidence'). Defaults to 0 (no confidence intervals).
         Returns:
-            RMSE array, fitted values of RMSE, and the fitting slopes (β values).
+            RMSE array, fitted values of RMSE, and the fitting parameters ([a, β] values).
         """
         rmse_array = self.__calculate_rmse(particles, dts)
-        # Smoothing parameter for the data filter.
-        smoothing = 3
-        # The model we expect for the curve fit (exponential).
-        def E(N, a, B): return a * N ** B
-        fitting_parameters = []
-        fitted_values = []
-        for index in range(len(dts)):
-            """
-            Filter the RMSE array values before applying the curve fitting.
-            This is done because the RMSE values have a lot of variation between runs.
-            """
-            filtered_rmse = lfilter([1.0 / smoothing] * smoothing, 1, x=rmse_array[index])
-            # Fit the particle counts and the filtered 
-            # RMSE values based on the expected model.
-            parameters, _ = curve_fit(E, particles, filtered_rmse, p0=[1, -0.5])
-            # Store the fitted values and fitting parameters
-            # for printing or graphing later.
-            fitting_parameters.append(parameters)
-            fitted_values.append(E(particles, *parameters))
+        # Smoothing parameter for the data filter. Averaging replicas
+        # already reduces the variation, so they are not filtered.
+        smoothing = 3 if self.replicas == 1 else 1
+        """
+        Filter the RMSE array values before applying the curve fitting.
+        This is done because the RMSE values have a lot of variation between runs.
+        """
+        filtered_rmse = lfilter([1.0 / smoothing] * smoothing, 1, x=rmse_array, axis=1)
+        # The model we expect for the curve fit (power law), E(N) = a * N^β, is fitted to every time step at once.
+        sigma = None
+        if weighted and self.replicas > 1 and np.all(self.rmse_confidence > 0):
+            sigma = self.rmse_confidence
+        fitting_parameters = fit_power_laws(particles, filtered_rmse, sigma, refine)
+        fitted_values = fitting_parameters[:, 0:1] * particles ** fitting_parameters[:, 1:2]
+        self.beta_confidence = None
+        if bootstraps > 0:
+            rng = np.random.default_rng(self.entropy)
+            self.beta_confidence = bootstrap_slopes(particles, filtered_rmse, bootstraps, rng, sigma, refine)
         return rmse_array, fitted_values, fitting_parameters
\ No newline at end of file